@@ -1,10 +1,9 @@
 # Send key sequence to attempt docking
-import sqlite3
 import time
 import subprocess
 
 from common.ocr import MultithreadOcr, import_news_results
-from common.personaldb import StructuredImport, Writer
+from common.personaldb import Writer, connect, structured_import
 
 NEWS_PATH = "/home/greg/ed/news/"
 DB_PATH = "/home/greg/ed/save.db"
@@ -50,10 +49,11 @@ for i in range(14):
     send_key(" ")
 send_key("<backspace>")
 try:
-    with sqlite3.connect(DB_PATH) as conn:
+    results = ocr.get_all()
+    with connect(DB_PATH) as conn:
         writer = Writer(conn, False)
-        importer = StructuredImport(writer)
-        import_news_results(ocr.get_all(), importer, True)
-        writer.commit()
+        importer = structured_import(writer)
+        with writer.transaction():
+            import_news_results(results, importer, True)
 finally:
     ocr.shutdown()
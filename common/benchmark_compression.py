@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from personaldb import Writer, StructuredImport, decode_event, register_functions
+from personal_best import Reader
+from trade_data import trade_query
+from import_journal import SAVE_PATH, BATCH_SIZE, COMPRESS_THRESHOLD
+
+QUERIES = [
+    ("material query", Reader.MATERIAL_QUERY, []),
+    ("trade query", trade_query(), []),
+    ("events scan", "SELECT COUNT(*) FROM events WHERE json_extract(inflate(event), '$.StarSystem') IS NOT NULL", []),
+    ("market snapshots", "SELECT COUNT(*) FROM Market, json_each(Market.Items)", []),
+]
+# Tables whose size is reported on their own: events, and the snapshots with the rows pointing at them
+TABLES = ("events", "snapshots", "MarketRecord", "OutfittingRecord", "ShipyardRecord")
+
+
+def load_corpus(save_path):
+    lines = []
+    for name in sorted(os.listdir(save_path)):
+        if "Journal." not in name:
+            continue
+        with open(os.path.join(save_path, name), 'rb') as file:
+            lines.extend(line for line in file.readlines() if line.strip())
+    return lines
+
+
+def build_db(db_path, lines, compress_threshold):
+    start = time.perf_counter()
+    with sqlite3.connect(db_path) as conn:
+        writer = Writer(conn, False, BATCH_SIZE, compress_threshold)
+        importer = StructuredImport(writer)
+        for line in lines:
+            importer.event(decode_event(line))
+        writer.commit()
+    elapsed = time.perf_counter() - start
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("VACUUM")
+    return elapsed
+
+
+def table_sizes(db_path, tables):
+    # Pages of each table and its indexes, from the dbstat virtual table
+    with sqlite3.connect(db_path) as conn:
+        try:
+            sizes = dict(conn.execute("""
+                SELECT sqlite_master.tbl_name, SUM(dbstat.pgsize)
+                FROM dbstat
+                JOIN sqlite_master ON sqlite_master.name = dbstat.name
+                GROUP BY sqlite_master.tbl_name
+            """))
+        except sqlite3.OperationalError:
+            # SQLite built without dbstat
+            return [float('nan')] * len(tables)
+    return [sizes.get(table, 0) / 1024 / 1024 for table in tables]
+
+
+def time_query(db_path, sql, values, repeat):
+    with sqlite3.connect(db_path) as conn:
+        register_functions(conn)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                conn.execute(sql, values).fetchall()
+            except sqlite3.OperationalError:
+                # The corpus lacks a table the query needs, e.g. the OCR tables of the trade query
+                return float('nan')
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+
+def benchmark(save_path, compress_threshold, repeat):
+    lines = load_corpus(save_path)
+    print(f"{len(lines)} events from {save_path}")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, threshold in (("plain", None), ("compressed", compress_threshold)):
+            db_path = os.path.join(tmp, label + ".db")
+            rows = [("import (s)", build_db(db_path, lines, threshold))]
+            rows.append(("size (MB)", os.path.getsize(db_path) / 1024 / 1024))
+            rows.extend((table + " (MB)", size) for table, size in zip(TABLES, table_sizes(db_path, TABLES)))
+            for name, sql, values in QUERIES:
+                rows.append((name + " (s)", time_query(db_path, sql, values, repeat)))
+            results[label] = rows
+    print("%-22s %12s %12s" % ("", "plain", "compressed"))
+    for (name, plain), (_, compressed) in zip(results["plain"], results["compressed"]):
+        print("%-22s %12.3f %12.3f" % (name, plain, compressed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare database size and query time with and without JSON compression")
+    parser.add_argument("save_path", nargs="?", default=SAVE_PATH, help="Directory of journal files to import")
+    parser.add_argument("--threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help="Compress JSON values of at least this many characters")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query, the fastest is reported")
+    args = parser.parse_args()
+    benchmark(args.save_path, args.threshold, args.repeat)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+from personaldb import Writer, StructuredImport, GroupImport, connect
+from import_journal import BATCH_SIZE, COMPRESS_THRESHOLD, import_files, load_file
+from synthetic_journal import write_journals
+
+SIZES = [10000, 100000, 1000000]
+
+
+class StatementCounter:
+    # Statements run on a connection, executemany counts once per row
+    def __init__(self, conn):
+        self.count = 0
+        conn.set_trace_callback(self.trace)
+
+    def trace(self, sql):
+        self.count += 1
+
+
+def journal_events(paths):
+    for path in paths:
+        for event, _ in load_file(path, 0, os.path.getsize(path)):
+            yield event
+
+
+# Each benchmark reads the journal files from scratch, so they all include reading and decoding, see "read".
+# They return the number of events imported.
+
+def bench_read(paths, conn, options):
+    return sum(1 for _ in journal_events(paths))
+
+
+def bench_baseline(paths, conn, options):
+    # The per-event path from before batching, that the others are compared against: an INSERT into events and
+    # another into the event type's table for every line, the table created or given new columns as they turn up.
+    # Without the per-type handlers it is, if anything, faster than that path was.
+    sql_types = {str: 'TEXT', int: 'INTEGER', bool: 'BOOLEAN', float: 'REAL', list: 'JSON', dict: 'JSON'}
+
+    def value(v):
+        return json.dumps(v) if isinstance(v, (list, dict)) else v
+
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TIMESTAMP, type TEXT, "
+                 "event JSON)")
+    schemas = {}
+    count = 0
+    for event in journal_events(paths):
+        event = dict(event)
+        event_type = event.pop('event')
+        event['event_id'] = conn.execute("INSERT INTO events (timestamp, type, event) VALUES (?, ?, ?)",
+                                         [event['timestamp'], event_type, json.dumps(event)]).lastrowid
+        del event['timestamp']
+        columns = schemas.get(event_type)
+        if columns is None:
+            conn.execute('CREATE TABLE "%s" (%s)' % (event_type, ",".join(
+                '"%s" %s' % (k, sql_types.get(type(v), '')) for k, v in event.items())))
+            columns = schemas[event_type] = set(event)
+        for k in event.keys() - columns:
+            conn.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (event_type, k, sql_types.get(type(event[k]), '')))
+            columns.add(k)
+        conn.execute('INSERT INTO "%s" (%s) VALUES (%s)' % (
+            event_type, ",".join('"%s"' % k for k in event), ",".join("?" * len(event))
+        ), [value(v) for v in event.values()])
+        count += 1
+    conn.commit()
+    return count
+
+
+def bench_writer(paths, conn, options):
+    # Only the events row of each event, the floor every import pays
+    writer = Writer(conn, False, BATCH_SIZE, options.compress_threshold)
+    writer.set_schema("events", "id INTEGER PRIMARY KEY AUTOINCREMENT", "timestamp TIMESTAMP", "type TEXT",
+                      "event JSON")
+    count = 0
+    for event in journal_events(paths):
+        writer.insert("events", id=writer.next_id("events"), timestamp=event['timestamp'], type=event['event'],
+                      event=event.raw)
+        count += 1
+    writer.commit()
+    return count
+
+
+def bench_structured(paths, conn, options):
+    writer = Writer(conn, False, BATCH_SIZE, options.compress_threshold)
+    importer = StructuredImport(writer, virtual=options.virtual)
+    count = 0
+    for event in journal_events(paths):
+        importer.event(event)
+        count += 1
+    writer.commit()
+    return count
+
+
+def bench_group(paths, conn, options):
+    # One checkpointed transaction per file, as import_journal and --follow import them
+    writer = Writer(conn, False, BATCH_SIZE, options.compress_threshold)
+    importer = StructuredImport(writer, virtual=options.virtual)
+    count = 0
+    for path in paths:
+        stat = os.stat(path)
+        count += GroupImport(path, writer, importer).events(load_file(path, 0, stat.st_size),
+                                                            stat.st_size, stat.st_mtime_ns)
+    return count
+
+
+def bench_import(paths, conn, options):
+    # What import_save_to_db runs on the connection it opens, here on one whose statements are counted
+    with contextlib.redirect_stdout(io.StringIO()):
+        import_files(os.path.dirname(paths[0]), conn, compress_threshold=options.compress_threshold,
+                     virtual=options.virtual)
+    return conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+
+# The baseline runs first so every other row is given relative to it, read included: decoding the lines alone is as
+# fast as any import that decodes them in Python can get.
+BENCHMARKS = [
+    ("baseline", bench_baseline),
+    ("read", bench_read),
+    ("Writer", bench_writer),
+    ("StructuredImport", bench_structured),
+    ("GroupImport", bench_group),
+    ("import_journal", bench_import),
+]
+
+
+def db_size(db_path):
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+
+def run(name, fn, paths, db_path, options):
+    with connect(db_path) as conn:
+        counter = StatementCounter(conn)
+        start = time.perf_counter()
+        count = fn(paths, conn, options)
+        elapsed = time.perf_counter() - start
+    conn.close()
+    size = db_size(db_path) if name != "read" else 0
+    return count, elapsed, counter.count, size
+
+
+def benchmark(sizes, options):
+    # Speed is also given relative to the baseline benchmark of the same size, when it runs
+    print("%-18s %9s %12s %12s %12s %12s" % ("", "events", "events/s", "vs baseline", "stmts/event", "bytes/event"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            journal_path = os.path.join(tmp, "journal_%d" % size)
+            start = time.perf_counter()
+            paths = write_journals(journal_path, size, options.seed)
+            print("generated %d events in %.1fs" % (size, time.perf_counter() - start))
+            baseline = None
+            for name, fn in BENCHMARKS:
+                if options.only and name not in options.only:
+                    continue
+                db_path = os.path.join(tmp, "%s_%d.db" % (name, size))
+                count, elapsed, statements, db_bytes = run(name, fn, paths, db_path, options)
+                if name == "baseline":
+                    baseline = count / elapsed
+                print("%-18s %9d %12.0f %12s %12.2f %12.0f" % (
+                    name, count, count / elapsed, "%.2fx" % (count / elapsed / baseline) if baseline else "-",
+                    statements / count, db_bytes / count
+                ))
+                for path in (db_path, db_path + "-wal", db_path + "-shm", db_path + ".lock"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            for path in paths:
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure journal ingest throughput on synthetic journals")
+    parser.add_argument("--events", type=int, nargs="+", default=SIZES, help="Journal sizes to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic journal")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS],
+                        help="Run only these benchmarks")
+    parser.add_argument("--compress", action="store_true",
+                        help=f"Store JSON values of {COMPRESS_THRESHOLD} characters or more zlib compressed")
+    parser.add_argument("--virtual", action="store_true",
+                        help="Store event types as views over events instead of per-type tables")
+    args = parser.parse_args()
+    args.compress_threshold = COMPRESS_THRESHOLD if args.compress else None
+    benchmark(args.events, args)
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+from personaldb import SCREENSHOT_FUDGE, TICK_CUTOFF, TICK_DURATION, Writer, StructuredImport, connect, full_scans
+from import_journal import BATCH_SIZE
+from synthetic_journal import TradeJournal
+from trade_data import observation_query, rebuild_trade_observations, trade_query
+
+SIZES = [10000, 100000, 1000000]
+VARIANTS = [(complete, transaction_type)
+            for complete in (None, True, False) for transaction_type in (None, 'Buy', 'Sell')]
+PLANS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trade_data_plans.json")
+# Growth in time from one size to the next beyond size ratio ** MAX_EXPONENT fails the run: well short of the
+# quadratic joins this is meant to catch, past the n log n of index lookups and the cache misses of a larger file.
+# Times under MIN_SECONDS at the smaller size are mostly fixed costs and noise, and aren't compared.
+MAX_EXPONENT = 1.5
+MIN_SECONDS = 0.02
+
+
+# Marks the end of the right side of asof_join()
+END = object()
+
+
+# Matches each row of `left` with the row of `right` nearest in time within a window around it, in a single merge
+# of the two, for "latest X before time T" lookups that would otherwise join every pair and keep the MAX().
+# Both are iterables sorted by time, left_time and right_time give the time of a row.
+# A right row is in the window of a left row if left time + after < right time < left time + before, a bound of None
+# leaving that side open. The default window is everything strictly before the left row.
+# With left_key and right_key, rows only match rows with an equal key, e.g. the same MarketID or StarSystem.
+# A key of None matches nothing, like NULL in SQL.
+# Yields (left row, right row) in the order of left, with the latest right row of the window if direction is
+# 'backward', the earliest if 'forward', or None if the window is empty.
+# Right rows are held on to while a later left row may still match them: about a window's worth per key, or only
+# the latest per key for a backward join without a lower bound. A forward join without an upper bound reads ahead
+# as far as the next right row with the left row's key.
+def asof_join(left, right, left_time, right_time, left_key=None, right_key=None, after=None, before=0,
+              direction='backward'):
+    if direction not in ('backward', 'forward'):
+        raise Exception("Unknown as-of join direction: %s" % direction)
+    left_key = left_key or (lambda row: ())
+    right_key = right_key or (lambda row: ())
+    latest_only = direction == 'backward' and after is None
+    # Key -> deque of (time, row) read from right that may still be in the window of a later left row
+    if latest_only:
+        candidates = collections.defaultdict(lambda: collections.deque(maxlen=1))
+    else:
+        candidates = collections.defaultdict(collections.deque)
+    right = iter(right)
+    upcoming = next(right, END)
+    last_left = last_right = None
+
+    def drop_expired(rows, low):
+        while rows and rows[0][0] <= low:
+            rows.popleft()
+
+    for row in left:
+        time = left_time(row)
+        if last_left is not None and time < last_left:
+            raise Exception("Left side of the as-of join is not sorted by time: %s after %s" % (time, last_left))
+        last_left = time
+        key = left_key(row)
+        low = None if after is None else time + after
+        high = None if before is None else time + before
+        rows = candidates[key] if key is not None else collections.deque()
+        while upcoming is not END:
+            upcoming_time = right_time(upcoming)
+            if high is not None:
+                if upcoming_time >= high:
+                    break
+            elif direction == 'forward':
+                if low is not None:
+                    drop_expired(rows, low)
+                if rows:
+                    break
+            if last_right is not None and upcoming_time < last_right:
+                raise Exception("Right side of the as-of join is not sorted by time: %s after %s"
+                                % (upcoming_time, last_right))
+            last_right = upcoming_time
+            upcoming_key = right_key(upcoming)
+            if upcoming_key is not None:
+                candidates[upcoming_key].append((upcoming_time, upcoming))
+            upcoming = next(right, END)
+        if low is not None:
+            drop_expired(rows, low)
+        if not rows:
+            yield row, None
+        else:
+            yield row, rows[-1][1] if direction == 'backward' else rows[0][1]
+
+
+# trade_query() as a merge of time-ordered scans of each table, matched up by asof_join(), rather than one query
+# joining every transaction with every market, docking and screenshot before or after it.
+# Gives the same rows as trade_query() and observation_query(), but takes about twice as long as trade_query() at
+# 10k and 100k events, so trade_data doesn't use it. Kept here to compare against.
+def merge_trades(conn, complete=None, transaction_type=None, instrumentation=None):
+    def rows(sql):
+        cursor = instrumentation.query(conn, sql) if instrumentation else conn.execute(sql)
+        columns = [col[0] for col in cursor.description]
+        return (dict(zip(columns, row)) for row in cursor)
+
+    def column(name):
+        return lambda row: row[name]
+
+    def key(*names):
+        return lambda row: None if any(row[name] is None for name in names) else tuple(row[name] for name in names)
+
+    def located(screenshots):
+        # Screenshots with the system of the most recent docking before them
+        docked = rows("SELECT StarSystem, epoch DockedEpoch FROM Docked ORDER BY epoch")
+        for screenshot, docking in asof_join(screenshots, docked, column('ScreenshotEpoch'), column('DockedEpoch')):
+            if docking:
+                yield dict(screenshot, StarSystem=docking['StarSystem'])
+
+    def statuses():
+        return located(rows(f"""
+            SELECT
+                epoch + {SCREENSHOT_FUDGE} ScreenshotEpoch,
+                faction,
+                influence Influence,
+                replace(text, '\n', '\\n') RawStatus
+            FROM LocalFactionStatusSummary
+            ORDER BY epoch
+        """))
+
+    trades = rows("""
+        SELECT event_id, 'Buy' Type, MarketID, Type Commodity, Count, epoch TransactEpoch FROM MarketBuy
+        UNION ALL
+        SELECT event_id, 'Sell' Type, MarketID, Type Commodity, Count, epoch TransactEpoch FROM MarketSell
+        ORDER BY TransactEpoch, event_id
+    """)
+    if transaction_type is not None:
+        trades = (trade for trade in trades if trade['Type'] == transaction_type)
+
+    # Details of the market performing the transaction, such as demand, come from its latest market event
+    items = rows("""
+        SELECT
+            MarketID,
+            Commodity,
+            epoch MarketEpoch,
+            (SELECT StarSystem FROM Market WHERE Market.event_id = MarketItem.event_id) StarSystem,
+            Name_Localised,
+            BuyPrice,
+            SellPrice,
+            Stock,
+            Demand,
+            StockBracket,
+            DemandBracket
+        FROM MarketItem
+        WHERE (MarketID, Commodity) IN (
+            SELECT MarketID, Type FROM MarketBuy
+            UNION
+            SELECT MarketID, Type FROM MarketSell
+        )
+        ORDER BY epoch
+    """)
+    trades = (
+        dict(trade, **market)
+        for trade, market in asof_join(trades, items, column('TransactEpoch'), column('MarketEpoch'),
+                                       key('MarketID', 'Commodity'), key('MarketID', 'Commodity'))
+        if market
+    )
+
+    # Details about the faction come from the most recent docking at the station
+    dockings = rows("""
+        SELECT
+            MarketID,
+            json_extract(inflate(StationFaction), '$.Name') Faction,
+            upper(json_extract(inflate(StationFaction), '$.Name')) StatusFaction,
+            epoch DockedEpoch
+        FROM Docked
+        ORDER BY epoch
+    """)
+    trades = (
+        dict(trade, **docking)
+        for trade, docking in asof_join(trades, dockings, column('TransactEpoch'), column('DockedEpoch'),
+                                        key('MarketID'), key('MarketID'))
+        if docking
+    )
+
+    # Details about the system population come from the latest jump into the system
+    jumps = {jump['StarSystem']: jump for jump in rows("SELECT StarSystem, Population FROM FSDJump ORDER BY event_id")}
+    trades = (dict(trade, Population=jumps[trade['StarSystem']]['Population'])
+              for trade in trades if trade['StarSystem'] in jumps)
+
+    traffic = located(rows(f"""
+        SELECT
+            epoch + {SCREENSHOT_FUDGE} ScreenshotEpoch,
+            total TotalTraffic,
+            ships Ships,
+            replace(text, '\n', '\\n') RawTraffic
+        FROM DetailedTrafficReport
+        ORDER BY epoch
+    """))
+    trades = (
+        dict(trade, Traffic=report or {})
+        for trade, report in asof_join(trades, traffic, column('TransactEpoch'), column('ScreenshotEpoch'),
+                                       key('StarSystem'), key('StarSystem'), after=TICK_CUTOFF, before=TICK_DURATION,
+                                       direction='forward')
+    )
+    # Influence is compared between the latest screenshot in the tick before the transaction and the earliest in the
+    # tick after. Without one before there is nothing to compare.
+    trades = (
+        dict(trade, Before=status)
+        for trade, status in asof_join(trades, statuses(), column('TransactEpoch'), column('ScreenshotEpoch'),
+                                       key('StarSystem', 'StatusFaction'), key('StarSystem', 'faction'),
+                                       after=-TICK_DURATION, before=TICK_CUTOFF)
+        if status
+    )
+    trades = (
+        dict(trade, After=status or {})
+        for trade, status in asof_join(trades, statuses(), column('TransactEpoch'), column('ScreenshotEpoch'),
+                                       key('StarSystem', 'StatusFaction'), key('StarSystem', 'faction'),
+                                       after=TICK_CUTOFF, before=TICK_DURATION, direction='forward')
+    )
+
+    now = time.time()
+    for trade in trades:
+        traffic, before, after = trade['Traffic'], trade['Before'], trade['After']
+        if complete is True and (before['Influence'] is None or after.get('Influence') is None):
+            continue
+        if complete is False and not (
+            (before['Influence'] is None and now < trade['TransactEpoch'] + TICK_CUTOFF)
+            or (before['Influence'] is not None and after.get('Influence') is None
+                and now < trade['TransactEpoch'] + TICK_DURATION)
+        ):
+            continue
+        buy = trade['Type'] == 'Buy'
+        count = trade['Count']
+        price = trade['BuyPrice'] if buy else trade['SellPrice']
+        inventory = trade['Stock'] if buy else trade['Demand']
+        yield (
+            time.strftime('%Y-%m-%d', time.gmtime(trade['TransactEpoch'])),
+            trade['StarSystem'],
+            trade['Population'],
+            trade['Faction'],
+            before['Influence'],
+            trade['Type'],
+            trade['Name_Localised'],
+            count,
+            inventory,
+            None if inventory is None or count is None else inventory - count,
+            trade['StockBracket'] if buy else trade['DemandBracket'],
+            price,
+            None if count is None or price is None else count * price,
+            traffic.get('TotalTraffic'),
+            after.get('Influence'),
+            traffic.get('Ships'),
+            traffic.get('RawTraffic'),
+            before['RawStatus'],
+            after.get('RawStatus'),
+        )
+
+
+# The ways of getting the report: trade_data's SQL query, the as-of merge above, and reading the TradeObservation table
+def run_query(conn, complete, transaction_type):
+    return conn.execute(trade_query(complete, transaction_type)).fetchall()
+
+
+def run_merge(conn, complete, transaction_type):
+    return list(merge_trades(conn, complete, transaction_type))
+
+
+def run_observations(conn, complete, transaction_type):
+    return conn.execute(observation_query(complete, transaction_type)).fetchall()
+
+
+ENGINES = [
+    ("query", run_query),
+    ("merge", run_merge),
+    ("observations", run_observations),
+]
+
+
+def variant_name(complete, transaction_type):
+    return "complete=%s type=%s" % (complete, transaction_type)
+
+
+def build_db(db_path, size, seed):
+    # Journal events straight into a database, with the station visits of TradeJournal so most trades find the
+    # markets, dockings, jumps and screenshots trade_data matches them with
+    start = time.perf_counter()
+    with connect(db_path) as conn:
+        writer = Writer(conn, False, BATCH_SIZE)
+        importer = StructuredImport(writer)
+        with writer.transaction():
+            for event in TradeJournal(seed).events(size):
+                importer.event(event)
+    conn.close()
+    return time.perf_counter() - start
+
+
+def plan(conn, sql):
+    # EXPLAIN QUERY PLAN as indented lines, without the step and subquery numbers that change with any edit to
+    # the query
+    depths = {}
+    lines = []
+    for step_id, parent, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql):
+        depths[step_id] = depths.get(parent, -1) + 1
+        lines.append("  " * depths[step_id] + re.sub(r'SUBQUERY \d+', 'SUBQUERY', detail))
+    return lines
+
+
+def traced(conn, fn, *args):
+    # Runs fn, returning its result and the statements it ran on the connection
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        return fn(conn, *args), statements
+    finally:
+        conn.set_trace_callback(None)
+
+
+def time_variants(db_path, repeat, engines, failures):
+    # {engine: {variant: seconds}} and {engine: {variant: plan lines}} of the database
+    times = {}
+    plans = {}
+    with connect(db_path, readonly=True) as conn:
+        for engine, fn in ENGINES:
+            if engine not in engines:
+                continue
+            for complete, transaction_type in VARIANTS:
+                name = variant_name(complete, transaction_type)
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    _, statements = traced(conn, fn, complete, transaction_type)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times.setdefault(engine, {})[name] = best
+                plans.setdefault(engine, {})[name] = [line for sql in statements for line in plan(conn, sql)]
+                for sql in statements:
+                    for scan in full_scans(conn, sql):
+                        failures.append("%s %s: full table scan: %s" % (engine, name, scan))
+    conn.close()
+    return times, plans
+
+
+def check_plans(plans, expected, size, failures):
+    for engine, variants in plans.items():
+        for name, lines in variants.items():
+            if engine not in expected or name not in expected[engine]:
+                failures.append("%s %s: no plan recorded in %s, run with --update-plans" % (engine, name, PLANS_PATH))
+            elif lines != expected[engine][name]:
+                failures.append("%s %s: plan changed at %d events:\n    %s" % (
+                    engine, name, size, "\n    ".join(lines)))
+
+
+def check_growth(results, max_exponent, failures):
+    # results: [(size, {engine: {variant: seconds}})] in increasing size
+    for (small, small_times), (large, large_times) in zip(results, results[1:]):
+        for engine, variants in large_times.items():
+            for name, seconds in variants.items():
+                previous = small_times.get(engine, {}).get(name)
+                if previous is None or previous < MIN_SECONDS:
+                    continue
+                exponent = math.log(seconds / previous) / math.log(large / small)
+                if exponent > max_exponent:
+                    failures.append("%s %s: %.3fs at %d events to %.3fs at %d, grows as size ** %.2f" % (
+                        engine, name, previous, small, seconds, large, exponent))
+
+
+def load_plans(failures):
+    # The recorded {engine: {variant: plan lines}}, or None if there are none for this version of SQLite: the
+    # wording and the choices of EXPLAIN QUERY PLAN change between versions, so those of another can't be compared
+    if not os.path.exists(PLANS_PATH):
+        failures.append("no plans recorded in %s, run with --update-plans" % PLANS_PATH)
+        return None
+    with open(PLANS_PATH) as file:
+        recorded = json.load(file)
+    if recorded.get("sqlite_version") != sqlite3.sqlite_version:
+        print("not comparing query plans: recorded with SQLite %s, running %s, run with --update-plans to record "
+              "them for this version" % (recorded.get("sqlite_version"), sqlite3.sqlite_version), file=sys.stderr)
+        return None
+    return recorded["plans"]
+
+
+def benchmark(options):
+    # The failures of the run, which are also printed
+    failures = []
+    expected = None if options.update_plans else load_plans(failures)
+    recorded = {}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = options.db_dir or tmp
+        for size in sorted(options.events):
+            db_path = os.path.join(directory, "trade_%d_%d.db" % (size, options.seed))
+            if not os.path.exists(db_path):
+                print("built %d events in %.1fs" % (size, build_db(db_path, size, options.seed)))
+            if "observations" in options.engines:
+                start = time.perf_counter()
+                rebuild_trade_observations(db_path)
+                print("rebuilt TradeObservation in %.2fs" % (time.perf_counter() - start))
+            times, plans = time_variants(db_path, options.repeat, options.engines, failures)
+            results.append((size, times))
+            if expected is not None:
+                check_plans(plans, expected, size, failures)
+            recorded = plans
+            print("%-14s %-28s %10s" % ("", "", "%d events" % size))
+            for engine, variants in times.items():
+                for name, seconds in variants.items():
+                    print("%-14s %-28s %10.3f" % (engine, name, seconds))
+    check_growth(results, options.max_exponent, failures)
+    if options.update_plans:
+        with open(PLANS_PATH, 'w') as file:
+            json.dump({"sqlite_version": sqlite3.sqlite_version, "plans": recorded}, file, indent=2)
+            file.write("\n")
+        print("recorded plans in %s" % PLANS_PATH)
+    for failure in failures:
+        print("FAIL " + failure, file=sys.stderr)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time every trade_data variant on synthetic databases of growing size, failing on query plan "
+                    "changes and worse than linear growth")
+    parser.add_argument("--events", type=int, nargs="+", default=SIZES, help="Database sizes to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic journal")
+    parser.add_argument("--engines", nargs="+", default=[name for name, _ in ENGINES],
+                        choices=[name for name, _ in ENGINES], help="Only time these ways of getting the report")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, the fastest is reported")
+    parser.add_argument("--max-exponent", type=float, default=MAX_EXPONENT,
+                        help="Fail when time grows faster than size to this power between two sizes")
+    parser.add_argument("--db-dir", metavar="PATH",
+                        help="Keep the generated databases in PATH and reuse them on later runs")
+    parser.add_argument("--update-plans", action="store_true",
+                        help=f"Record the query plans of this run in {PLANS_PATH} instead of comparing against it")
+    args = parser.parse_args()
+    sys.exit(1 if benchmark(args) else 0)
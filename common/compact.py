@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import pathlib
+import sqlite3
+import time
+
+from personaldb import RETENTION, Writer, apply_retention, connect, register_functions, set_retention, shard_path
+from personal_best import Reader
+from trade_data import trade_query
+
+DB_PATH = "/home/greg/ed/save.db"
+
+# What the policy should speed up, timed before and after compacting
+QUERIES = [
+    ("events scan", "SELECT type, COUNT(*), SUM(length(event)) FROM events GROUP BY type"),
+    ("trade data", trade_query()),
+    ("materials", Reader.MATERIAL_QUERY),
+]
+# Runs of each query, the fastest counts
+QUERY_RUNS = 3
+
+
+def read_only(path):
+    # A plain connection to one database file, connect() would attach the shards of a sharded save database
+    conn = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+    register_functions(conn)
+    return conn
+
+
+def database_paths(db_path):
+    # The save database and its monthly shards
+    conn = read_only(db_path)
+    try:
+        paths = [db_path]
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shards'").fetchone():
+            directory = os.path.dirname(db_path)
+            paths += [os.path.join(directory, path) for path, in conn.execute("SELECT path FROM shards ORDER BY name")]
+    finally:
+        conn.close()
+    return paths
+
+
+def size(paths):
+    return sum(os.path.getsize(p) for path in paths for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def time_queries(paths):
+    # {query name: seconds}, summed over the databases, which are queried one at a time.
+    # None for queries none of them has the tables for.
+    times = dict.fromkeys(name for name, _ in QUERIES)
+    for path in paths:
+        conn = read_only(path)
+        try:
+            for name, sql in QUERIES:
+                best = None
+                for _ in range(QUERY_RUNS):
+                    start = time.perf_counter()
+                    try:
+                        conn.execute(sql).fetchall()
+                    except sqlite3.OperationalError:
+                        break
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                if best is not None:
+                    times[name] = (times[name] or 0) + best
+        finally:
+            conn.close()
+    return times
+
+
+def vacuum(path):
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def compact(db_path, archive_path=None, dry_run=False, policy=RETENTION):
+    # Stores policy in the save database, so imports apply it from now on, and applies it to what is already there
+    archive_path = archive_path or shard_path(db_path, "archive")
+    paths = database_paths(db_path)
+    size_before = size(paths)
+    times_before = time_queries(paths)
+    removed = {}
+    for path in paths:
+        with connect(path) as conn:
+            writer = Writer(conn, False)
+            if path == db_path and not dry_run:
+                with writer.transaction():
+                    set_retention(writer, policy)
+            for event_type, (count, archived) in apply_retention(writer, archive_path, policy,
+                                                                 dry_run=dry_run).items():
+                totals = removed.setdefault(event_type, [0, 0])
+                totals[0] += count
+                totals[1] += archived
+        conn.close()
+    for event_type, (count, archived) in sorted(removed.items()):
+        print("%-24s %10d %s" % (event_type, count, "archived" if archived else "removed"))
+    if dry_run:
+        return
+    if any(archived for _, archived in removed.values()):
+        print("archived to %s" % archive_path)
+    for path in paths:
+        vacuum(path)
+    size_after = size(paths)
+    times_after = time_queries(paths)
+    print("%-24s %8.1f MB -> %8.1f MB" % ("size", size_before / 1024 / 1024, size_after / 1024 / 1024))
+    for name, _ in QUERIES:
+        if times_before[name] is not None and times_after[name] is not None:
+            print("%-24s %9.3fs -> %9.3fs" % (name, times_before[name], times_after[name]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply the event retention policy (RETENTION in personaldb) to the save database: drop and "
+                    "sample noise events, move old ones to the archive database, then VACUUM"
+    )
+    parser.add_argument("--archive", metavar="PATH",
+                        help="Archive database, save.archive.db next to the save database by default")
+    parser.add_argument("--dry-run",
+                        help="Only count the events the policy would remove",
+                        action="store_true")
+    args = parser.parse_args()
+    compact(DB_PATH, args.archive, args.dry_run)
@@ -1,35 +1,277 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import contextlib
 import json
+import mmap
 import os
-import sqlite3
+import re
+import sys
+import time
 
-from personaldb import Writer, StructuredImport, GroupImport
+from personaldb import Writer, GroupImport, BulkLoad, connect, decode_event, enable_shards, instrument, \
+    set_retention, structured_import, upgrade
+from watch import PollWatcher, watch
 
 DB_PATH = "/home/greg/ed/save.db"
 SAVE_PATH = "/home/greg/ed/journals/"
+BATCH_SIZE = 10000
+COMPRESS_THRESHOLD = 1024
+# Files the game rewrites whole, imported as one event each time they change in --follow mode
+SNAPSHOT_FILES = ("Status.json", "Market.json")
+# Longest --follow waits between checks of its stop event, no shorter than the polling fallback backs off to
+FOLLOW_TIMEOUT = PollWatcher.MAX_INTERVAL
 
+# Journal.2022-01-01T120000.01.log, or Journal.220101120000.01.log for journals written before Odyssey
+JOURNAL_NAME = re.compile(r'^Journal\.(?:(\d{4}-\d{2}-\d{2}T\d{6})|(\d{12}))\.(\d+)\.log$')
 
-def load_file(file_path):
-    if "Journal." not in file_path.name:
-        return []
-    with open(file_path, 'r') as file:
-        return [json.loads(line) for line in file.readlines()]
 
+def journal_order(name):
+    # Sort key putting journal files in game time order, whichever naming scheme they use
+    match = JOURNAL_NAME.match(name)
+    if not match:
+        return "", 0, name
+    iso, short, part = match.groups()
+    stamp = iso.replace('-', '').replace('T', '') if iso else '20' + short
+    return stamp, int(part), name
 
-def import_save_to_db(save_path, db_path):
-    with sqlite3.connect(db_path) as conn:
-        writer = Writer(conn, False)
-        importer = StructuredImport(writer)
-        with os.scandir(save_path) as files:
-            for file_path in files:
-                contents = load_file(file_path)
-                import_obj = GroupImport(file_path.path, writer, importer, len(contents))
-                count = import_obj.events(lambda: contents)
-                if count > 0:
-                    print(f"Imported {count} events from {file_path.path}")
 
+class Stages:
+    # Time, events and bytes per import stage, for the throughput report
+    def __init__(self):
+        self.totals = collections.OrderedDict()
 
-if __name__ == "__main__":
-    import_save_to_db(SAVE_PATH, DB_PATH)
+    def add(self, stage, seconds, events=0, size=0):
+        totals = self.totals.setdefault(stage, [0.0, 0, 0])
+        totals[0] += seconds
+        totals[1] += events
+        totals[2] += size
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed(self, stage, iterable):
+        # Passes iterable through, adding the time spent producing each item to stage
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, 1)
+            yield item
+
+    def report(self, file=None):
+        file = file or sys.stdout
+        for stage, (seconds, events, size) in self.totals.items():
+            print("%-6s %8.3fs %10.0f events/s %8.1f MB/s" % (
+                stage,
+                seconds,
+                events / seconds if seconds else 0,
+                size / 1024 / 1024 / seconds if seconds else 0
+            ), file=file)
+
+
+def load_file(file_path, offset, size):
+    # Lazily yields (event, end offset) for each complete line between offset and size, straight out of a memory map.
+    # A line still being written is left for later.
+    if size <= offset:
+        return
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            start = offset
+            while True:
+                end = data.find(b'\n', start, size)
+                if end < 0:
+                    break
+                end += 1
+                line = str(view[start:end], 'utf-8')
+                if line.strip():
+                    yield decode_event(line), end
+                start = end
+        finally:
+            view.release()
+
+
+def checkpoint(path, stat, writer, importer):
+    # The file's GroupImport if it has lines left to import
+    import_obj = GroupImport(path, writer, importer)
+    if import_obj.unchanged(stat.st_size, stat.st_mtime_ns):
+        return None
+    if stat.st_size < import_obj.offset:
+        print(f"skipping {path}, it shrank below the {import_obj.offset} bytes already imported", file=sys.stderr)
+        return None
+    return import_obj
+
+
+def pending_files(save_path, writer, importer):
+    # (path, stat, GroupImport) of journal files with lines left to import, in game time order
+    files = []
+    with os.scandir(save_path) as entries:
+        for file_path in entries:
+            if "Journal." not in file_path.name:
+                continue
+            stat = file_path.stat()
+            import_obj = checkpoint(file_path.path, stat, writer, importer)
+            if import_obj:
+                files.append((journal_order(file_path.name), file_path.path, stat, import_obj))
+    files.sort(key=lambda f: f[0])
+    return [f[1:] for f in files]
+
+
+def import_files(save_path, conn, snapshot_deltas=False, compress_threshold=None, virtual=False, materialize=(),
+                 shard=False, retention=False):
+    stages = Stages()
+    writer = Writer(conn, False, BATCH_SIZE, compress_threshold)
+    with writer.transaction():
+        upgrade(writer)
+        if shard:
+            enable_shards(writer)
+        if retention:
+            set_retention(writer)
+    importer = structured_import(writer, snapshot_deltas, virtual, materialize)
+    with stages.timer("scan"):
+        files = pending_files(save_path, writer, importer)
+    stages.add("write", 0)
+    began = time.perf_counter()
+    stages.add("parse", 0, 0, sum(stat.st_size - import_obj.offset for _, stat, import_obj in files))
+    for path, stat, import_obj in files:
+        events = stages.timed("parse", load_file(path, import_obj.offset, stat.st_size))
+        import_file(path, stat, import_obj, events, stages)
+    stages.totals.move_to_end("write")
+    stages.totals["write"][0] = time.perf_counter() - began - stages.totals["parse"][0]
+    stages.report()
 
+
+def import_file(path, stat, import_obj, events, stages):
+    size = stat.st_size - import_obj.offset
+    count = import_obj.events(events, stat.st_size, stat.st_mtime_ns)
+    stages.add("write", 0, count, size)
+    if count > 0:
+        print(f"Imported {count} events from {path}")
+
+
+def follow_journal(path, writer, importer):
+    stat = os.stat(path)
+    import_obj = checkpoint(path, stat, writer, importer)
+    if not import_obj:
+        return 0
+    return import_obj.events(load_file(path, import_obj.offset, stat.st_size), stat.st_size, stat.st_mtime_ns)
+
+
+def follow_snapshot(path, writer, importer):
+    stat = os.stat(path)
+    import_obj = GroupImport(path, writer, importer)
+    if import_obj.unchanged(stat.st_size, stat.st_mtime_ns):
+        return 0
+    with open(path, 'rb') as file:
+        data = file.read()
+    try:
+        event = decode_event(data)
+    except json.JSONDecodeError:
+        # Caught while the game was rewriting it, the write's own change notification brings it back
+        return 0
+    return import_obj.events([(event, len(data))], stat.st_size, stat.st_mtime_ns)
+
+
+def follow(save_path, db_path, snapshot_deltas=False, compress_threshold=None, virtual=False, materialize=(),
+           stop=None):
+    # Imports journal lines and snapshot files as they are written until stop (a threading.Event) is set.
+    # Checkpoints are committed with every import, so a restart carries on where this left off.
+    with connect(db_path) as conn:
+        writer = Writer(conn, False, BATCH_SIZE, compress_threshold)
+        with writer.transaction():
+            upgrade(writer)
+        importer = structured_import(writer, snapshot_deltas, virtual, materialize)
+        watcher = watch(save_path)
+        try:
+            # Everything already there counts as changed, the watcher covers what is written from here on
+            changed = set(os.listdir(save_path))
+            while not (stop and stop.is_set()):
+                for name in sorted(changed, key=journal_order):
+                    path = os.path.join(save_path, name)
+                    try:
+                        if "Journal." in name:
+                            count = follow_journal(path, writer, importer)
+                        elif name in SNAPSHOT_FILES:
+                            count = follow_snapshot(path, writer, importer)
+                        else:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    if count > 0:
+                        print(f"Imported {count} events from {path}")
+                changed = watcher.wait(FOLLOW_TIMEOUT)
+        finally:
+            watcher.close()
+    conn.close()
+
+
+def import_save_to_db(save_path, db_path, bulk=False, snapshot_deltas=False, compress_threshold=None, virtual=False,
+                      materialize=(), shard=False, retention=False):
+    with connect(db_path) as conn:
+        if bulk:
+            with BulkLoad(conn) as load:
+                with load.phase("import"):
+                    import_files(save_path, conn, snapshot_deltas, compress_threshold, virtual, materialize, shard,
+                                 retention)
+            load.report()
+        else:
+            import_files(save_path, conn, snapshot_deltas, compress_threshold, virtual, materialize, shard, retention)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill journal files into the save database")
+    parser.add_argument("--bulk",
+                        help="Relax durability and enlarge caches for a large backfill, then ANALYZE",
+                        action="store_true")
+    parser.add_argument("--snapshot-deltas",
+                        help="Store changed Market/Outfitting/Shipyard snapshots as deltas against the last full one",
+                        action="store_true")
+    parser.add_argument("--compress",
+                        help=f"Store JSON values of {COMPRESS_THRESHOLD} characters or more zlib compressed",
+                        action="store_true")
+    parser.add_argument("--follow",
+                        help=f"After the backfill, keep importing journal lines and {', '.join(SNAPSHOT_FILES)} "
+                             "as the game writes them",
+                        action="store_true")
+    parser.add_argument("--virtual",
+                        help="Store new event types only in the events table, read through views and expression "
+                             "indexes instead of per-type tables. Saves about a fifth of the database size, nested "
+                             "JSON values read through the views come back minified",
+                        action="store_true")
+    parser.add_argument("--materialize", nargs="+", default=(), metavar="EVENT_TYPE",
+                        help="Event types given their own tables even with --virtual")
+    parser.add_argument("--shard",
+                        help="Write new events to a database per month next to the save database, "
+                             "read back through views over the months asked for",
+                        action="store_true")
+    parser.add_argument("--retention",
+                        help="Drop and sample noise events as they are imported, following the retention policy "
+                             "(RETENTION in personaldb), compact.py applies it to what was imported before",
+                        action="store_true")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write statement, event type and commit timings to PATH on exit, "
+                             "as JSON if it ends in .json, '-' for stderr")
+    args = parser.parse_args()
+    if args.profile:
+        instrument(args.profile)
+    if args.follow and args.bulk:
+        parser.error("--follow keeps writing after the backfill, it can't run with --bulk")
+    compress_threshold = COMPRESS_THRESHOLD if args.compress else None
+    import_save_to_db(SAVE_PATH, DB_PATH, args.bulk, args.snapshot_deltas, compress_threshold, args.virtual,
+                      args.materialize, args.shard, args.retention)
+    if args.follow:
+        try:
+            follow(SAVE_PATH, DB_PATH, args.snapshot_deltas, compress_threshold, args.virtual, args.materialize)
+        except KeyboardInterrupt:
+            pass
@@ -2,7 +2,6 @@ import concurrent.futures
 import json
 import os
 import re
-import sqlite3
 import subprocess
 import sys
 import time
@@ -226,7 +225,14 @@ def import_news_results(results, importer, strict):
 
 
 if __name__ == '__main__':
-    from personaldb import StructuredImport, Writer
+    import argparse
+    from personaldb import Writer, BulkLoad, connect, structured_import
+
+    parser = argparse.ArgumentParser(description="OCR saved news screenshots into the save database")
+    parser.add_argument("--bulk",
+                        help="Relax durability and enlarge caches for a large import, then ANALYZE",
+                        action="store_true")
+    args = parser.parse_args()
 
     ocr = MultithreadOcr("/tmp/news")
     with os.scandir(NEWS_PATH) as files:
@@ -236,8 +242,19 @@ if __name__ == '__main__':
             index = int(str_index)
             ocr.submit(file_path, (timestamp, index))
 
-    with sqlite3.connect(DB_PATH) as conn:
-        writer = Writer(conn, False)
-        importer = StructuredImport(writer)
-        import_news_results(ocr.get_all(), importer, False)
+    with connect(DB_PATH) as conn:
+        if args.bulk:
+            with BulkLoad(conn) as load:
+                with load.phase("ocr"):
+                    results = ocr.get_all()
+                with load.phase("import"):
+                    writer = Writer(conn, False)
+                    with writer.transaction():
+                        import_news_results(results, structured_import(writer), False)
+            load.report()
+        else:
+            results = ocr.get_all()
+            writer = Writer(conn, False)
+            with writer.transaction():
+                import_news_results(results, structured_import(writer), False)
     ocr.shutdown()
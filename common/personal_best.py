@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
-import sqlite3
+import argparse
+
+from personaldb import DEFAULT_SHARDS, check_query_plan, connect, default_instrumentation, instrument
+from query_cache import QueryCache, default_cache_path
 
 DB_PATH = "/home/greg/ed/save.db"
 
@@ -15,8 +18,10 @@ def dump_res(res):
 
 
 class Reader:
-    def __init__(self, conn):
+    def __init__(self, conn, instrumentation=None, cache=None):
         self.conn = conn
+        self.instrumentation = instrumentation or default_instrumentation()
+        self.cache = cache
 
     def rank_by_col(self, table, sort_column, sort_type, display_columns):
         res = self.execute(
@@ -40,24 +45,25 @@ class Reader:
             json_extract(signals.value, '$.Type_Localised') signal_type,
             json_extract(signals.value, '$.Count') signal_count
         FROM 
-            Scan, json_each(Scan.Materials) materials 
+            Scan, json_each(inflate(Scan.Materials)) materials 
         JOIN 
-            SAASignalsFound, json_each(SAASignalsFound.Signals) signals 
+            SAASignalsFound, json_each(inflate(SAASignalsFound.Signals)) signals 
             ON Scan.BodyName = SAASignalsFound.BodyName
         WHERE (signal_type = 'Geological' OR signal_type = 'Biological')
         GROUP BY body, material
     """
 
-    def all_best_materials(self):
-        res = self.execute("SELECT * FROM ( %s ) GROUP BY material" % self.MATERIAL_QUERY)
-        for material in [r[2] for r in res]:
-            sql = """
+    BEST_MATERIAL_QUERY = """
             SELECT * FROM ( %s )
             WHERE material = ?
             ORDER BY percent DESC
             LIMIT 20
-            """
-            res = self.execute(sql % self.MATERIAL_QUERY, [material])
+            """ % MATERIAL_QUERY
+
+    def all_best_materials(self):
+        res = self.execute("SELECT * FROM ( %s ) GROUP BY material" % self.MATERIAL_QUERY)
+        for material in [r[2] for r in res]:
+            res = self.execute(self.BEST_MATERIAL_QUERY, [material])
             print("best locations for %s" % material)
             dump_res(res)
 
@@ -70,12 +76,16 @@ class Reader:
             self.rank_by_col(table, sort_column, "DESC", display_columns)
 
     def execute(self, sql, *values):
+        if self.cache:
+            return self.cache.query(self.conn, sql, *values)
+        if self.instrumentation:
+            return self.instrumentation.query(self.conn, sql, *values)
         return self.conn.execute(sql, *values)
 
 
-def summarize_bodies(db_path):
-    with sqlite3.connect(db_path) as conn:
-        reader = Reader(conn)
+def summarize_bodies(db_path, since=None, until=None, cache=None):
+    with connect(db_path, readonly=True, since=since, until=until) as conn:
+        reader = Reader(conn, cache=cache)
         reader.all_body_rankings(
             "Scan", [
                 "DistanceFromArrivalLS", "StellarMass", "Radius",
@@ -91,4 +101,34 @@ def summarize_bodies(db_path):
         reader.all_best_materials()
 
 
-summarize_bodies(DB_PATH)
+def check_body_plans(db_path, since=None, until=None):
+    with connect(db_path, readonly=True, since=since, until=until) as conn:
+        check_query_plan(conn, Reader.MATERIAL_QUERY)
+        check_query_plan(conn, Reader.BEST_MATERIAL_QUERY, [''])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank scanned bodies and material deposits")
+    parser.add_argument("--check-plan",
+                        help="Fail if the material queries fall back to a full table scan",
+                        action="store_true")
+    parser.add_argument("--no-cache",
+                        help="Run the queries even if the database is unchanged since their results were cached",
+                        action="store_true")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write query timings to PATH on exit, as JSON if it ends in .json, '-' for stderr")
+    parser.add_argument("--since", metavar="DATE",
+                        help="On a sharded database, only read the months from DATE (YYYY-MM or an ISO timestamp). "
+                             f"Without --since or --until the newest {DEFAULT_SHARDS} months are read")
+    parser.add_argument("--until", metavar="DATE",
+                        help="On a sharded database, only read the months up to DATE (YYYY-MM or an ISO timestamp)")
+    args = parser.parse_args()
+    if args.profile:
+        instrument(args.profile)
+    if args.check_plan:
+        check_body_plans(DB_PATH, args.since, args.until)
+    else:
+        cache = None
+        if not args.no_cache:
+            cache = QueryCache(default_cache_path(DB_PATH), instrumentation=default_instrumentation())
+        summarize_bodies(DB_PATH, args.since, args.until, cache)
@@ -1,91 +1,1002 @@
+import atexit
 import collections
+import contextlib
+import copy
+import datetime
+import hashlib
 import json
+import os
+import pathlib
+import queue
 import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RawJSON(str):
+    # JSON text taken verbatim from a journal line, stored without being serialized again
+    pass
+
+
+class RawEvent(dict):
+    # The decoded fields of a journal line, plus the original line in `raw`
+    raw = None
+
+
+def decode_event(line):
+    # The whole line goes through json.loads, which is faster than decoding only its top level in python and
+    # serializing nothing but the nested values again. The line itself is kept for events.event.
+    if isinstance(line, (bytes, bytearray, memoryview)):
+        line = str(line, 'utf-8')
+    event = RawEvent(json.loads(line))
+    event.raw = RawJSON(line.strip())
+    return event
+
+
+def inflate(value):
+    # JSON values stored by Writer(compress_threshold=...) come back as zlib BLOBs, anything else passes through
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+def register_functions(conn):
+    # Queries over possibly compressed JSON columns wrap them as json_extract(inflate(column), ...)
+    conn.create_function("inflate", 1, inflate, deterministic=True)
+
+
+# Seconds a connection waits on another process's lock before failing with "database is locked"
+BUSY_TIMEOUT = 30
+
+
+class Connection(sqlite3.Connection):
+    # Writers opened by connect() carry the database's WriteLock, see Writer.transaction()
+    write_lock = None
+
+
+class WriteLock:
+    # One writer at a time per database: a thread lock within the process, flock on <db>.lock across processes.
+    # Without fcntl (Windows) only the thread lock applies and other processes are left to the busy timeout.
+    def __init__(self, db_path):
+        self.path = str(db_path) + ".lock"
+        self.thread_lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl:
+            try:
+                self.file = open(self.path, 'a')
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+            except BaseException:
+                self._release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._release()
+
+    def _release(self):
+        if self.file:
+            # Unlock explicitly, processes forked while the lock was held share the open file and would keep it
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+_WRITE_LOCKS = {}
+_WRITE_LOCKS_GUARD = threading.Lock()
+
+
+def write_lock(db_path):
+    key = str(pathlib.Path(db_path).resolve())
+    with _WRITE_LOCKS_GUARD:
+        if key not in _WRITE_LOCKS:
+            _WRITE_LOCKS[key] = WriteLock(key)
+        return _WRITE_LOCKS[key]
+
+
+def connect(db_path, readonly=False, since=None, until=None):
+    # Read-only connections never take the write lock, and under WAL never wait for a writer to commit.
+    # They also see the events of a sharded database through union views, limited to since/until if given.
+    if readonly:
+        uri = pathlib.Path(db_path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, factory=Connection)
+    else:
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, factory=Connection)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.write_lock = write_lock(db_path)
+    register_functions(conn)
+    if readonly and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shards'").fetchone():
+        attach_shards(conn, db_path, since, until)
+    return conn
+
+
+# Sharded databases keep each month of events in a database of its own next to the main one,
+# save.2022-01.db etc., listed in the main database's shards table. See ShardedImport and attach_shards().
+SHARD_NAME = re.compile(r'^\d{4}-\d{2}')
+# Months a read-only connection sees when not given a range
+DEFAULT_SHARDS = 9
+
+
+def shard_name(timestamp):
+    match = SHARD_NAME.match(timestamp or '')
+    if not match:
+        raise Exception("Can't pick a shard for timestamp %r" % timestamp)
+    return match.group()
+
+
+def shard_path(db_path, name):
+    path = pathlib.Path(db_path)
+    return str(path.with_name("%s.%s%s" % (path.stem, name, path.suffix)))
+
+
+def shard_id_offset(name):
+    # First event id of a shard. Every month gets its own range so event_ids stay unique across the union views.
+    year, month = name.split('-')
+    return (int(year) * 12 + int(month) - 1) << 32
+
+
+def attach_shards(conn, db_path, since=None, until=None):
+    # Attaches the shards of months from since to until (ISO dates or timestamps, either may be None) and shadows
+    # every table with a TEMP view of the same name over them and the main database, which holds any history
+    # imported before sharding.
+    # SQLite attaches few databases at a time (10 by default). Without since or until only the newest DEFAULT_SHARDS
+    # months are read, leaving room for another attached database, earlier months need since/until.
+    shards = [
+        (name, path) for name, path in conn.execute("SELECT name, path FROM shards ORDER BY name")
+        if (not since or name >= since[:len(name)]) and (not until or name <= until[:len(name)])
+    ]
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    default = min(DEFAULT_SHARDS, limit - 1)
+    if not since and not until and len(shards) > default:
+        print("reading the newest %d of %d monthly shards, %s to %s, give since/until for earlier months" % (
+            default, len(shards), shards[-default][0], shards[-1][0]
+        ), file=sys.stderr)
+        shards = shards[-default:]
+        since = shards[0][0]
+    if len(shards) > limit:
+        raise Exception("%d monthly shards between %s and %s, SQLite can only attach %d, narrow the range" % (
+            len(shards), shards[0][0], shards[-1][0], limit
+        ))
+    schemas = ["main"]
+    if since and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events'").fetchone():
+        latest = conn.execute("SELECT MAX(timestamp) FROM events").fetchone()[0]
+        if latest is None or latest < since:
+            schemas = []
+    directory = pathlib.Path(db_path).resolve().parent
+    for name, path in shards:
+        schema = "shard_" + name.replace('-', '_')
+        conn.execute("ATTACH DATABASE ? AS %s" % schema, [(directory / path).as_uri() + "?mode=ro"])
+        schemas.append(schema)
+    # {table: {schema: [columns]}}, columns added by later schema changes are NULL in the shards without them
+    sources = collections.OrderedDict()
+    for schema in schemas:
+        names = conn.execute(
+            "SELECT name FROM %s.sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%%'" % schema
+        ).fetchall()
+        for (name,) in names:
+            columns = [row[1] for row in conn.execute('PRAGMA %s.table_info("%s")' % (schema, name))]
+            sources.setdefault(name, collections.OrderedDict())[schema] = columns
+    for name, tables in sources.items():
+        if list(tables) == ["main"]:
+            continue
+        columns = collections.OrderedDict()
+        for table_columns in tables.values():
+            for column in table_columns:
+                columns.setdefault(column.lower(), column)
+        selects = []
+        for schema, table_columns in tables.items():
+            present = {column.lower() for column in table_columns}
+            select = ", ".join('"%s"' % column if key in present else 'NULL "%s"' % column
+                               for key, column in columns.items())
+            selects.append('SELECT %s FROM %s."%s"' % (select, schema, name))
+        conn.execute('CREATE TEMP VIEW "%s" AS %s' % (name, " UNION ALL ".join(selects)))
+    return [name for name, _ in shards]
+
+
+# Indexes backing the joins and filters of the shipped analytics queries (trade_data, personal_best).
+# columns: the table columns that must exist before the index can be created, expressions: the indexed terms.
+Index = collections.namedtuple('Index', ['name', 'table', 'columns', 'expressions'])
+INDEXES = [
+    Index('events_epoch', 'events', ('epoch',), 'epoch'),
+    Index('Docked_event_id', 'Docked', ('event_id',), 'event_id'),
+    Index('Docked_MarketID_epoch', 'Docked', ('MarketID', 'epoch'), '"MarketID", epoch'),
+    Index('Docked_epoch', 'Docked', ('epoch',), 'epoch'),
+    Index('Market_event_id', 'Market', ('event_id',), 'event_id'),
+    Index('MarketRecord_event_id', 'MarketRecord', ('event_id',), 'event_id'),
+    Index('MarketItem_event_id', 'MarketItem', ('event_id',), 'event_id'),
+    Index('MarketItem_MarketID_Commodity_epoch', 'MarketItem', ('MarketID', 'Commodity', 'epoch'),
+          '"MarketID", "Commodity", epoch'),
+    Index('FSDJump_StarSystem_event_id', 'FSDJump', ('StarSystem', 'event_id'), '"StarSystem", event_id'),
+    Index('SAASignalsFound_BodyName', 'SAASignalsFound', ('BodyName',), '"BodyName"'),
+    Index('MarketBuy_epoch', 'MarketBuy', ('epoch',), 'epoch'),
+    Index('MarketSell_epoch', 'MarketSell', ('epoch',), 'epoch'),
+    Index('DetailedTrafficReport_epoch', 'DetailedTrafficReport', ('epoch',), 'epoch'),
+    Index('LocalFactionStatusSummary_faction_epoch', 'LocalFactionStatusSummary', ('faction', 'epoch'),
+          '"faction", epoch'),
+    Index('TradeObservation_TransactEpoch', 'TradeObservation', ('TransactEpoch',), '"TransactEpoch"'),
+    Index('TradeObservation_StarSystem', 'TradeObservation', ('StarSystem',), '"StarSystem"'),
+]
+# Indexes no query uses any more, dropped by upgrade() so inserts stop maintaining them
+RETIRED_INDEXES = ['events_datetime']
+
+
+def full_scans(conn, sql, *values):
+    # Plan steps that read a whole table once per row of an enclosing loop.
+    # The outermost loop of each query level may scan, unless the level is a correlated subquery.
+    # json_each and other virtual tables are ignored.
+    steps = {}
+    outer = set()
+    scans = []
+    for step_id, parent, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql, *values):
+        steps[step_id] = (parent, detail)
+        if not detail.startswith(("SCAN ", "SEARCH ")):
+            continue
+        correlated = False
+        ancestor = parent
+        while ancestor in steps:
+            ancestor, ancestor_detail = steps[ancestor]
+            correlated = correlated or ancestor_detail.startswith("CORRELATED")
+        first = parent not in outer
+        outer.add(parent)
+        if first and not correlated:
+            continue
+        if detail.startswith("SCAN ") and "USING" not in detail and "VIRTUAL TABLE" not in detail:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plan(conn, sql, *values):
+    scans = full_scans(conn, sql, *values)
+    if scans:
+        raise Exception("Query falls back to full table scans: " + ", ".join(scans))
+
+
+class Rows(list):
+    # Fetched result rows, keeping the cursor's column description for printing
+    description = None
+
+
+class Instrumentation:
+    # Where the time goes in imports and queries: latency histograms per statement, time per event type, rows per
+    # table, commit durations and schema changes. Writers take one explicitly, or use the process-wide one set up
+    # by instrument() or the PERSONALDB_PROFILE environment variable.
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, float('inf'))
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # template -> [executions, rows, seconds, max seconds, histogram]
+        self.statements = {}
+        # SQL text -> template, most statements come from a handful of cached strings
+        self.templates = {}
+        # event type -> [events, seconds]
+        self.event_types = {}
+        self.rows = collections.Counter()
+        self.commits = []
+        self.schema_changes = []
+
+    def _record(self, stats, seconds):
+        stats[2] += seconds
+        stats[3] = max(stats[3], seconds)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds < bound:
+                stats[4][i] += 1
+                break
+
+    def statement(self, sql, seconds, rows=1):
+        template = self.templates.get(sql)
+        if template is None:
+            template = self.templates[sql] = self.WHITESPACE.sub(' ', sql).strip()
+        with self.lock:
+            stats = self.statements.get(template)
+            if stats is None:
+                stats = self.statements[template] = [0, 0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            stats[0] += 1
+            stats[1] += rows
+            self._record(stats, seconds)
+            if template.startswith(("CREATE ", "ALTER ", "DROP ")):
+                self.schema_changes.append((time.time() - self.started, template, seconds))
+
+    def event(self, event_type, seconds):
+        with self.lock:
+            stats = self.event_types.setdefault(event_type, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def row(self, table):
+        with self.lock:
+            self.rows[table] += 1
+
+    def commit(self, seconds):
+        with self.lock:
+            self.commits.append(seconds)
+
+    def query(self, conn, sql, *values):
+        # Runs a read query to completion so its full time is counted, rather than only the first step
+        start = time.perf_counter()
+        cursor = conn.execute(sql, *values)
+        rows = Rows(cursor.fetchall())
+        rows.description = cursor.description
+        self.statement(sql, time.perf_counter() - start, len(rows))
+        return rows
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "buckets": [str(bound) for bound in self.BUCKETS],
+                "statements": [
+                    {"sql": sql, "count": count, "rows": rows, "seconds": seconds, "max": longest,
+                     "histogram": histogram}
+                    for sql, (count, rows, seconds, longest, histogram) in self.statements.items()
+                ],
+                "event_types": {event_type: {"count": count, "seconds": seconds}
+                                for event_type, (count, seconds) in self.event_types.items()},
+                "rows": dict(self.rows),
+                "commits": {"count": len(self.commits), "seconds": sum(self.commits),
+                            "max": max(self.commits, default=0)},
+                "schema_changes": [{"at": at, "sql": sql, "seconds": seconds}
+                                   for at, sql, seconds in self.schema_changes],
+            }
+
+    def report(self, file=None, limit=20):
+        file = file or sys.stdout
+        data = self.to_json()
+        buckets = ["<%gms" % (bound * 1000) for bound in self.BUCKETS[:-1]] + [">=%gs" % self.BUCKETS[-2]]
+        print("%-70s %8s %9s %9s %8s %s" % (
+            "statement", "count", "rows", "total s", "max ms", " ".join("%7s" % b for b in buckets)
+        ), file=file)
+        for stats in sorted(data["statements"], key=lambda s: -s["seconds"])[:limit]:
+            print("%-70s %8d %9d %9.3f %8.1f %s" % (
+                stats["sql"][:70], stats["count"], stats["rows"], stats["seconds"], stats["max"] * 1000,
+                " ".join("%7d" % n for n in stats["histogram"])
+            ), file=file)
+        print("%-30s %8s %9s %9s" % ("event type", "count", "total s", "mean ms"), file=file)
+        for event_type, stats in sorted(data["event_types"].items(), key=lambda e: -e[1]["seconds"])[:limit]:
+            print("%-30s %8d %9.3f %9.3f" % (
+                event_type, stats["count"], stats["seconds"], stats["seconds"] / stats["count"] * 1000
+            ), file=file)
+        print("%-30s %8s" % ("table", "rows"), file=file)
+        for table, rows in collections.Counter(data["rows"]).most_common(limit):
+            print("%-30s %8d" % (table, rows), file=file)
+        commits = data["commits"]
+        print("commits: %d, %.3fs total, %.1fms max" % (commits["count"], commits["seconds"], commits["max"] * 1000),
+              file=file)
+        print("schema changes: %d" % len(data["schema_changes"]), file=file)
+        for change in data["schema_changes"][:limit]:
+            print("  +%.1fs %6.1fms %s" % (change["at"], change["seconds"] * 1000, change["sql"][:90]), file=file)
+
+    def dump(self, path):
+        # JSON for paths ending in .json, the text report otherwise, or on stderr for "-"
+        if path == "-":
+            self.report(sys.stderr)
+        elif path.endswith(".json"):
+            with open(path, 'w') as file:
+                json.dump(self.to_json(), file, indent=1)
+        else:
+            with open(path, 'w') as file:
+                self.report(file)
+
+
+_INSTRUMENTATION = None
+
+
+def instrument(path):
+    # Turns on the process-wide Instrumentation and writes its report to path when the process exits
+    global _INSTRUMENTATION
+    if _INSTRUMENTATION is None:
+        _INSTRUMENTATION = Instrumentation()
+        atexit.register(_INSTRUMENTATION.dump, path)
+    return _INSTRUMENTATION
+
+
+def default_instrumentation():
+    if _INSTRUMENTATION is None and os.environ.get("PERSONALDB_PROFILE"):
+        instrument(os.environ["PERSONALDB_PROFILE"])
+    return _INSTRUMENTATION
+
+
+# A column of a virtual view: its declared type and every spelling of its key seen in the journal
+VirtualColumn = collections.namedtuple('VirtualColumn', ['type', 'keys'])
 
 
 class Writer:
-    def __init__(self, conn, debug):
+    def __init__(self, conn, debug, batch_size=None, compress_threshold=None, instrumentation=None):
         self.conn = conn
         self.debug = debug
+        self.instrumentation = instrumentation or default_instrumentation()
+        # JSON values at least this many characters long are stored zlib compressed, see inflate()
+        self.compress_threshold = compress_threshold
+        self.lock = getattr(conn, 'write_lock', None)
         self.schema_cache = {}
+        self.statement_cache = {}
+        # (event type, frozenset of (key, python type)) seen with an up-to-date schema
+        self.fingerprints = set()
+        # Hashes of the snapshots known to be in the database, see StructuredImport._store_snapshot()
+        self.snapshots = set()
+        # When batch_size is set, inserts are buffered per (table, columns) and written with executemany
+        self.batch_size = batch_size
+        self.pending = collections.defaultdict(list)
+        self.pending_count = 0
+        self.sequences = {}
+        self.indexes = set()
+        self.views = set()
+        # Views over events standing in for per-type tables: {view: {lowercase column: VirtualColumn}}
+        self.virtual_schema = {}
+        # Writers of other databases committed and rolled back with this one, see enlist()
+        self.participants = []
+        # Called before each commit, once pending inserts are written, to bring derived tables up to date
+        self.commit_hooks = []
+        register_functions(conn)
+        self._load_schema()
 
     TYPE_MAPS = collections.defaultdict(lambda: lambda x: x)
     TYPE_MAPS[list] = TYPE_MAPS[dict] = TYPE_MAPS[tuple] = TYPE_MAPS[collections.OrderedDict] = json.dumps
+    JSON_TYPES = (list, dict, tuple, collections.OrderedDict, RawJSON)
+
+    COLUMN_NAME = re.compile(r'^"([^"]+)"|^(\w+)')
 
     def set_schema(self, table, *schema):
         old_schema = self._get_schema(table)
         if not old_schema:
             self._change_table(table, "CREATE TABLE %s (%s)" % (table, ",".join(schema)))
         else:
-            for col in set(schema) - set(old_schema):
-                self._change_table(table, "ALTER TABLE %s ADD COLUMN %s" % (table, col))
+            old_columns = {self._column_name(col) for col in old_schema}
+            for col in schema:
+                if self._column_name(col) not in old_columns:
+                    self._change_table(table, "ALTER TABLE %s ADD COLUMN %s" % (table, col))
 
     def _change_table(self, table, sql):
         self.execute(sql)
-        if table in self.schema_cache:
-            del self.schema_cache[table]
-
-    def _get_schema(self, table):
-        if table in self.schema_cache:
-            return self.schema_cache[table]
         res = self.execute(
             "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type = 'table'",
             [table]
         ).fetchone()
-        if not res:
-            return None
-        sql = res[0]
-        typedef = [s.strip() for s in re.split(",", sql[sql.index('(')+1:sql.rindex(')')])]
-        self.schema_cache[table] = typedef
-        return typedef
+        self.schema_cache[table] = self._parse_schema(res[0])
+        self._ensure_indexes(table)
+
+    def _load_schema(self):
+        for table, sql in self.execute("SELECT tbl_name, sql FROM sqlite_master WHERE type = 'table'"):
+            self.schema_cache[table] = self._parse_schema(sql)
+        for (name,) in self.execute("SELECT name FROM sqlite_master WHERE type = 'index'"):
+            self.indexes.add(name)
+        for (name,) in self.execute("SELECT name FROM sqlite_master WHERE type = 'view'"):
+            self.views.add(name)
+        if "virtual_columns" in self.schema_cache:
+            for view, key, column_type in self.execute("SELECT name, key, type FROM virtual_columns ORDER BY rowid"):
+                columns = self.virtual_schema.setdefault(view, collections.OrderedDict())
+                columns.setdefault(key.lower(), VirtualColumn(column_type, [])).keys.append(key)
+        self.schema_version = self._schema_version()
+
+    def _schema_version(self):
+        return self.execute("PRAGMA schema_version").fetchone()[0]
+
+    def reload_schema(self):
+        # After tables were renamed or dropped behind the cache's back
+        self.flush()
+        self.schema_cache.clear()
+        self.statement_cache.clear()
+        self.fingerprints.clear()
+        self.snapshots.clear()
+        self.indexes.clear()
+        self.views.clear()
+        self.virtual_schema.clear()
+        self._load_schema()
+
+    def create_view(self, view, sql):
+        if view not in self.views:
+            self.execute("CREATE VIEW IF NOT EXISTS %s AS %s" % (view, sql))
+            self.views.add(view)
+
+    # Columns every virtual view has, taken from events itself rather than the event JSON
+    VIRTUAL_COLUMNS = collections.OrderedDict([('event_id', 'id'), ('epoch', 'epoch')])
+
+    def set_virtual_schema(self, view, *schema):
+        # Creates or widens a view exposing keys of the events rows of type `view`, in place of a per-type table.
+        # Like ALTER TABLE for set_schema, a new key means recreating the view, but no data is rewritten.
+        columns = self.virtual_schema.setdefault(view, collections.OrderedDict())
+        new_columns = []
+        for col in schema:
+            match = self.COLUMN_NAME.match(col)
+            key = match.group(1) or match.group(2)
+            column = columns.get(key.lower())
+            if key.lower() not in self.VIRTUAL_COLUMNS and not (column and key in column.keys):
+                new_columns.append((key, col[match.end():].strip()))
+        if not new_columns and view in self.views:
+            return
+        if "virtual_columns" not in self.schema_cache:
+            self.set_schema("virtual_columns", "name TEXT", "key TEXT", "type TEXT")
+        respelled = set()
+        for key, column_type in new_columns:
+            if key.lower() in columns:
+                respelled.add(key.lower())
+            columns.setdefault(key.lower(), VirtualColumn(column_type, [])).keys.append(key)
+            self.execute("INSERT INTO virtual_columns (name, key, type) VALUES (?, ?, ?)", [view, key, column_type])
+        self.execute("DROP VIEW IF EXISTS %s" % view)
+        self.views.discard(view)
+        names = [(name, name) for name in self.VIRTUAL_COLUMNS]
+        names.extend((name, column.keys[0]) for name, column in columns.items())
+        self.create_view(view, "SELECT %s FROM events WHERE type = '%s'" % (
+            ", ".join('%s "%s"' % (self.virtual_column(view, name), alias) for name, alias in names),
+            view
+        ))
+        # Index expressions over a column that gained a spelling no longer match the view's
+        for index in INDEXES:
+            if index.table == view and respelled & {col.lower() for col in index.columns}:
+                self.execute("DROP INDEX IF EXISTS %s" % index.name)
+                self.indexes.discard(index.name)
+        if "events_type_epoch" not in self.indexes:
+            # Whole-view scans read only the view's own rows, in time order
+            self.execute("CREATE INDEX IF NOT EXISTS events_type_epoch ON events (type, epoch)")
+            self.indexes.add("events_type_epoch")
+        self._ensure_indexes(view)
+
+    def virtual_column(self, view, name):
+        # SQL for a column of a virtual view, matching the expression its indexes were created on
+        name = name.lower()
+        if name in self.VIRTUAL_COLUMNS:
+            return self.VIRTUAL_COLUMNS[name]
+        column = self.virtual_schema[view][name]
+        paths = [
+            "json_extract(event, '$.%s')" % (key if re.fullmatch(r'\w+', key) else '"%s"' % key.replace("'", "''"))
+            for key in column.keys
+        ]
+        # Journals aren't consistent about the case of some keys, e.g. MarketID and MarketId
+        sql = paths[0] if len(paths) == 1 else "COALESCE(%s)" % ", ".join(paths)
+        # json_extract has no affinity, text is cast so it compares (and gets automatic indexes) like a TEXT column
+        return "CAST(%s AS TEXT)" % sql if column.type == 'TEXT' else sql
+
+    def ensure_indexes(self):
+        # Indexes are otherwise only added when a table changes, databases created before an index was
+        # registered need this once
+        for table in list(self.schema_cache) + list(self.virtual_schema):
+            self._ensure_indexes(table)
+
+    def _ensure_indexes(self, table):
+        virtual = table in self.virtual_schema
+        if virtual:
+            columns = set(self.VIRTUAL_COLUMNS) | set(self.virtual_schema[table])
+        else:
+            columns = {self._column_name(col) for col in self.schema_cache.get(table, [])}
+        for index in INDEXES:
+            if index.table != table or index.name in self.indexes:
+                continue
+            if not all(col.lower() in columns for col in index.columns):
+                continue
+            if not virtual:
+                self.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (index.name, table, index.expressions))
+            elif index.columns not in (('event_id',), ('epoch',)):
+                # event_id and epoch alone are covered by the primary key and events_type_epoch. Anything else
+                # becomes a partial index on events, usable through the view since it filters on the same type.
+                self.execute("CREATE INDEX IF NOT EXISTS %s ON events (%s) WHERE type = '%s'" % (
+                    index.name,
+                    ", ".join(self.virtual_column(table, col) for col in index.columns),
+                    table
+                ))
+            self.indexes.add(index.name)
+
+    def _get_schema(self, table):
+        return self.schema_cache.get(table)
+
+    @staticmethod
+    def _parse_schema(sql):
+        return [s.strip() for s in re.split(",", sql[sql.index('(')+1:sql.rindex(')')])]
+
+    @classmethod
+    def _column_name(cls, typedef):
+        match = cls.COLUMN_NAME.match(typedef)
+        return (match.group(1) or match.group(2)).lower() if match else typedef
 
     def insert(self, table, **kwargs):
-        columns = kwargs.keys()
-        return self.execute(
-            "INSERT INTO %s (%s) VALUES (%s)" % (
+        return self.insert_row(table, tuple(kwargs), kwargs.values())
+
+    def insert_row(self, table, columns, values):
+        # insert() with the columns and their values apart, as callers holding a dict of the row already have them
+        type_maps = self.TYPE_MAPS
+        if self.compress_threshold:
+            json_types = self.JSON_TYPES
+            values = [self.compress(type_maps[type(v)](v)) if isinstance(v, json_types) else v for v in values]
+        else:
+            # Looked up with `in` first, which unlike indexing the defaultdict doesn't call a function per plain value
+            values = [type_maps[type(v)](v) if type(v) in type_maps else v for v in values]
+        if self.instrumentation:
+            self.instrumentation.row(table)
+        if self.batch_size:
+            self.pending[(table, columns)].append(values)
+            self.pending_count += 1
+            if self.pending_count >= self.batch_size:
+                self.flush()
+            return None
+        return self.execute(self._insert_sql(table, columns), values)
+
+    def compress(self, text):
+        if not self.compress_threshold or len(text) < self.compress_threshold:
+            return text
+        blob = zlib.compress(text.encode('utf-8'))
+        return blob if len(blob) < len(text) else text
+
+    def next_id(self, table):
+        # Batched inserts have no lastrowid, so AUTOINCREMENT keys are handed out here instead.
+        # Only valid while this writer is the only one inserting into the table.
+        if table not in self.sequences:
+            seq = self.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", [table]).fetchone()
+            top = self.execute("SELECT MAX(rowid) FROM %s" % table).fetchone()
+            self.sequences[table] = max(seq[0] if seq else 0, top[0] or 0)
+        self.sequences[table] += 1
+        return self.sequences[table]
+
+    def flush(self):
+        for (table, columns), rows in self.pending.items():
+            self.executemany(self._insert_sql(table, columns), rows)
+        self.pending.clear()
+        self.pending_count = 0
+
+    def _insert_sql(self, table, columns):
+        key = (table, columns)
+        if key not in self.statement_cache:
+            self.statement_cache[key] = "INSERT INTO %s (%s) VALUES (%s)" % (
                 table,
                 ",".join(["\"" + k + "\"" for k in columns]),
                 ",".join(["?" for _ in columns])
-            ),
-            [self.TYPE_MAPS[type(kwargs[k])](kwargs[k]) for k in columns]
-        )
+            )
+        return self.statement_cache[key]
 
     def execute(self, *args):
         if self.debug:
             print(args[0])
-        return self.conn.execute(*args)
+        if not self.instrumentation:
+            return self.conn.execute(*args)
+        start = time.perf_counter()
+        cursor = self.conn.execute(*args)
+        self.instrumentation.statement(args[0], time.perf_counter() - start)
+        return cursor
+
+    def executemany(self, sql, rows):
+        if self.debug:
+            print(sql)
+        if not self.instrumentation:
+            return self.conn.executemany(sql, rows)
+        start = time.perf_counter()
+        cursor = self.conn.executemany(sql, rows)
+        self.instrumentation.statement(sql, time.perf_counter() - start, len(rows))
+        return cursor
 
     def commit(self, *args):
-        return self.conn.commit(*args)
+        start = time.perf_counter()
+        self.flush()
+        for hook in self.commit_hooks:
+            hook()
+        # Enlisted writers commit first, so whatever this one records about their work (import checkpoints)
+        # never gets ahead of it
+        for writer in self.participants:
+            writer.commit()
+        result = self.conn.commit(*args)
+        if self.instrumentation:
+            self.instrumentation.commit(time.perf_counter() - start)
+        return result
+
+    def rollback(self):
+        for writer in self.participants:
+            writer.rollback()
+        self.pending.clear()
+        self.pending_count = 0
+        self.conn.rollback()
+        # Tables created inside the transaction are gone again
+        self.reload_schema()
+
+    def enlist(self, writer):
+        # Makes writer, of another database, part of this writer's transactions and serialized by its lock
+        writer.lock = None
+        self.participants.append(writer)
+
+    def refresh(self):
+        # Other writers may have changed tables or handed out ids since this one last held the lock
+        self.sequences.clear()
+        if self._schema_version() != self.schema_version:
+            self.reload_schema()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Holds the database's write lock, if the connection came from connect(), until the work is committed
+        with self.lock or contextlib.nullcontext():
+            if self.lock:
+                for writer in [self] + self.participants:
+                    writer.refresh()
+            try:
+                yield self
+                self.commit()
+            except BaseException:
+                self.rollback()
+                raise
+            for writer in [self] + self.participants:
+                writer.schema_version = writer._schema_version()
+
+
+class BulkLoad:
+    # Connection settings for a one-off backfill, traded for durability while the load runs
+    PRAGMAS = collections.OrderedDict([
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('cache_size', '-262144'),
+        ('temp_store', 'MEMORY'),
+    ])
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.previous = {}
+        self.timings = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def __enter__(self):
+        with self.phase("setup"):
+            self.conn.commit()
+            for pragma, value in self.PRAGMAS.items():
+                self.previous[pragma] = self.conn.execute("PRAGMA %s" % pragma).fetchone()[0]
+                self.conn.execute("PRAGMA %s = %s" % (pragma, value))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.phase("restore"):
+            self.conn.commit()
+            for pragma, value in reversed(self.previous.items()):
+                self.conn.execute("PRAGMA %s = %s" % (pragma, value))
+        if exc_type is None:
+            with self.phase("analyze"):
+                self.conn.execute("ANALYZE")
+                self.conn.commit()
+
+    def report(self, file=sys.stdout):
+        for name, duration in self.timings:
+            print("%-10s %8.3fs" % (name, duration), file=file)
+
+
+def backfill_market_items(writer):
+    # MarketItem rows for Market snapshots stored before StructuredImport.Market wrote them
+    if "items" not in {writer._column_name(col) for col in writer.schema_cache.get("Market", [])}:
+        return
+    writer.set_schema("MarketItem", *StructuredImport.MARKET_ITEM_SCHEMA)
+    writer.execute("""
+        INSERT INTO MarketItem (
+            event_id, epoch, MarketID, Commodity, Name, Name_Localised, Category_Localised,
+            BuyPrice, SellPrice, Stock, StockBracket, Demand, DemandBracket
+        )
+        SELECT
+            Market.event_id,
+            CAST(strftime('%s', events.timestamp) AS INTEGER),
+            Market.MarketID,
+            replace(lower(json_extract(item.value, '$.Name_Localised')), ' ', ''),
+            json_extract(item.value, '$.Name'),
+            json_extract(item.value, '$.Name_Localised'),
+            json_extract(item.value, '$.Category_Localised'),
+            json_extract(item.value, '$.BuyPrice'),
+            json_extract(item.value, '$.SellPrice'),
+            json_extract(item.value, '$.Stock'),
+            json_extract(item.value, '$.StockBracket'),
+            json_extract(item.value, '$.Demand'),
+            json_extract(item.value, '$.DemandBracket')
+        FROM Market
+        JOIN events ON events.id = Market.event_id, json_each(inflate(Market.Items)) item
+        WHERE NOT EXISTS (SELECT 1 FROM MarketItem WHERE MarketItem.event_id = Market.event_id)
+    """)
+
+
+def migrate_snapshots(writer):
+    # Moves inline Market/Outfitting/Shipyard item lists into content-addressed snapshots
+    for event_type, field in StructuredImport.SNAPSHOT_FIELDS.items():
+        record = StructuredImport.snapshot_table(event_type)
+        if event_type not in writer.schema_cache or record in writer.schema_cache:
+            continue
+        # Tables only ever written from journal lines have no list column to move
+        inline = field.lower() in {writer._column_name(col) for col in writer.schema_cache[event_type]}
+        writer.set_schema("snapshots", *StructuredImport.SNAPSHOT_SCHEMA)
+        writer.execute("DROP INDEX IF EXISTS %s_event_id" % event_type)
+        writer.execute("ALTER TABLE %s RENAME TO %s" % (event_type, record))
+        writer.execute('ALTER TABLE %s ADD COLUMN "%s_hash" TEXT' % (record, field))
+        rows = writer.execute('SELECT rowid, event_id, "%s" FROM %s' % (field, record)).fetchall() if inline else []
+        for rowid, event_id, payload in rows:
+            if payload is None:
+                continue
+            # Stored and hashed as StructuredImport stores them, so later imports of the same list dedupe
+            text = StructuredImport.canonical_json(json.loads(inflate(payload)))
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            writer.execute(
+                "INSERT OR IGNORE INTO snapshots (hash, type, payload) VALUES (?, ?, ?)",
+                [digest, event_type, writer.compress(text)]
+            )
+            writer.execute('UPDATE %s SET "%s_hash" = ? WHERE rowid = ?' % (record, field), [digest, rowid])
+            writer.execute(
+                "UPDATE events SET event = json_set(inflate(event), '$.%s', ?) WHERE id = ?" % field,
+                [digest, event_id]
+            )
+        if inline:
+            writer.execute('ALTER TABLE %s DROP COLUMN "%s"' % (record, field))
+        writer.reload_schema()
+        writer.create_view(event_type, StructuredImport.snapshot_view(event_type))
+
+
+def backfill_epochs(writer):
+    # Fills the epoch columns of tables written before StructuredImport stored them, once per table
+    if "events" not in writer.schema_cache:
+        return
+    if "epoch" not in {writer._column_name(col) for col in writer.schema_cache["events"]}:
+        writer.set_schema("events", "epoch INTEGER")
+        writer.execute("UPDATE events SET epoch = CAST(strftime('%s', timestamp) AS INTEGER)")
+    for table in list(writer.schema_cache):
+        columns = {writer._column_name(col) for col in writer.schema_cache[table]}
+        if table == "events" or "event_id" not in columns or "epoch" in columns:
+            continue
+        writer.set_schema(table, "epoch INTEGER")
+        writer.execute("UPDATE %s SET epoch = (SELECT epoch FROM events WHERE events.id = %s.event_id)" % (table, table))
+
+
+def drop_retired_indexes(writer):
+    for name in RETIRED_INDEXES:
+        if name in writer.indexes:
+            writer.execute("DROP INDEX %s" % name)
+            writer.indexes.discard(name)
+
+
+def upgrade(writer):
+    # Brings a database written by an older version of these scripts up to date, safe to repeat
+    backfill_epochs(writer)
+    backfill_market_items(writer)
+    migrate_snapshots(writer)
+    drop_retired_indexes(writer)
+    writer.ensure_indexes()
 
 
 class GroupImport:
-    def __init__(self, key, writer, importer, length):
+    # Checkpoint of one imported file: its size and mtime when last read, and the byte offset consumed so far.
+    # count is the number of lines consumed, all that rows written before offsets were tracked know about.
+    def __init__(self, key, writer, importer):
         self.key = key
         self.writer = writer
         self.importer = importer
-        self.length = length
-        self.index = 0
-        self.writer.set_schema("imports", "key TEXT PRIMARY KEY", "count INTEGER DEFAULT 0")
-        self.writer.execute("INSERT OR IGNORE INTO imports (path) VALUES (?)", [self.key])
-        self.imported = self.writer.execute("SELECT count FROM imports WHERE key = ?", [self.key]).fetchone()[0]
-
-    def events(self, events):
-        if self.length > self.imported:
-            for event in events():
-                if self.index > self.imported:
+        self.writer.set_schema(
+            "imports",
+            "key TEXT PRIMARY KEY",
+            "count INTEGER DEFAULT 0",
+            "size INTEGER",
+            "mtime INTEGER",
+            '"offset" INTEGER',
+        )
+        row = self.writer.execute('SELECT count, size, mtime, "offset" FROM imports WHERE key = ?', [key]).fetchone()
+        self.count, self.size, self.mtime, self.offset = row or (0, None, None, 0)
+        # A count-only row is resumed by reading the file from the start and skipping that many lines
+        self.skip_lines = self.count if self.offset is None else 0
+        self.offset = self.offset or 0
+
+    def unchanged(self, size, mtime):
+        return (self.size, self.mtime) == (size, mtime)
+
+    def events(self, events, size, mtime):
+        # events: (event, byte offset just past its line) pairs, read from self.offset on
+        imported = 0
+        with self.writer.transaction():
+            for event, end in events:
+                if self.skip_lines:
+                    self.skip_lines -= 1
+                else:
                     self.importer.event(event)
-                self.index += 1
-            self.writer.execute("UPDATE imports SET count = ? WHERE key = ?", [self.index, self.key])
-            self.writer.commit()
-            return self.index - self.imported
-        return 0
+                    self.count += 1
+                    imported += 1
+                self.offset = end
+            self.writer.execute(
+                'INSERT OR REPLACE INTO imports (key, count, size, mtime, "offset") VALUES (?, ?, ?, ?, ?)',
+                [self.key, self.count, size, mtime, self.offset]
+            )
+        self.size, self.mtime = size, mtime
+        return imported
+
+
+# type_overrides: {key: column type}, constraints: extra table constraints,
+# transform: fn(importer, event) returning the row to store, with an optional 'event' key naming the table
+Handler = collections.namedtuple('Handler', ['type_overrides', 'constraints', 'transform'])
+DEFAULT_HANDLER = Handler(None, None, None)
+
+
+def handler(type_overrides=None, constraints=None):
+    def decorator(fn):
+        fn.handler = Handler(type_overrides, constraints, fn)
+        return fn
+    return decorator
+
+
+# What happens to an event type's events, types without a rule are kept:
+# 'drop': never stored, 'sample': only the first of each interval seconds is stored,
+# 'archive': stored, and moved to the archive database by apply_retention() once older than days.
+Retention = collections.namedtuple('Retention', ['action', 'interval', 'days'], defaults=[None, None])
+
+# Events no analytics script reads, which would otherwise make up much of the events table
+RETENTION = {
+    'Music': Retention('drop'),
+    'ShieldState': Retention('drop'),
+    'HeatWarning': Retention('drop'),
+    'HeatDamage': Retention('drop'),
+    'UnderAttack': Retention('drop'),
+    'ReservoirReplenished': Retention('drop'),
+    'FuelScoop': Retention('sample', interval=60),
+    # Status.json, rewritten every few seconds in flight and imported by --follow
+    'Status': Retention('sample', interval=60),
+    'ReceiveText': Retention('archive', days=30),
+    'NpcCrewPaidWage': Retention('archive', days=30),
+}
+
+
+def set_retention(writer, policy=RETENTION):
+    # Stores policy in the database, where every StructuredImport writing to it picks it up
+    writer.set_schema("retention", "type TEXT PRIMARY KEY", "action TEXT", "interval INTEGER", "days INTEGER")
+    writer.execute("DELETE FROM retention")
+    for event_type, rule in policy.items():
+        if rule.action not in ('keep', 'drop', 'sample', 'archive'):
+            raise Exception("Unknown retention action %r for %s" % (rule.action, event_type))
+        if event_type in StructuredImport.SNAPSHOT_FIELDS:
+            raise Exception("%s events share snapshots, they can't be given a retention rule" % event_type)
+        writer.execute("INSERT INTO retention (type, action, interval, days) VALUES (?, ?, ?, ?)",
+                       [event_type, rule.action, rule.interval, rule.days])
+
+
+def load_retention(writer):
+    if "retention" not in writer.schema_cache:
+        return {}
+    return {
+        event_type: Retention(action, interval, days)
+        for event_type, action, interval, days in writer.execute("SELECT type, action, interval, days FROM retention")
+    }
 
 
 class StructuredImport:
 
-    def __init__(self, writer):
+    def __init__(self, writer, snapshot_deltas=False, virtual=False, materialize=(), retention=None):
         self.writer = writer
+        self.unknown_types = set()
+        # {event type: Retention}, the policy stored in the database unless given
+        self.retention = load_retention(writer) if retention is None else retention
+        # Event type -> interval of the last sampled event stored
+        self.sample_intervals = {}
+        # Kept up to date once TradeObservations.rebuild() has created the table, see trade_observations()
+        self.trades = None
+        self.snapshot_deltas = snapshot_deltas
+        # New event types get a view over events instead of a table of their own, except those in materialize.
+        # Types already stored one way keep being stored that way, whatever these say.
+        # The views return nested JSON values minified by json_extract, where tables return them as json.dumps()
+        # wrote them, e.g. the Ships of trade_data. Dropping the tables saves what they took up, about a fifth of
+        # the database: events and the snapshots take up most of it either way.
+        self.virtual = virtual
+        self.materialize = set(materialize)
+        # (event type, MarketID) -> (hash, {item id: item}) of the latest full snapshot, the base for deltas
+        self.snapshot_bases = {}
+        self.writer.set_schema(
+            "events",
+            "id INTEGER PRIMARY KEY AUTOINCREMENT",
+            "timestamp TIMESTAMP",
+            "key TEXT",
+            "index_in_path INTEGER",
+            "type TEXT",
+            "event JSON",
+            "epoch INTEGER",
+        )
 
     DEFAULT_TYPES = {
         str: 'TEXT',
@@ -97,31 +1008,279 @@ class StructuredImport:
         tuple: 'JSON',
         collections.OrderedDict: 'JSON'
     }
+    # Columns of the events rows of batched inserts, which hand out their ids
+    EVENT_COLUMNS = ("id", "timestamp", "type", "event", "epoch")
 
     def event(self, event):
+        instrumentation = self.writer.instrumentation
+        if not instrumentation:
+            return self._event(event)
         event_type = event['event']
+        start = time.perf_counter()
+        try:
+            return self._event(event)
+        finally:
+            instrumentation.event(event_type, time.perf_counter() - start)
+
+    def _event(self, event):
+        event_type = event['event']
+        if event_type in self.retention:
+            if not self.retains(event_type, event):
+                return
+            self.record_sample(event_type, event)
+        # events.event holds the journal line, "event" key included: the original text of lines decoded by
+        # decode_event, everything else serialized
+        stored = event.raw if isinstance(event, RawEvent) else dict(event)
         del event['event']
-        self.writer.set_schema(
-            "events",
-            "id INTEGER PRIMARY KEY AUTOINCREMENT",
-            "timestamp TIMESTAMP",
-            "key TEXT",
-            "index_in_path INTEGER",
-            "type TEXT",
-            "event JSON",
-        )
-        event['event_id'] = self.writer.insert(
-            "events",
-            timestamp=event['timestamp'],
-            type=event_type,
-            event=event
-        ).lastrowid
+        snapshot_field = self.SNAPSHOT_FIELDS.get(event_type)
+        if snapshot_field and self.deduplicates(event_type):
+            # The journal's own Market etc. lines carry no list, they still belong in <type>Record
+            if snapshot_field in event:
+                stored = self._store_snapshot(event_type, snapshot_field, event, stored)
+        else:
+            snapshot_field = None
+        event_handler = self.HANDLERS.get(event_type) or self._unknown_type(event_type)
+        virtual = self.stores_virtually(event_type, event_handler)
+        if virtual:
+            # The view reads its columns out of this text, so it is never compressed
+            stored = str(stored) if isinstance(stored, str) else json.dumps(stored)
+        epoch = self.epoch(event['timestamp'])
+        if event_type in TradeObservations.SOURCES and self.trade_observations():
+            self.trades.touch(event_type, epoch, event.get('StarSystem'))
+        if self.writer.batch_size:
+            event_id = self.writer.next_id("events")
+            self.writer.insert_row("events", self.EVENT_COLUMNS,
+                                   (event_id, event['timestamp'], event_type, stored, epoch))
+        else:
+            event_id = self.writer.insert(
+                "events",
+                timestamp=event['timestamp'],
+                type=event_type,
+                event=stored,
+                epoch=epoch
+            ).lastrowid
+        event['event_id'] = event_id
         del event['timestamp']
-        custom_fn = getattr(self, event_type)
-        type_info = custom_fn(None)
-        type_overrides = constraints = None
-        if type_info:
-            type_overrides, constraints = type_info
+        if epoch is not None:
+            event['epoch'] = epoch
+        table = event_type
+        if event_handler.transform:
+            event = event_handler.transform(self, event)
+            table = event.pop('event', event_type)
+        if snapshot_field and table == event_type:
+            event.pop(snapshot_field, None)
+            table = self.snapshot_table(event_type)
+        fingerprint = (table, frozenset(zip(event, map(type, event.values()))))
+        if virtual:
+            if fingerprint not in self.writer.fingerprints:
+                self._update_schema(table, event, event_handler, virtual)
+                self.writer.fingerprints.add(fingerprint)
+            return
+        if fingerprint not in self.writer.fingerprints:
+            self._update_schema(table, event, event_handler)
+            if snapshot_field:
+                if "snapshots" not in self.writer.schema_cache:
+                    self.writer.set_schema("snapshots", *self.SNAPSHOT_SCHEMA)
+                self.writer.set_schema(table, '"%s_hash" TEXT' % snapshot_field)
+                self.writer.create_view(event_type, self.snapshot_view(event_type))
+            self.writer.fingerprints.add(fingerprint)
+        self.writer.insert_row(table, tuple(event), event.values())
+
+    def trade_observations(self):
+        # The table may be created while this importer runs, by a rebuild in another process. The writer sees it
+        # once it reloads its schema, at the start of its next transaction.
+        if self.trades is None and "TradeObservation" in self.writer.schema_cache:
+            self.trades = TradeObservations(self.writer)
+        return self.trades
+
+    def state(self):
+        # What event() keeps track of outside the database, for restore() to undo along with a rollback
+        trades = self.trades and (list(self.trades.ranges), set(self.trades.systems))
+        return dict(self.sample_intervals), trades
+
+    def restore(self, state):
+        sample_intervals, trades = state
+        self.sample_intervals = dict(sample_intervals)
+        if self.trades:
+            # A TradeObservations created since has seen rolled back events only
+            ranges, systems = trades or ([], set())
+            self.trades.ranges = list(ranges)
+            self.trades.systems = set(systems)
+
+    def stores_virtually(self, event_type, event_handler):
+        # Only rows stored exactly as the journal wrote them can be read back out of events.
+        # Transformed and snapshot types always get tables.
+        if event_type in self.writer.virtual_schema:
+            return True
+        return self.virtual \
+            and event_type not in self.materialize \
+            and event_type not in self.writer.schema_cache \
+            and event_type not in self.SNAPSHOT_FIELDS \
+            and not event_handler.transform
+
+    def retains(self, event_type, event):
+        # Whether the retention policy has the event stored at all, given the sampled events record_sample() noted.
+        # Sampling starts over with each importer, apply_retention() thins out what that lets through.
+        rule = self.retention[event_type]
+        if rule.action == 'drop':
+            return False
+        if rule.action != 'sample':
+            return True
+        return self.sample_intervals.get(event_type) != self.sample_interval(rule, event)
+
+    def record_sample(self, event_type, event):
+        # Notes a stored event, so retains() leaves out the rest of its sampling interval
+        rule = self.retention[event_type]
+        if rule.action == 'sample':
+            self.sample_intervals[event_type] = self.sample_interval(rule, event)
+
+    def sample_interval(self, rule, event):
+        return (self.epoch(event['timestamp']) or 0) // rule.interval
+
+    @staticmethod
+    def epoch(timestamp):
+        # Integer seconds of the journal's UTC timestamps, what the analytics queries compare and index
+        try:
+            return int(datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp())
+        except (AttributeError, ValueError):
+            return None
+
+    # Market/Outfitting/Shipyard.json item lists are stored once per distinct content in `snapshots`.
+    # Their rows go to <type>Record with a <field>_hash column, and a view named after the event type
+    # joins the full list back in, so queries against Market etc. see the same columns as before.
+    SNAPSHOT_FIELDS = {'Market': 'Items', 'Outfitting': 'Items', 'Shipyard': 'PriceList'}
+    SNAPSHOT_SCHEMA = ("hash TEXT PRIMARY KEY", "type TEXT", "base TEXT", "payload JSON")
+    # A delta against the station's previous full snapshot is kept only below this fraction of the full size
+    SNAPSHOT_DELTA_RATIO = 0.5
+
+    @staticmethod
+    def snapshot_table(event_type):
+        return event_type + "Record"
+
+    @classmethod
+    def snapshot_view(cls, event_type):
+        # Deltas are JSON merge patches over the base list keyed by item id, with the ids in list order
+        field = cls.SNAPSHOT_FIELDS[event_type]
+        record = cls.snapshot_table(event_type)
+        return f"""
+            SELECT
+                {record}.*,
+                CASE
+                    WHEN snapshot.base IS NULL THEN inflate(snapshot.payload)
+                    ELSE (
+                        SELECT json_group_array(json(json_extract(patched.items, '$."' || item_id.value || '"')))
+                        FROM (
+                            SELECT json_patch(json_group_object(CAST(json_extract(item.value, '$.id') AS TEXT),
+                                                                json(item.value)),
+                                              json_extract(inflate(snapshot.payload), '$.patch')) items
+                            FROM json_each(inflate(base.payload)) item
+                        ) patched, json_each(inflate(snapshot.payload), '$.order') item_id
+                    )
+                END "{field}"
+            FROM {record}
+            LEFT JOIN snapshots snapshot ON snapshot.hash = {record}."{field}_hash"
+            LEFT JOIN snapshots base ON base.hash = snapshot.base
+        """
+
+    def deduplicates(self, event_type):
+        # Databases with an inline <type> table keep using it until upgrade() migrates them
+        return self.snapshot_table(event_type) in self.writer.schema_cache \
+            or event_type not in self.writer.schema_cache
+
+    def _store_snapshot(self, event_type, field, event, stored):
+        items = event[field]
+        if isinstance(items, str):
+            items = json.loads(items)
+        # The text stored is what's hashed, serialized once. Snapshots seen before only cost a set lookup.
+        text = self.canonical_json(items)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        if "snapshots" not in self.writer.schema_cache:
+            self.writer.set_schema("snapshots", *self.SNAPSHOT_SCHEMA)
+        key = (event_type, event.get('MarketID'))
+        if digest not in self.writer.snapshots and \
+                not self.writer.execute("SELECT 1 FROM snapshots WHERE hash = ?", [digest]).fetchone():
+            base = self._snapshot_base(event_type, field, key) if self.snapshot_deltas else None
+            delta = self.snapshot_delta(base[1], items) if base else None
+            if delta is not None and len(delta) < len(text) * self.SNAPSHOT_DELTA_RATIO:
+                self.writer.execute(
+                    "INSERT INTO snapshots (hash, type, base, payload) VALUES (?, ?, ?, ?)",
+                    [digest, event_type, base[0], self.writer.compress(delta)]
+                )
+            else:
+                self.writer.execute(
+                    "INSERT INTO snapshots (hash, type, payload) VALUES (?, ?, ?)",
+                    [digest, event_type, self.writer.compress(text)]
+                )
+                self.snapshot_bases[key] = (digest, self.items_by_id(items))
+        self.writer.snapshots.add(digest)
+        if isinstance(stored, str):
+            # Serialized again without the payload, the one part of the line worth keeping out of events
+            stored = {'timestamp': event['timestamp'], 'event': event_type, **event}
+        stored = {**stored, field: digest}
+        event[field] = items
+        event[field + '_hash'] = digest
+        return stored
+
+    def _snapshot_base(self, event_type, field, key):
+        # A base the writer no longer knows of may have been rolled back
+        if key in self.snapshot_bases and self.snapshot_bases[key][0] in self.writer.snapshots:
+            return self.snapshot_bases[key]
+        record = self.snapshot_table(event_type)
+        if key[1] is None or record not in self.writer.schema_cache:
+            return None
+        self.writer.flush()
+        res = self.writer.execute(f"""
+            SELECT base.hash, base.payload
+            FROM {record}
+            JOIN snapshots latest ON latest.hash = {record}."{field}_hash"
+            JOIN snapshots base ON base.hash = COALESCE(latest.base, latest.hash)
+            WHERE {record}.MarketID = ?
+            ORDER BY {record}.event_id DESC
+            LIMIT 1
+        """, [key[1]]).fetchone()
+        if not res:
+            return None
+        self.snapshot_bases[key] = (res[0], self.items_by_id(json.loads(inflate(res[1]))))
+        self.writer.snapshots.add(res[0])
+        return self.snapshot_bases[key]
+
+    @staticmethod
+    def canonical_json(value):
+        # Sorted keys, so the same list hashes the same whichever way its items were serialized
+        return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+    @staticmethod
+    def items_by_id(items):
+        return {str(item.get('id')): item for item in items}
+
+    @staticmethod
+    def snapshot_delta(base_items, items):
+        # JSON merge patch turning base_items into items along with the order of items, or None if one can't
+        # express it
+        new_items = StructuredImport.items_by_id(items)
+        if len(new_items) != len(items) or 'None' in new_items:
+            return None
+        delta = {}
+        for item_id, item in new_items.items():
+            if any(v is None for v in item.values()):
+                return None
+            old = base_items.get(item_id)
+            if old != item:
+                delta[item_id] = {**{k: None for k in (old or {}) if k not in item}, **item}
+        for item_id in base_items:
+            if item_id not in new_items:
+                delta[item_id] = None
+        return StructuredImport.canonical_json({'order': list(new_items), 'patch': delta})
+
+    def _unknown_type(self, event_type):
+        if event_type not in self.unknown_types:
+            print("storing unknown event type %s with the default schema" % event_type, file=sys.stderr)
+            self.unknown_types.add(event_type)
+        return DEFAULT_HANDLER
+
+    def _update_schema(self, table, event, event_handler, virtual=False):
+        type_overrides = event_handler.type_overrides
+        constraints = event_handler.constraints
 
         def lookup_type(key):
             if type_overrides and key in type_overrides:
@@ -131,482 +1290,593 @@ class StructuredImport:
         if constraints:
             schema.extend(constraints)
         schema.extend(['"' + k + '"' + lookup_type(k) for k in event.keys()])
-        self.writer.set_schema(event_type, *schema)
-        value_overrides = custom_fn(event)
-        if value_overrides:
-            event = value_overrides
-        self.writer.insert(event_type, **event)
-
-    def ApproachSettlement(self, approachsettlement):
-        pass
-    def BackPack(self, backpack):
-        pass
-    def BackpackChange(self, backpackchange):
-        pass
-    def BookTaxi(self, booktaxi):
-        pass
-    def BuyAmmo(self, buyammo):
-        pass
-    def BuyDrones(self, buydrones):
-        pass
-    def BuyExplorationData(self, buyexplorationdata):
-        pass
-    def BuyTradeData(self, buytradedata):
-        pass
-    def CancelTaxi(self, canceltaxi):
-        pass
-    def Cargo(self, cargo):
-        pass
-    def CargoDepot(self, cargodepot):
-        pass
-    def CarrierJump(self, carrierjump):
-        pass
-    def CodexEntry(self, codexentry):
-        pass
-    def CollectCargo(self, collectcargo):
-        pass
-    def CommitCrime(self, commitcrime):
-        pass
-    def CommunityGoal(self, communitygoal):
-        pass
-    def CommunityGoalDiscard(self, communitygoaldiscard):
-        pass
-    def CommunityGoalJoin(self, communitygoaljoin):
-        pass
-    def CommunityGoalReward(self, communitygoalreward):
-        pass
-    def CrewHire(self, crewhire):
-        pass
-    def Died(self, died):
-        pass
-    def Docked(self, docked):
-        pass
-    def EjectCargo(self, ejectcargo):
-        pass
-    def EngineerContribution(self, engineercontribution):
-        pass
-    def EngineerCraft(self, engineercraft):
-        pass
-    def EngineerProgress(self, engineerprogress):
-        pass
-    def FSDJump(self, fsdjump):
-        pass
-    def FSDTarget(self, fsdtarget):
-        pass
-    def FSSAllBodiesFound(self, fssallbodiesfound):
-        pass
-    def FSSDiscoveryScan(self, fssdiscoveryscan):
-        pass
-    def FetchRemoteModule(self, fetchremotemodule):
-        pass
-    def Friends(self, friends):
-        pass
-    def Interdicted(self, interdicted):
-        pass
-    def Interdiction(self, interdiction):
-        pass
-    def JoinACrew(self, joinacrew):
-        pass
-    def LoadGame(self, loadgame):
-        pass
-    def Loadout(self, loadout):
-        pass
-    def Location(self, location):
-        pass
-    def MarketBuy(self, marketbuy):
-        pass
-    def MarketSell(self, marketsell):
-        pass
-    def MaterialCollected(self, materialcollected):
-        pass
-    def MaterialDiscarded(self, materialdiscarded):
-        pass
-    def MaterialTrade(self, materialtrade):
-        pass
-    def Materials(self, materials):
-        pass
-    def MiningRefined(self, miningrefined):
-        pass
-    def MissionAbandoned(self, missionabandoned):
-        pass
-    def MissionAccepted(self, missionaccepted):
-        pass
-    def MissionCompleted(self, missioncompleted):
-        pass
-    def MissionFailed(self, missionfailed):
-        pass
-    def MissionRedirected(self, missionredirected):
-        pass
-    def Missions(self, missions):
-        pass
-    def ModuleBuy(self, modulebuy):
-        pass
-    def ModuleRetrieve(self, moduleretrieve):
-        pass
-    def ModuleSell(self, modulesell):
-        pass
-    def ModuleSellRemote(self, modulesellremote):
-        pass
-    def MultiSellExplorationData(self, multisellexplorationdata):
-        pass
-    def NpcCrewPaidWage(self, npccrewpaidwage):
-        pass
-    def PayBounties(self, paybounties):
-        pass
-    def PayFines(self, payfines):
-        pass
-    def PayLegacyFines(self, paylegacyfines):
-        pass
-    def Powerplay(self, powerplay):
-        pass
-    def PowerplayCollect(self, powerplaycollect):
-        pass
-    def PowerplayDefect(self, powerplaydefect):
-        pass
-    def PowerplayDeliver(self, powerplaydeliver):
-        pass
-    def PowerplayFastTrack(self, powerplayfasttrack):
-        pass
-    def PowerplayJoin(self, powerplayjoin):
-        pass
-    def PowerplayLeave(self, powerplayleave):
-        pass
-    def PowerplaySalary(self, powerplaysalary):
-        pass
-    def Progress(self, progress):
-        pass
-    def Promotion(self, promotion):
-        pass
-    def QuitACrew(self, quitacrew):
-        pass
-    def Rank(self, rank):
-        pass
-    def RedeemVoucher(self, redeemvoucher):
-        pass
-    def RefuelAll(self, refuelall):
-        pass
-    def RefuelPartial(self, refuelpartial):
-        pass
-    def Repair(self, repair):
-        pass
-    def RepairAll(self, repairall):
-        pass
-    def Reputation(self, reputation):
-        pass
-    def RestockVehicle(self, restockvehicle):
-        pass
-    def Resurrect(self, resurrect):
-        pass
-    def SAASignalsFound(self, saascancomplete):
-        pass
-    def SAAScanComplete(self, saascancomplete):
-        pass
-    def Scan(self, scan):
-        pass
-    def ScientificResearch(self, scientificresearch):
-        pass
-    def SearchAndRescue(self, searchandrescue):
-        pass
-    def SelfDestruct(self, selfdestruct):
-        pass
-    def SellDrones(self, selldrones):
-        pass
-    def SellExplorationData(self, sellexplorationdata):
-        pass
-    def SellShipOnRebuy(self, sellshiponrebuy):
-        pass
-    def SetUserShipName(self, setusershipname):
-        pass
-    def ShipLocker(self, shiplocker):
-        pass
-    def ShipyardBuy(self, shipyardbuy):
-        pass
-    def ShipyardSell(self, shipyardsell):
-        pass
-    def ShipyardSwap(self, shipyardswap):
-        pass
-    def ShipyardTransfer(self, shipyardtransfer):
-        pass
-    def StartUp(self, startup):
-        pass
-    def Statistics(self, statistics):
-        pass
-    def StoredShips(self, storedships):
-        pass
-    def Synthesis(self, synthesis):
-        pass
-    def TechnologyBroker(self, technologybroker):
-        pass
-    def USSDrop(self, ussdrop):
-        pass
-    def Undocked(self, undocked):
-        pass
-    def AfmuRepairs(self, afmurepairs):
-        pass
-    def AppliedToSquadron(self, appliedtosquadron):
-        pass
-    def ApproachBody(self, approachbody):
-        pass
-    def AsteroidCracked(self, asteroidcracked):
-        pass
-    def BookDropship(self, bookdropship):
-        pass
-    def Bounty(self, bounty):
-        pass
-    def CancelDropship(self, canceldropship):
-        pass
-    def CapShipBond(self, capshipbond):
-        pass
-    def CargoTransfer(self, cargotransfer):
-        pass
-    def CarrierBankTransfer(self, carrierbanktransfer):
-        pass
-    def CarrierBuy(self, carrierbuy):
-        pass
-    def CarrierCrewServices(self, carriercrewservices):
-        pass
-    def CarrierDecommission(self, carrierdecommission):
-        pass
-    def CarrierDepositFuel(self, carrierdepositfuel):
-        pass
-    def CarrierDockingPermission(self, carrierdockingpermission):
-        pass
-    def CarrierFinance(self, carrierfinance):
-        pass
-    def CarrierJumpCancelled(self, carrierjumpcancelled):
-        pass
-    def CarrierJumpRequest(self, carrierjumprequest):
-        pass
-    def CarrierModulePack(self, carriermodulepack):
-        pass
-    def CarrierNameChange(self, carriernamechange):
-        pass
-    def CarrierStats(self, carrierstats):
-        pass
-    def CarrierTradeOrder(self, carriertradeorder):
-        pass
-    def ChangeCrewRole(self, changecrewrole):
-        pass
-    def ClearSavedGame(self, clearsavedgame):
-        pass
-    def CockpitBreached(self, cockpitbreached):
-        pass
-    def CollectItems(self, collectitems):
-        pass
-    def Commander(self, commander):
-        pass
-    def Continued(self, continued):
-        pass
-    def Coriolis(self, coriolis):
-        pass
-    def CrewAssign(self, crewassign):
-        pass
-    def CrewFire(self, crewfire):
-        pass
-    def CrewLaunchFighter(self, crewlaunchfighter):
-        pass
-    def CrewMemberJoins(self, crewmemberjoins):
-        pass
-    def CrewMemberQuits(self, crewmemberquits):
-        pass
-    def CrewMemberRoleChange(self, crewmemberrolechange):
-        pass
-    def CrimeVictim(self, crimevictim):
-        pass
-    def DataScanned(self, datascanned):
-        pass
-    def DatalinkScan(self, datalinkscan):
-        pass
-    def DatalinkVoucher(self, datalinkvoucher):
-        pass
-    def DisbandedSquadron(self, disbandedsquadron):
-        pass
-    def DiscoveryScan(self, discoveryscan):
-        pass
-    def DockFighter(self, dockfighter):
-        pass
-    def DockSRV(self, docksrv):
-        pass
-    def DockingCancelled(self, dockingcancelled):
-        pass
-    def DockingDenied(self, dockingdenied):
-        pass
-    def DockingGranted(self, dockinggranted):
-        pass
-    def DockingRequested(self, dockingrequested):
-        pass
-    def DockingTimeout(self, dockingtimeout):
-        pass
-    def DropItems(self, dropitems):
-        pass
-    def EDDCommodityPrices(self, eddcommodityprices):
-        pass
-    def EDDItemSet(self, edditemset):
-        pass
-    def EDShipyard(self, edshipyard):
-        pass
-    def Embark(self, embark):
-        pass
-    def EndCrewSession(self, endcrewsession):
-        pass
-    def EngineerApply(self, engineerapply):
-        pass
-    def EngineerLegacyConvert(self, engineerlegacyconvert):
-        pass
-    def EscapeInterdiction(self, escapeinterdiction):
-        pass
-    def FSSSignalDiscovered(self, fsssignaldiscovered):
-        pass
-    def FactionKillBond(self, factionkillbond):
-        pass
-    def FighterDestroyed(self, fighterdestroyed):
-        pass
-    def FighterRebuilt(self, fighterrebuilt):
-        pass
-    def Fileheader(self, fileheader):
-        pass
-    def FuelScoop(self, fuelscoop):
-        pass
-    def HeatDamage(self, heatdamage):
-        pass
-    def HeatWarning(self, heatwarning):
-        pass
-    def HullDamage(self, hulldamage):
-        pass
-    def InvitedToSquadron(self, invitedtosquadron):
-        pass
-    def JetConeBoost(self, jetconeboost):
-        pass
-    def JetConeDamage(self, jetconedamage):
-        pass
-    def JoinedSquadron(self, joinedsquadron):
-        pass
-    def KickCrewMember(self, kickcrewmember):
-        pass
-    def LaunchDrone(self, launchdrone):
-        pass
-    def LaunchFighter(self, launchfighter):
-        pass
-    def LaunchSRV(self, launchsrv):
-        pass
-    def LeaveBody(self, leavebody):
-        pass
-    def LeftSquadron(self, leftsquadron):
-        pass
-    def Liftoff(self, liftoff):
-        pass
+        if virtual:
+            self.writer.set_virtual_schema(table, *schema)
+        else:
+            self.writer.set_schema(table, *schema)
+
+    @classmethod
+    def build_handlers(cls):
+        handlers = dict.fromkeys(cls.EVENT_TYPES, DEFAULT_HANDLER)
+        for klass in reversed(cls.__mro__):
+            for name, fn in vars(klass).items():
+                if hasattr(fn, 'handler'):
+                    handlers[name] = fn.handler
+        return handlers
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.HANDLERS = cls.build_handlers()
+
+    # Journal and OCR event types stored with the default schema and no transform
+    EVENT_TYPES = (
+        'ApproachSettlement', 'BackPack', 'BackpackChange', 'BookTaxi', 'BuyAmmo', 'BuyDrones',
+        'BuyExplorationData', 'BuyTradeData', 'CancelTaxi', 'Cargo', 'CargoDepot', 'CarrierJump', 'CodexEntry',
+        'CollectCargo', 'CommitCrime', 'CommunityGoal', 'CommunityGoalDiscard', 'CommunityGoalJoin',
+        'CommunityGoalReward', 'CrewHire', 'Died', 'Docked', 'EjectCargo', 'EngineerContribution', 'EngineerCraft',
+        'EngineerProgress', 'FSDJump', 'FSDTarget', 'FSSAllBodiesFound', 'FSSDiscoveryScan', 'FetchRemoteModule',
+        'Friends', 'Interdicted', 'Interdiction', 'JoinACrew', 'LoadGame', 'Loadout', 'Location', 'MarketBuy',
+        'MarketSell', 'MaterialCollected', 'MaterialDiscarded', 'MaterialTrade', 'Materials', 'MiningRefined',
+        'MissionAbandoned', 'MissionAccepted', 'MissionCompleted', 'MissionFailed', 'MissionRedirected', 'Missions',
+        'ModuleBuy', 'ModuleRetrieve', 'ModuleSell', 'ModuleSellRemote', 'MultiSellExplorationData',
+        'NpcCrewPaidWage', 'PayBounties', 'PayFines', 'PayLegacyFines', 'Powerplay', 'PowerplayCollect',
+        'PowerplayDefect', 'PowerplayDeliver', 'PowerplayFastTrack', 'PowerplayJoin', 'PowerplayLeave',
+        'PowerplaySalary', 'Progress', 'Promotion', 'QuitACrew', 'Rank', 'RedeemVoucher', 'RefuelAll',
+        'RefuelPartial', 'Repair', 'RepairAll', 'Reputation', 'RestockVehicle', 'Resurrect', 'SAASignalsFound',
+        'SAAScanComplete', 'Scan', 'ScientificResearch', 'SearchAndRescue', 'SelfDestruct', 'SellDrones',
+        'SellExplorationData', 'SellShipOnRebuy', 'SetUserShipName', 'ShipLocker', 'ShipyardBuy', 'ShipyardSell',
+        'ShipyardSwap', 'ShipyardTransfer', 'StartUp', 'Statistics', 'StoredShips', 'Synthesis', 'TechnologyBroker',
+        'USSDrop', 'Undocked', 'AfmuRepairs', 'AppliedToSquadron', 'ApproachBody', 'AsteroidCracked',
+        'BookDropship', 'Bounty', 'CancelDropship', 'CapShipBond', 'CargoTransfer', 'CarrierBankTransfer',
+        'CarrierBuy', 'CarrierCrewServices', 'CarrierDecommission', 'CarrierDepositFuel',
+        'CarrierDockingPermission', 'CarrierFinance', 'CarrierJumpCancelled', 'CarrierJumpRequest',
+        'CarrierModulePack', 'CarrierNameChange', 'CarrierStats', 'CarrierTradeOrder', 'ChangeCrewRole',
+        'ClearSavedGame', 'CockpitBreached', 'CollectItems', 'Commander', 'Continued', 'Coriolis', 'CrewAssign',
+        'CrewFire', 'CrewLaunchFighter', 'CrewMemberJoins', 'CrewMemberQuits', 'CrewMemberRoleChange',
+        'CrimeVictim', 'DataScanned', 'DatalinkScan', 'DatalinkVoucher', 'DisbandedSquadron', 'DiscoveryScan',
+        'DockFighter', 'DockSRV', 'DockingCancelled', 'DockingDenied', 'DockingGranted', 'DockingRequested',
+        'DockingTimeout', 'DropItems', 'EDDCommodityPrices', 'EDDItemSet', 'EDShipyard', 'Embark', 'EndCrewSession',
+        'EngineerApply', 'EngineerLegacyConvert', 'EscapeInterdiction', 'FSSSignalDiscovered', 'FactionKillBond',
+        'FighterDestroyed', 'FighterRebuilt', 'Fileheader', 'FuelScoop', 'HeatDamage', 'HeatWarning', 'HullDamage',
+        'InvitedToSquadron', 'JetConeBoost', 'JetConeDamage', 'JoinedSquadron', 'KickCrewMember', 'LaunchDrone',
+        'LaunchFighter', 'LaunchSRV', 'LeaveBody', 'LeftSquadron', 'Liftoff', 'MassModuleStore',
+        'MaterialDiscovered', 'ModuleArrived', 'ModuleInfo', 'ModuleStore', 'ModuleSwap', 'Music', 'NavBeaconScan',
+        'NavRoute', 'NewCommander', 'NpcCrewRank', 'Outfitting', 'PVPKill', 'Passengers', 'PowerplayVote',
+        'PowerplayVoucher', 'ProspectedAsteroid', 'RebootRepair', 'ReceiveText', 'RepairDrone',
+        'ReservoirReplenished', 'SRVDestroyed', 'Scanned', 'Screenshot', 'SendText', 'SharedBookmarkToSquadron',
+        'ShieldState', 'ShipArrived', 'ShipTargeted', 'Shipyard', 'ShipyardNew', 'ShutDown', 'SquadronCreated',
+        'SquadronStartup', 'StartJump', 'Status', 'StoredModules', 'SupercruiseEntry', 'SupercruiseExit',
+        'SystemsShutdown', 'Touchdown', 'UnderAttack', 'VehicleSwitch', 'WingAdd', 'WingInvite', 'WingJoin',
+        'WingLeave', 'DetailedTrafficReport', 'LocalFactionStatusSummary', 'LocalFactionBounties',
+        'LocalPowerBounties', 'LocalPowerUpdate', 'LocalTradeReport', 'LocalCrimeReport', 'LocalBountyReport',
+    )
+
+    MARKET_ITEM_SCHEMA = (
+        "event_id INTEGER",
+        "epoch INTEGER",
+        "MarketID INTEGER",
+        "Commodity TEXT",
+        "Name TEXT",
+        "Name_Localised TEXT",
+        "Category_Localised TEXT",
+        "BuyPrice INTEGER",
+        "SellPrice INTEGER",
+        "Stock INTEGER",
+        "StockBracket INTEGER",
+        "Demand INTEGER",
+        "DemandBracket INTEGER",
+    )
+
+    @staticmethod
+    def commodity_key(name_localised):
+        # Matches the lowercase, space-free commodity names used by MarketBuy/MarketSell.Type
+        return name_localised.lower().replace(' ', '') if name_localised else None
+
+    @handler()
     def Market(self, market):
-        pass
-    def MassModuleStore(self, massmodulestore):
-        pass
-    def MaterialDiscovered(self, materialdiscovered):
-        pass
-    def ModuleArrived(self, modulearrived):
-        pass
-    def ModuleInfo(self, moduleinfo):
-        pass
-    def ModuleStore(self, modulestore):
-        pass
-    def ModuleSwap(self, moduleswap):
-        pass
-    def Music(self, music):
-        pass
-    def NavBeaconScan(self, navbeaconscan):
-        pass
-    def NavRoute(self, navroute):
-        pass
-    def NewCommander(self, newcommander):
-        pass
-    def NpcCrewRank(self, npccrewrank):
-        pass
-    def Outfitting(self, outfitting):
-        pass
-    def PVPKill(self, pvpkill):
-        pass
-    def Passengers(self, passengers):
-        pass
-    def PowerplayVote(self, powerplayvote):
-        pass
-    def PowerplayVoucher(self, powerplayvoucher):
-        pass
-    def ProspectedAsteroid(self, prospectedasteroid):
-        pass
-    def RebootRepair(self, rebootrepair):
-        pass
-    def ReceiveText(self, receivetext):
-        pass
-    def RepairDrone(self, repairdrone):
-        pass
-    def ReservoirReplenished(self, reservoirreplenished):
-        pass
-    def SRVDestroyed(self, srvdestroyed):
-        pass
-    def Scanned(self, scanned):
-        pass
-    def Screenshot(self, screenshot):
-        pass
-    def SendText(self, sendtext):
-        pass
-    def SharedBookmarkToSquadron(self, sharedbookmarktosquadron):
-        pass
-    def ShieldState(self, shieldstate):
-        pass
-    def ShipArrived(self, shiparrived):
-        pass
-    def ShipTargeted(self, shiptargeted):
-        pass
-    def Shipyard(self, shipyard):
-        pass
-    def ShipyardNew(self, shipyardnew):
-        pass
-    def ShutDown(self, shutdown):
-        pass
+        # Market.json snapshots carry Items, the journal Market event only points at the file
+        items = market.get('Items')
+        if items:
+            if isinstance(items, str):
+                items = json.loads(items)
+            if "MarketItem" not in self.writer.schema_cache:
+                self.writer.set_schema("MarketItem", *self.MARKET_ITEM_SCHEMA)
+            for item in items:
+                self.writer.insert(
+                    "MarketItem",
+                    event_id=market['event_id'],
+                    epoch=market.get('epoch'),
+                    MarketID=market.get('MarketID'),
+                    Commodity=self.commodity_key(item.get('Name_Localised')),
+                    Name=item.get('Name'),
+                    Name_Localised=item.get('Name_Localised'),
+                    Category_Localised=item.get('Category_Localised'),
+                    BuyPrice=item.get('BuyPrice'),
+                    SellPrice=item.get('SellPrice'),
+                    Stock=item.get('Stock'),
+                    StockBracket=item.get('StockBracket'),
+                    Demand=item.get('Demand'),
+                    DemandBracket=item.get('DemandBracket'),
+                )
+        return market
+
+    @handler()
     def Shutdown(self, shutdown):
-        if shutdown:
-            return {**shutdown, 'event': 'ShutDown'}
-    def SquadronCreated(self, squadroncreated):
-        pass
-    def SquadronStartup(self, squadronstartup):
-        pass
-    def StartJump(self, startjump):
-        pass
-    def Status(self, status):
-        pass
-    def StoredModules(self, storedmodules):
-        pass
-    def SupercruiseEntry(self, supercruiseentry):
-        pass
-    def SupercruiseExit(self, supercruiseexit):
-        pass
-    def SystemsShutdown(self, systemsshutdown):
-        pass
-    def Touchdown(self, touchdown):
-        pass
-    def UnderAttack(self, underattack):
-        pass
-    def VehicleSwitch(self, vehicleswitch):
-        pass
-    def WingAdd(self, wingadd):
-        pass
-    def WingInvite(self, winginvite):
-        pass
-    def WingJoin(self, wingjoin):
-        pass
-    def WingLeave(self, wingleave):
-        pass
-    def DetailedTrafficReport(self, detailedtrafficreport):
-        pass
-    def LocalFactionStatusSummary(self, localfactionstatussummary):
-        pass
-    def LocalFactionBounties(self, localfactionbounties):
-        pass
-    def LocalPowerBounties(self, localpowerbounties):
-        pass
-    def LocalPowerUpdate(self, localpowerupdate):
-        pass
-    def LocalTradeReport(self, localtradereport):
-        pass
-    def LocalCrimeReport(self, localcrimereport):
-        pass
-    def LocalBountyReport(self, localbountyreport):
-        pass
+        return {**shutdown, 'event': 'ShutDown'}
+
+
+StructuredImport.HANDLERS = StructuredImport.build_handlers()
+
+
+def apply_retention(writer, archive_path, policy=None, now=None, dry_run=False):
+    # Applies the retention policy, the database's own unless given, to the events already in it, moving those due
+    # for archiving to the database at archive_path. Returns {event type: (events removed, of which archived)}.
+    # Archived events are written before they are deleted here, a crash in between leaves them in both.
+    now = int(time.time()) if now is None else now
+    policy = load_retention(writer) if policy is None else policy
+    if not policy or "events" not in writer.schema_cache:
+        return {}
+    cutoffs = {
+        event_type: now - rule.days * 24 * 3600 for event_type, rule in policy.items() if rule.action == 'archive'
+    }
+    due = [
+        event_type for event_type, cutoff in sorted(cutoffs.items())
+        if writer.execute("SELECT 1 FROM events WHERE type = ? AND epoch < ? LIMIT 1", [event_type, cutoff]).fetchone()
+    ]
+    attached = bool(due) and not dry_run
+    if attached:
+        _prepare_archive(writer, archive_path, due)
+        writer.execute("ATTACH DATABASE ? AS archive", [archive_path])
+    removed = {}
+    try:
+        with writer.transaction():
+            writer.execute("CREATE TEMP TABLE IF NOT EXISTS retired (id INTEGER PRIMARY KEY)")
+            for event_type, rule in sorted(policy.items()):
+                writer.execute("DELETE FROM retired")
+                if rule.action == 'drop':
+                    writer.execute("INSERT INTO retired SELECT id FROM events WHERE type = ?", [event_type])
+                elif rule.action == 'sample':
+                    # Same rows as sampling at import keeps, so compacting again removes nothing more
+                    writer.execute("""
+                        INSERT INTO retired
+                        SELECT id FROM events WHERE type = ? AND id NOT IN (
+                            SELECT MIN(id) FROM events WHERE type = ? GROUP BY epoch / ?
+                        )
+                    """, [event_type, event_type, rule.interval])
+                elif rule.action == 'archive':
+                    writer.execute("INSERT INTO retired SELECT id FROM events WHERE type = ? AND epoch < ?",
+                                   [event_type, cutoffs[event_type]])
+                count = writer.execute("SELECT COUNT(*) FROM retired").fetchone()[0]
+                if not count:
+                    continue
+                removed[event_type] = (count, count if rule.action == 'archive' else 0)
+                if dry_run:
+                    continue
+                table = event_type if event_type in writer.schema_cache else None
+                if rule.action == 'archive':
+                    _archive_rows(writer, "events", "id")
+                    if table:
+                        _archive_rows(writer, table, "event_id")
+                if table:
+                    writer.execute('DELETE FROM "%s" WHERE event_id IN (SELECT id FROM retired)' % table)
+                writer.execute("DELETE FROM events WHERE id IN (SELECT id FROM retired)")
+            writer.execute("DROP TABLE retired")
+    finally:
+        if attached:
+            writer.execute("DETACH DATABASE archive")
+    return removed
+
+
+def _prepare_archive(writer, archive_path, event_types):
+    # Gives the archive database the tables, or for virtual types the views, the event types are read through
+    archive = Writer(connect(archive_path), False)
+    with archive.transaction():
+        archive.set_schema("events", *writer.schema_cache["events"])
+        for event_type in event_types:
+            if event_type in writer.schema_cache:
+                archive.set_schema(event_type, *writer.schema_cache[event_type])
+            elif event_type in writer.views and event_type not in archive.views:
+                view = writer.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?",
+                                      [event_type]).fetchone()[0]
+                archive.execute(view)
+    archive.conn.close()
+
+
+def _archive_rows(writer, table, id_column):
+    # Copies the rows of table listed in retired to the attached archive database
+    columns = ", ".join('"%s"' % row[1] for row in writer.execute('PRAGMA table_info("%s")' % table))
+    writer.execute('INSERT OR IGNORE INTO archive."%s" (%s) SELECT %s FROM "%s" WHERE %s IN (SELECT id FROM retired)'
+                   % (table, columns, columns, table, id_column))
+
+
+# Windows of the trade analysis, in seconds: influence and traffic are compared between the tick before a trade
+# and the one after, which is taken to have passed TICK_CUTOFF after it.
+TICK_CUTOFF = 4 * 3600
+TICK_DURATION = 28 * 3600
+# There's some sort of clock skew between the timestamp captured when taking screenshots, and timestamps from EDMC.
+# Screenshots were recorded as taking place ~25s before the docking event
+# Artificially add this skew back into the timestamp so that it lines up.
+SCREENSHOT_FUDGE = 60
+
+
+class TradeObservations:
+    # Keeps TradeObservation up to date: a row per MarketBuy/MarketSell with what trade_data reports about it, the
+    # market it traded at, its faction, and the traffic and influence screenshots of the ticks around it.
+    # Imported events mark the transactions they may change, which are recomputed before the writer commits.
+    SCHEMA = (
+        "event_id INTEGER PRIMARY KEY",
+        "Type TEXT",
+        "MarketID INTEGER",
+        "StarSystem TEXT",
+        "Population INTEGER",
+        "JumpId INTEGER",
+        "Faction TEXT",
+        "Commodity TEXT",
+        "Commodity_Localised TEXT",
+        "Count INTEGER",
+        "Inventory INTEGER",
+        "Bracket INTEGER",
+        "Price INTEGER",
+        "TransactEpoch INTEGER",
+        "TickCutoff INTEGER",
+        "TickWindow INTEGER",
+        "MarketEpoch INTEGER",
+        "DockedEpoch INTEGER",
+        "TrafficEpoch INTEGER",
+        "TotalTraffic INTEGER",
+        "Ships JSON",
+        "RawTraffic TEXT",
+        "StatusBeforeEpoch INTEGER",
+        "InfluenceBefore REAL",
+        "RawStatusBefore TEXT",
+        "StatusAfterEpoch INTEGER",
+        "InfluenceAfter REAL",
+        "RawStatusAfter TEXT",
+    )
+    SOURCES = {'MarketBuy', 'MarketSell', 'Market', 'Docked', 'FSDJump', 'DetailedTrafficReport',
+               'LocalFactionStatusSummary'}
+    LATEST = 2 ** 62
+
+    def __init__(self, writer):
+        self.writer = writer
+        # (first, last) TransactEpoch of transactions to recompute, last None for all later ones
+        self.ranges = []
+        # Systems jumped to, whose population is taken from the latest jump
+        self.systems = set()
+        writer.commit_hooks.append(self.refresh)
+
+    def touch(self, event_type, epoch, star_system=None):
+        if epoch is None:
+            return
+        if event_type in ('MarketBuy', 'MarketSell'):
+            self.ranges.append((epoch, epoch))
+        elif event_type == 'FSDJump':
+            self.systems.add(star_system)
+        elif event_type == 'Market':
+            self.ranges.append((epoch, None))
+        elif event_type == 'Docked':
+            # The faction of later transactions at the station, and the system of later screenshots,
+            # which are matched with transactions up to a tick before them
+            self.ranges.append((epoch - TICK_DURATION, None))
+        else:
+            # Screenshots are the before or after of transactions up to a tick away
+            self.ranges.append((epoch + SCREENSHOT_FUDGE - TICK_DURATION, epoch + SCREENSHOT_FUDGE + TICK_DURATION))
+
+    def rebuild(self):
+        self.writer.ensure_indexes()
+        self.writer.set_schema("TradeObservation", *self.SCHEMA)
+        self.writer.execute("DELETE FROM TradeObservation")
+        self.systems.clear()
+        self.ranges = [(0, None)]
+        self.refresh()
+
+    def refresh(self):
+        ranges = []
+        for first, last in sorted((first, self.LATEST if last is None else last) for first, last in self.ranges):
+            if ranges and first <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], last)
+            else:
+                ranges.append([first, last])
+        sql = self.refresh_sql()
+        for first, last in ranges:
+            self.writer.execute("DELETE FROM TradeObservation WHERE TransactEpoch BETWEEN ? AND ?", [first, last])
+            if sql:
+                self.writer.execute(sql, [first, last] * len(self.transactions()))
+        if self.has("FSDJump"):
+            for system in self.systems:
+                self.writer.execute("""
+                    UPDATE TradeObservation SET (Population, JumpId) = (
+                        SELECT Population, event_id FROM FSDJump WHERE StarSystem = ? ORDER BY event_id DESC LIMIT 1
+                    )
+                    WHERE StarSystem = ?
+                """, [system, system])
+        self.ranges.clear()
+        self.systems.clear()
+
+    def has(self, name):
+        return name in self.writer.schema_cache or name in self.writer.views
+
+    def transactions(self):
+        return [name for name in ('MarketBuy', 'MarketSell') if self.has(name)]
+
+    def refresh_sql(self):
+        # Recomputes the transactions between two epochs, one pair of parameters per transaction table.
+        # None until there are transactions and the markets and dockings to go with them.
+        # Screenshot and jump tables not imported yet leave their columns NULL.
+        transactions = self.transactions()
+        if not transactions or not all(self.has(name) for name in ('MarketItem', 'Market', 'Docked')):
+            return None
+
+        def system_at(time_expr):
+            # System of the most recent docking before a point in time
+            return f"""(
+                SELECT LastDocked.StarSystem
+                FROM Docked LastDocked
+                WHERE LastDocked.epoch < {time_expr}
+                ORDER BY LastDocked.epoch DESC
+                LIMIT 1
+            )"""
+
+        def latest_before(table, criteria):
+            return f"""(
+                SELECT Latest.epoch
+                FROM {table} Latest
+                WHERE {criteria}
+                AND Latest.epoch < Transact.TransactEpoch
+                ORDER BY Latest.epoch DESC
+                LIMIT 1
+            )"""
+
+        # The screenshot of a table taken in the trade's system, and for influence of the trade's faction,
+        # between two offsets from the trade: the latest one if descending, the earliest otherwise
+        def screenshot(table, after, before, descending=False):
+            faction_criteria = "AND Candidate.faction = upper(Trade.Faction)" if table == "LocalFactionStatusSummary" \
+                else ""
+            return f"""(
+                SELECT Candidate.epoch
+                FROM {table} Candidate
+                WHERE Candidate.epoch > Trade.TransactEpoch + {after - SCREENSHOT_FUDGE}
+                AND Candidate.epoch < Trade.TransactEpoch + {before - SCREENSHOT_FUDGE}
+                {faction_criteria}
+                AND {system_at(f"Candidate.epoch + {SCREENSHOT_FUDGE}")} = Trade.StarSystem
+                ORDER BY Candidate.epoch {"DESC" if descending else ""}
+                LIMIT 1
+            )"""
+
+        columns = [col.split()[0] for col in self.SCHEMA]
+        values = {name: "NULL" for name in columns}
+        values.update({
+            name: "Trade." + name for name in (
+                'event_id', 'Type', 'MarketID', 'StarSystem', 'Faction', 'Commodity', 'Commodity_Localised', 'Count',
+                'Inventory', 'Bracket', 'Price', 'TransactEpoch', 'MarketEpoch', 'DockedEpoch'
+            )
+        })
+        values['TickCutoff'] = f"Trade.TransactEpoch + {TICK_CUTOFF}"
+        values['TickWindow'] = f"Trade.TransactEpoch + {TICK_DURATION}"
+        joins = []
+        if self.has("FSDJump"):
+            last_jump = "FROM FSDJump LastJump WHERE LastJump.StarSystem = Trade.StarSystem " \
+                        "ORDER BY LastJump.event_id DESC LIMIT 1"
+            values['Population'] = f"(SELECT LastJump.Population {last_jump})"
+            values['JumpId'] = f"(SELECT LastJump.event_id {last_jump})"
+        if self.has("DetailedTrafficReport"):
+            joins.append(f"""
+                LEFT JOIN DetailedTrafficReport Traffic
+                ON Traffic.epoch = {screenshot("DetailedTrafficReport", TICK_CUTOFF, TICK_DURATION)}
+            """)
+            values.update({
+                'TrafficEpoch': f"Traffic.epoch + {SCREENSHOT_FUDGE}",
+                'TotalTraffic': "Traffic.total",
+                'Ships': "Traffic.ships",
+                'RawTraffic': "replace(Traffic.text, '\n', '\\n')",
+            })
+        if self.has("LocalFactionStatusSummary"):
+            for name, after, before, descending in (("StatusBefore", -TICK_DURATION, TICK_CUTOFF, True),
+                                                    ("StatusAfter", TICK_CUTOFF, TICK_DURATION, False)):
+                joins.append(f"""
+                    LEFT JOIN LocalFactionStatusSummary {name}
+                    ON {name}.faction = upper(Trade.Faction)
+                    AND {name}.epoch = {screenshot("LocalFactionStatusSummary", after, before, descending)}
+                """)
+                values.update({
+                    name + 'Epoch': f"{name}.epoch + {SCREENSHOT_FUDGE}",
+                    'Influence' + name[len("Status"):]: f"{name}.influence",
+                    'Raw' + name: f"replace({name}.text, '\n', '\\n')",
+                })
+        transact = " UNION ALL ".join(f"""
+            SELECT event_id, '{name[len("Market"):]}' Type, MarketID, Type Commodity, Count, epoch TransactEpoch
+            FROM {name}
+            WHERE epoch BETWEEN ? AND ?
+        """ for name in transactions)
+        # MATERIALIZED, or SQLite copies the StarSystem and Faction lookups into every screenshot subquery using them
+        return f"""
+            WITH Trade AS MATERIALIZED (
+                SELECT
+                    Transact.*,
+                    (SELECT StarSystem FROM Market WHERE Market.event_id = MarketItem.event_id) StarSystem,
+                    MarketItem.Name_Localised Commodity_Localised,
+                    CASE Transact.Type WHEN 'Buy' THEN MarketItem.BuyPrice ELSE MarketItem.SellPrice END Price,
+                    CASE Transact.Type WHEN 'Buy' THEN MarketItem.Stock ELSE MarketItem.Demand END Inventory,
+                    CASE Transact.Type WHEN 'Buy' THEN MarketItem.StockBracket
+                        ELSE MarketItem.DemandBracket END Bracket,
+                    MarketItem.epoch MarketEpoch,
+                    json_extract(inflate(Docked.StationFaction), '$.Name') Faction,
+                    Docked.epoch DockedEpoch
+                FROM ({transact}) Transact
+                -- The latest market snapshot and docking at the station before the transaction
+                CROSS JOIN MarketItem
+                ON MarketItem.MarketID = Transact.MarketID
+                AND MarketItem.Commodity = Transact.Commodity
+                AND MarketItem.epoch = {latest_before("MarketItem", "Latest.MarketID = Transact.MarketID "
+                                                                    "AND Latest.Commodity = Transact.Commodity")}
+                CROSS JOIN Docked
+                ON Docked.MarketID = Transact.MarketID
+                AND Docked.epoch = {latest_before("Docked", "Latest.MarketID = Transact.MarketID")}
+            )
+            INSERT OR REPLACE INTO TradeObservation ({", ".join('"%s"' % name for name in columns)})
+            SELECT {", ".join(values[name] for name in columns)}
+            FROM Trade
+            {"".join(joins)}
+        """
+
+
+def enable_shards(writer):
+    # From here on structured_import() writes new events to monthly shards, what is already in the database stays
+    writer.set_schema("shards", "name TEXT PRIMARY KEY", "path TEXT")
+
+
+def structured_import(writer, *args, **kwargs):
+    # The importer for writer's database, which keeps events in monthly shards once enable_shards() has run on it
+    if "shards" in writer.schema_cache:
+        return ShardedImport(writer, *args, **kwargs)
+    return StructuredImport(writer, *args, **kwargs)
+
+
+class ShardedImport:
+    # Imports each event into the shard of its month with a StructuredImport of its own. The shards' writers are
+    # enlisted in writer's, so they commit with it and take its lock, and import checkpoints stay in the main database.
+    def __init__(self, writer, *args, **kwargs):
+        self.writer = writer
+        self.args = args
+        self.kwargs = kwargs
+        self.db_path = next(row[2] for row in writer.execute("PRAGMA database_list") if row[1] == "main")
+        self.importers = {}
+        # The policy is kept in the main database only
+        self.kwargs.setdefault('retention', load_retention(writer))
+
+    def event(self, event):
+        name = shard_name(event.get('timestamp'))
+        importer = self.importers.get(name) or self._open(name)
+        importer.event(event)
+
+    def _open(self, name):
+        path = shard_path(self.db_path, name)
+        conn = connect(path)
+        writer = Writer(conn, self.writer.debug, self.writer.batch_size, self.writer.compress_threshold,
+                        self.writer.instrumentation)
+        self.writer.enlist(writer)
+        upgrade(writer)
+        importer = StructuredImport(writer, *self.args, **self.kwargs)
+        writer.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'events', ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'events')",
+            [shard_id_offset(name)]
+        )
+        self.writer.execute("INSERT OR IGNORE INTO shards (name, path) VALUES (?, ?)", [name, os.path.basename(path)])
+        self.importers[name] = importer
+        return importer
+
+    def state(self):
+        return {name: importer.state() for name, importer in self.importers.items()}
+
+    def restore(self, state):
+        for name, importer in list(self.importers.items()):
+            if name in state:
+                importer.restore(state[name])
+                continue
+            # Opened in the rolled back transaction, which took the shard's tables and its shards row with it
+            self.writer.participants.remove(importer.writer)
+            importer.writer.conn.close()
+            del self.importers[name]
+
+
+class BackgroundWriter:
+    # Imports events on a thread of its own over one long-lived connection, committing them in groups of up to
+    # max_events or every max_delay seconds. submit() never blocks: events are dropped while queue_size are waiting,
+    # or once the thread has stopped on an error, which is kept in last_error.
+    STOP = object()
+
+    def __init__(self, db_path, max_events=256, max_delay=1.0, queue_size=10000, on_error=None):
+        self.db_path = db_path
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.queue = queue.Queue(queue_size)
+        self.on_error = on_error or self._print_error
+        self.last_error = None
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="BackgroundWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, event):
+        # Whether the event was queued
+        if self.thread.is_alive():
+            try:
+                self.queue.put_nowait(event)
+                return True
+            except queue.Full:
+                if self.thread.is_alive():
+                    self.last_error = Exception("%d events waiting to be written, dropping more" % self.queue.maxsize)
+        elif self.last_error is None:
+            self.last_error = Exception("background writer is not running")
+        self.dropped += 1
+        return False
+
+    def stop(self):
+        # Commits everything submitted so far before returning, unless the thread already stopped on an error
+        while self.thread.is_alive():
+            try:
+                self.queue.put(self.STOP, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+
+    def _run(self):
+        # Failures to write a group are handled by _write(), anything else, such as the database failing to open,
+        # stops the thread
+        try:
+            conn = connect(self.db_path)
+            try:
+                with conn:
+                    writer = Writer(conn, False, self.max_events)
+                    importer = structured_import(writer)
+                    self._loop(writer, importer)
+            finally:
+                conn.close()
+        except BaseException as e:
+            self.last_error = e
+            print("background writer for %s stopped" % self.db_path, file=sys.stderr)
+            traceback.print_exc()
+
+    def _loop(self, writer, importer):
+        stopped = False
+        while not stopped:
+            event = self.queue.get()
+            if event is self.STOP:
+                break
+            group = [event]
+            deadline = time.monotonic() + self.max_delay
+            while len(group) < self.max_events:
+                try:
+                    event = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is self.STOP:
+                    stopped = True
+                    break
+                group.append(event)
+            self._write(writer, importer, group)
+
+    def _write(self, writer, importer, group):
+        # StructuredImport.event consumes its argument, so each attempt gets a copy, and the importer is put back as
+        # it was before a failed attempt, e.g. so the retry doesn't take the events it sampled for duplicates
+        state = importer.state()
+        try:
+            with writer.transaction():
+                for event in group:
+                    importer.event(copy.copy(event))
+            self.last_error = None
+        except Exception:
+            importer.restore(state)
+            if len(group) == 1:
+                self.last_error = sys.exc_info()[1]
+                self.on_error(group[0])
+                return
+            # Retry one by one so a single bad event doesn't cost the rest of the group
+            for event in group:
+                self._write(writer, importer, [event])
+
+    @staticmethod
+    def _print_error(event):
+        print("failed to write %s event" % event.get('event'), file=sys.stderr)
+        traceback.print_exc()
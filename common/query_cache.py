@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from personaldb import Rows
+
+# Total size of the cached results, the least recently used go first beyond it
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_path(db_path):
+    # save.db -> save.cache.db next to it
+    stem, suffix = os.path.splitext(db_path)
+    return stem + ".cache" + suffix
+
+
+class QueryCache:
+    # Results of analytics queries kept on disk, so rerunning a report on a database nothing was imported into since
+    # returns them without running the query again. Entries are keyed on the query, its parameters and change_token()
+    # of the database at the time, any import makes a new token and the old entries age out.
+    def __init__(self, path, max_bytes=MAX_BYTES, instrumentation=None):
+        self.max_bytes = max_bytes
+        self.instrumentation = instrumentation
+        self.conn = sqlite3.connect(path)
+        # Losing the latest entries to a crash only means running those queries again, commits needn't wait for disk
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                columns JSON,
+                rows JSON,
+                size INTEGER,
+                used REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def change_token(conn):
+        # Changes whenever what conn reads changes. The size and modification time of every database file attached,
+        # and of its WAL, are what tell: any commit, from this process or another, writes to one of them. The latest
+        # event id is only there to tell imports apart within a file system's mtime resolution.
+        # PRAGMA data_version can't be part of the key: it is only comparable within one connection, and the next
+        # run opens a new one.
+        try:
+            latest = conn.execute("SELECT id FROM events ORDER BY id DESC LIMIT 1").fetchone()
+        except sqlite3.OperationalError:
+            latest = None
+        files = []
+        for _, name, path in conn.execute("PRAGMA database_list"):
+            for file in (path, path + "-wal") if path else ():
+                if os.path.exists(file):
+                    stat = os.stat(file)
+                    files.append([name, file, stat.st_size, stat.st_mtime_ns])
+        return [latest[0] if latest else None, files]
+
+    def rows(self, conn, key, compute):
+        # The rows compute() returns for key, which must be JSON serializable, from the cache if conn's database
+        # hasn't changed since they were stored
+        digest = hashlib.sha256(json.dumps([key, self.change_token(conn)]).encode()).hexdigest()
+        cached = self.conn.execute("SELECT columns, rows FROM results WHERE key = ?", [digest]).fetchone()
+        if cached:
+            self.hits += 1
+            self.conn.execute("UPDATE results SET used = ? WHERE key = ?", [time.time(), digest])
+            self.conn.commit()
+            rows = Rows(tuple(row) for row in json.loads(cached[1]))
+            columns = json.loads(cached[0])
+            rows.description = [(name,) + (None,) * 6 for name in columns] if columns is not None else None
+            return rows
+        self.misses += 1
+        rows = compute()
+        description = getattr(rows, 'description', None)
+        rows = Rows(rows)
+        rows.description = description
+        try:
+            text = json.dumps([list(row) for row in rows])
+        except TypeError:
+            # Such as blobs, returned but not cached
+            return rows
+        columns = json.dumps([col[0] for col in description] if description else None)
+        if len(text) <= self.max_bytes:
+            self.conn.execute("INSERT OR REPLACE INTO results (key, columns, rows, size, used) VALUES (?, ?, ?, ?, ?)",
+                              [digest, columns, text, len(text), time.time()])
+            self.evict()
+            self.conn.commit()
+        return rows
+
+    def query(self, conn, sql, *values):
+        # conn.execute(sql, *values).fetchall() through the cache, as Rows keeping the cursor's description
+        def compute():
+            if self.instrumentation:
+                return self.instrumentation.query(conn, sql, *values)
+            cursor = conn.execute(sql, *values)
+            rows = Rows(cursor.fetchall())
+            rows.description = cursor.description
+            return rows
+        return self.rows(conn, [sql] + [list(value) for value in values], compute)
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY used").fetchall():
+            self.conn.execute("DELETE FROM results WHERE key = ?", [key])
+            total -= size
+            if total <= self.max_bytes:
+                break
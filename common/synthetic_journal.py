@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import heapq
+import json
+import os
+import random
+
+# Journal lines per generated file, the game starts a new one each session
+FILE_EVENTS = 20000
+START = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+COMMODITIES = [
+    ("Gold", "Metals"), ("Silver", "Metals"), ("Palladium", "Metals"), ("Tea", "Foods"), ("Beer", "Legal Drugs"),
+    ("Hydrogen Fuel", "Chemicals"), ("Water", "Chemicals"), ("Grain", "Foods"), ("Fish", "Foods"),
+    ("Tritium", "Chemicals"), ("Bertrandite", "Minerals"), ("Indite", "Minerals"), ("Gallite", "Minerals"),
+    ("Consumer Technology", "Consumer Items"), ("Clothing", "Consumer Items"), ("Robotics", "Machinery"),
+    ("Power Generators", "Machinery"), ("Medical Diagnostic Equipment", "Technology"), ("Polymers", "Industrial"),
+    ("Semiconductors", "Industrial"), ("Superconductors", "Industrial"), ("Liquor", "Legal Drugs"),
+    ("Wine", "Legal Drugs"), ("Biowaste", "Waste"), ("Scrap", "Waste"),
+]
+MATERIALS = ["iron", "nickel", "sulphur", "carbon", "chromium", "manganese", "phosphorus", "zinc", "germanium",
+             "vanadium", "selenium", "arsenic", "cadmium", "niobium", "tin", "mercury", "tungsten", "polonium"]
+PLANET_CLASSES = ["Icy body", "Rocky body", "High metal content body", "Rocky ice body",
+                  "Gas giant with water based life", "Sudarsky class I gas giant", "Water world", "Earthlike body",
+                  "Metal rich body"]
+STAR_TYPES = ["G", "K", "M", "F", "A", "B", "L", "T", "Y", "TTS", "DA", "N"]
+SIGNALS = [("$SAA_SignalType_Geological;", "Geological"), ("$SAA_SignalType_Biological;", "Biological"),
+           ("$SAA_SignalType_Human;", "Human")]
+SHIPS = ["Anaconda", "Python", "Type-9 Heavy", "Krait Mk II", "Federal Corvette", "Imperial Cutter", "Sidewinder",
+         "Asp Explorer", "Cobra Mk III", "Viper Mk III"]
+STATES = ["Boom", "Bust", "Civil War", "Election", "Expansion", "Investment", "Lockdown", "None", "Outbreak"]
+NEWS_TYPES = ["DetailedTrafficReport", "LocalFactionStatusSummary", "LocalBountyReport", "LocalTradeReport"]
+
+# Relative frequency of each kind of event, roughly as they turn up in real journals.
+# Statistics and the events around it are written once per session, see SyntheticJournal.session().
+WEIGHTS = [
+    ("Music", 12), ("ReceiveText", 10), ("Scan", 14), ("FSSSignalDiscovered", 8), ("FSDTarget", 4),
+    ("StartJump", 4), ("FSDJump", 4), ("FuelScoop", 3), ("SupercruiseEntry", 3), ("SupercruiseExit", 3),
+    ("SAASignalsFound", 2), ("MaterialCollected", 3), ("ShipTargeted", 4), ("Bounty", 2), ("DockingRequested", 2),
+    ("DockingGranted", 2), ("Docked", 2), ("Undocked", 2), ("Market", 2), ("MarketBuy", 2), ("MarketSell", 2),
+    ("MissionAccepted", 1), ("MissionCompleted", 1), ("News", 2),
+]
+
+
+class SyntheticJournal:
+    # A seeded stream of journal events with the mix, sizes and cross-references (systems, markets, bodies)
+    # of real play: big Market item lists, Statistics per session, Scan details and news OCR events.
+    def __init__(self, seed=0, systems=500, markets=2000):
+        self.random = random.Random(seed)
+        self.time = START
+        self.systems = ["Synthetic %d" % i for i in range(systems)]
+        self.addresses = {system: 1013 * i for i, system in enumerate(self.systems)}
+        self.markets = {3220000000 + i: self.systems[i % systems] for i in range(markets)}
+        self.market_ids = list(self.markets)
+        self.system = self.systems[0]
+        self.market_id = self.market_ids[0]
+        self.body = 0
+        self.mission = 0
+        self.kinds = [kind for kind, _ in WEIGHTS]
+        self.weights = [weight for _, weight in WEIGHTS]
+
+    def events(self, count, session_length=2000):
+        produced = 0
+        while produced < count:
+            for event in self.session(session_length):
+                if produced >= count:
+                    return
+                yield event
+                produced += 1
+
+    def session(self, length):
+        for event in (self.event("Fileheader"), self.event("LoadGame"), self.statistics(), self.event("Materials")):
+            yield event
+        for kind in self.random.choices(self.kinds, self.weights, k=length - 5):
+            if kind == "News":
+                yield self.news()
+            elif hasattr(self, kind):
+                yield getattr(self, kind)()
+            else:
+                yield self.event(kind)
+        yield self.event("Shutdown")
+
+    def timestamp(self):
+        self.time += datetime.timedelta(seconds=self.random.randint(1, 40))
+        return self.time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def event(self, kind, **fields):
+        return {"timestamp": self.timestamp(), "event": kind, **fields}
+
+    def FSDJump(self, system=None):
+        self.system = system or self.random.choice(self.systems)
+        return self.event(
+            "FSDJump",
+            StarSystem=self.system,
+            SystemAddress=self.addresses[self.system],
+            StarPos=[round(self.random.uniform(-1000, 1000), 5) for _ in range(3)],
+            SystemAllegiance=self.random.choice(["Federation", "Empire", "Alliance", "Independent"]),
+            SystemEconomy_Localised=self.random.choice(["Industrial", "Extraction", "Refinery", "Agriculture"]),
+            Population=self.random.randint(0, 10 ** 9),
+            JumpDist=round(self.random.uniform(5, 60), 3),
+            FuelUsed=round(self.random.uniform(0.5, 8), 6),
+            FuelLevel=round(self.random.uniform(8, 32), 6),
+            Factions=[
+                {
+                    "Name": "%s Faction %d" % (self.system, i),
+                    "FactionState": self.random.choice(STATES),
+                    "Government": "Democracy",
+                    "Influence": round(self.random.random(), 6),
+                    "Allegiance": "Independent",
+                    "Happiness_Localised": "Happy",
+                    "MyReputation": round(self.random.uniform(-100, 100), 6),
+                }
+                for i in range(self.random.randint(1, 7))
+            ],
+        )
+
+    def Docked(self, market_id=None):
+        self.market_id = market_id or self.random.choice(self.market_ids)
+        self.system = self.markets[self.market_id]
+        return self.event(
+            "Docked",
+            StationName="Station %d" % self.market_id,
+            StationType="Coriolis",
+            StarSystem=self.system,
+            MarketID=self.market_id,
+            StationFaction={"Name": "%s Faction %d" % (self.system, self.market_id % 7), "FactionState": "Boom"},
+            StationGovernment_Localised="Democracy",
+            StationServices=["dock", "autodock", "commodities", "contacts", "missions", "outfitting", "rearm",
+                             "refuel", "repair", "shipyard", "tuning", "engineer", "facilitator"],
+            StationEconomies=[{"Name": "$economy_Industrial;", "Proportion": 0.8}],
+            DistFromStarLS=round(self.random.uniform(10, 5000), 3),
+        )
+
+    def Market(self):
+        # A Market.json snapshot, as --follow imports it, rather than the journal line pointing at the file
+        items = []
+        for i, (name, category) in enumerate(COMMODITIES[:self.random.randint(10, len(COMMODITIES))]):
+            items.append({
+                "id": 128049152 + i,
+                "Name": "$%s_name;" % name.lower().replace(" ", ""),
+                "Name_Localised": name,
+                "Category": "$MARKET_category_%s;" % category.lower().replace(" ", "_"),
+                "Category_Localised": category,
+                "BuyPrice": self.random.randint(10, 10000),
+                "SellPrice": self.random.randint(10, 10000),
+                "MeanPrice": self.random.randint(10, 10000),
+                "StockBracket": self.random.randint(0, 3),
+                "DemandBracket": self.random.randint(0, 3),
+                "Stock": self.random.randint(0, 50000),
+                "Demand": self.random.randint(0, 50000),
+                "Consumer": self.random.random() < 0.5,
+                "Producer": self.random.random() < 0.5,
+                "Rare": False,
+            })
+        return self.event("Market", MarketID=self.market_id, StationName="Station %d" % self.market_id,
+                          StarSystem=self.system, Items=items)
+
+    def transaction(self, kind, price_key, name=None):
+        name = name or self.random.choice(COMMODITIES)[0]
+        count = self.random.randint(1, 700)
+        price = self.random.randint(10, 10000)
+        return self.event(kind, MarketID=self.market_id, Type=name.lower().replace(" ", ""), Type_Localised=name,
+                          Count=count, **{price_key: price})
+
+    def MarketBuy(self, name=None):
+        return self.transaction("MarketBuy", "BuyPrice", name)
+
+    def MarketSell(self, name=None):
+        return self.transaction("MarketSell", "SellPrice", name)
+
+    def Scan(self):
+        self.body += 1
+        body = {
+            "ScanType": "Detailed",
+            "BodyName": "%s %d" % (self.system, self.body),
+            "BodyID": self.body % 80,
+            "Parents": [{"Star": 0}],
+            "StarSystem": self.system,
+            "DistanceFromArrivalLS": round(self.random.uniform(0, 10000), 6),
+            "Radius": round(self.random.uniform(1e5, 1e8), 3),
+            "SurfaceTemperature": round(self.random.uniform(20, 40000), 6),
+            "SemiMajorAxis": round(self.random.uniform(1e8, 1e13), 3),
+            "Eccentricity": round(self.random.random(), 6),
+            "OrbitalInclination": round(self.random.uniform(-90, 90), 6),
+            "Periapsis": round(self.random.uniform(0, 360), 6),
+            "OrbitalPeriod": round(self.random.uniform(1e4, 1e9), 3),
+            "RotationPeriod": round(self.random.uniform(1e4, 1e7), 3),
+            "AxialTilt": round(self.random.uniform(-3, 3), 6),
+            "WasDiscovered": self.random.random() < 0.7,
+            "WasMapped": self.random.random() < 0.2,
+        }
+        if self.random.random() < 0.25:
+            body.update({
+                "StarType": self.random.choice(STAR_TYPES),
+                "Subclass": self.random.randint(0, 9),
+                "StellarMass": round(self.random.uniform(0.1, 50), 6),
+                "AbsoluteMagnitude": round(self.random.uniform(-5, 20), 6),
+                "Age_MY": self.random.randint(1, 13000),
+                "Luminosity": self.random.choice(["V", "Va", "Vab", "IV", "III"]),
+            })
+        else:
+            percents = [self.random.random() for _ in range(self.random.randint(5, 9))]
+            body.update({
+                "TidalLock": self.random.random() < 0.5,
+                "TerraformState": "",
+                "PlanetClass": self.random.choice(PLANET_CLASSES),
+                "Atmosphere": "thin sulphur dioxide atmosphere",
+                "AtmosphereComposition": [{"Name": "SulphurDioxide", "Percent": 100.0}],
+                "Volcanism": "",
+                "MassEM": round(self.random.uniform(0.001, 300), 6),
+                "SurfaceGravity": round(self.random.uniform(0.1, 30), 6),
+                "SurfacePressure": round(self.random.uniform(0, 1e6), 6),
+                "Landable": self.random.random() < 0.4,
+                "Materials": [
+                    {"Name": name, "Percent": round(100 * p / sum(percents), 6)}
+                    for name, p in zip(self.random.sample(MATERIALS, len(percents)), percents)
+                ],
+                "Composition": {"Ice": 0.1, "Rock": 0.6, "Metal": 0.3},
+            })
+        return self.event("Scan", **body)
+
+    def SAASignalsFound(self):
+        return self.event(
+            "SAASignalsFound",
+            BodyName="%s %d" % (self.system, self.body),
+            SystemAddress=self.addresses[self.system],
+            BodyID=self.body % 80,
+            Signals=[
+                {"Type": signal, "Type_Localised": localised, "Count": self.random.randint(1, 6)}
+                for signal, localised in self.random.sample(SIGNALS, self.random.randint(1, len(SIGNALS)))
+            ],
+        )
+
+    def ReceiveText(self):
+        return self.event("ReceiveText", From="$npc_name_decorate:#name=Synthetic %d;" % self.random.randint(0, 999),
+                          Message="$Pirate_OnStartScanCargo%02d;" % self.random.randint(1, 9),
+                          Message_Localised="Let's see what you've got in your hold.", Channel="npc")
+
+    def Music(self):
+        return self.event("Music", MusicTrack=self.random.choice(["Exploration", "Supercruise", "Combat_Dogfight",
+                                                                  "DestinationFromHyperspace", "NoTrack"]))
+
+    def MissionAccepted(self):
+        self.mission += 1
+        return self.event("MissionAccepted", Faction="%s Faction 1" % self.system, Name="Mission_Delivery",
+                          LocalisedName="Deliver cargo", Commodity="$Gold_Name;", Count=self.random.randint(1, 50),
+                          DestinationSystem=self.random.choice(self.systems), Expiry=self.time.isoformat(),
+                          Wing=False, Influence="++", Reputation="++", Reward=self.random.randint(1000, 10 ** 6),
+                          MissionID=self.mission)
+
+    def MissionCompleted(self):
+        return self.event("MissionCompleted", Faction="%s Faction 1" % self.system, Name="Mission_Delivery",
+                          MissionID=self.mission, Reward=self.random.randint(1000, 10 ** 6),
+                          FactionEffects=[{"Faction": "%s Faction 1" % self.system, "Effects": [],
+                                           "Influence": [{"SystemAddress": 1013, "Trend": "UpGood",
+                                                          "Influence": "++"}],
+                                           "ReputationTrend": "UpGood", "Reputation": "+"}])
+
+    def statistics(self):
+        # One of the largest events in any journal: a dozen sections of lifetime counters
+        sections = ["Bank_Account", "Combat", "Crime", "Smuggling", "Trading", "Mining", "Exploration", "Passengers",
+                    "Search_And_Rescue", "Crafting", "Crew", "Multicrew", "Material_Trader_Stats", "CQC", "Exobiology"]
+        return self.event("Statistics", **{
+            section: {"%s_Stat_%d" % (section, i): self.random.randint(0, 10 ** 9) for i in range(15)}
+            for section in sections
+        })
+
+    def news(self, kind=None, faction=None):
+        # News screenshots are OCRed by ocr.py, which imports these events the way import_news_results builds them
+        kind = kind or self.random.choice(NEWS_TYPES)
+        event = self.event(kind, index=self.random.randint(0, 5))
+        if kind == "DetailedTrafficReport":
+            ships = {ship: self.random.randint(1, 50) for ship in self.random.sample(SHIPS, 5)}
+            event["total"] = sum(ships.values())
+            event["ships"] = ships
+            event["text"] = "DETAILED TRAFFIC REPORT\n%d ships have passed through, as follows:\n%s" % (
+                event["total"], "\n".join("%s - %d" % item for item in ships.items()))
+        elif kind == "LocalFactionStatusSummary":
+            event["faction"] = faction or "%s FACTION %d" % (self.system.upper(), self.random.randint(0, 6))
+            event["influence"] = round(self.random.uniform(0, 100), 1)
+            event["text"] = "%s STATUS SUMMARY\ninfluence: %s" % (event["faction"], event["influence"])
+        elif kind == "LocalBountyReport":
+            event["value"] = self.random.randint(0, 10 ** 7)
+            event["text"] = "LOCAL BOUNTY REPORT\n%d credits" % event["value"]
+        else:
+            event["text"] = "LOCAL TRADE REPORT\n" + "\n".join(name for name, _ in self.random.sample(COMMODITIES, 5))
+        return event
+
+
+class TradeJournal(SyntheticJournal):
+    # SyntheticJournal with the play trade_data analyses mixed in: every visit_every events a visit to a station,
+    # screenshotting its faction's influence and the system traffic before checking the market and trading, and
+    # a return to the station between one and six hours after the next tick to screenshot them again
+    def __init__(self, seed=0, visit_every=100, **kwargs):
+        super().__init__(seed, **kwargs)
+        self.visit_every = visit_every
+        # (time, market id) of the return visits to make
+        self.returns = []
+
+    def events(self, count, session_length=2000):
+        produced = 0
+        for i, event in enumerate(super().events(count, session_length)):
+            for event in [event] + (self.visit() if i % self.visit_every == self.visit_every - 1 else []):
+                if produced >= count:
+                    return
+                yield event
+                produced += 1
+
+    def visit(self):
+        if self.returns and self.returns[0][0] <= self.time:
+            _, market_id = heapq.heappop(self.returns)
+        else:
+            market_id = self.random.choice(self.market_ids)
+            heapq.heappush(self.returns, (self.time + datetime.timedelta(hours=self.random.randint(5, 10)), market_id))
+        system = self.markets[market_id]
+        events = [
+            self.FSDJump(system),
+            self.Docked(market_id),
+            self.news("LocalFactionStatusSummary", "%s FACTION %d" % (system.upper(), market_id % 7)),
+            self.news("DetailedTrafficReport"),
+            self.Market(),
+        ]
+        names = [item["Name_Localised"] for item in events[-1]["Items"]]
+        for _ in range(self.random.randint(1, 3)):
+            events.append(self.random.choice([self.MarketBuy, self.MarketSell])(self.random.choice(names)))
+        return events
+
+
+def write_journals(path, count, seed=0):
+    # Writes count events as Journal.<date>.01.log files of FILE_EVENTS lines, returning their paths.
+    # News OCR events aren't journal lines, they are written alongside so every benchmark sees the same mix.
+    os.makedirs(path, exist_ok=True)
+    paths = []
+    file = None
+    try:
+        for i, event in enumerate(SyntheticJournal(seed).events(count)):
+            if i % FILE_EVENTS == 0:
+                if file:
+                    file.close()
+                timestamp = event["timestamp"]
+                name = "Journal.%sT%s.01.log" % (timestamp[:10], timestamp[11:19].replace(":", ""))
+                paths.append(os.path.join(path, name))
+                file = open(paths[-1], 'w')
+            file.write(json.dumps(event) + "\r\n")
+    finally:
+        if file:
+            file.close()
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic journal files for benchmarks")
+    parser.add_argument("path", help="Directory to write the journal files to")
+    parser.add_argument("--events", type=int, default=100000, help="Number of events to generate")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the random generator, the same seed gives the same files")
+    args = parser.parse_args()
+    for path in write_journals(args.path, args.events, args.seed):
+        print(path)
@@ -0,0 +1,39 @@
+import argparse
+import contextlib
+import io
+import json
+import sqlite3
+import unittest
+
+import benchmark_trade_data
+
+
+def recorded_version():
+    try:
+        with open(benchmark_trade_data.PLANS_PATH) as file:
+            return json.load(file).get("sqlite_version")
+    except FileNotFoundError:
+        return None
+
+
+@unittest.skipUnless(recorded_version() == sqlite3.sqlite_version,
+                     "no query plans recorded for SQLite %s" % sqlite3.sqlite_version)
+class PlansTest(unittest.TestCase):
+    # The benchmark at sizes small enough for every run, failing as it would at full size on a changed plan
+    def test_plans(self):
+        options = argparse.Namespace(
+            events=[2000, 8000],
+            seed=0,
+            engines=[name for name, _ in benchmark_trade_data.ENGINES],
+            repeat=1,
+            max_exponent=benchmark_trade_data.MAX_EXPONENT,
+            db_dir=None,
+            update_plans=False,
+        )
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            failures = benchmark_trade_data.benchmark(options)
+        self.assertEqual(failures, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import compact
+from personaldb import Writer, connect, enable_shards, load_retention, structured_import
+from test_personaldb import NOISE, POLICY
+
+# Another month's events, kept in a shard of their own
+LATER = [{**event, "timestamp": "2022-04" + event["timestamp"][7:]} for event in NOISE]
+
+
+class CompactTest(unittest.TestCase):
+    # compact() applies the policy to the save database and each of its shards, and stores it for later imports
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "save.db")
+        conn = connect(self.db_path)
+        writer = Writer(conn, False)
+        with writer.transaction():
+            importer = structured_import(writer, retention={})
+            for event in NOISE:
+                importer.event(dict(event))
+            enable_shards(writer)
+        with writer.transaction():
+            importer = structured_import(writer, retention={})
+            for event in LATER:
+                importer.event(dict(event))
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def types(self):
+        conn = connect(self.db_path, readonly=True, since="2022-01")
+        try:
+            return [event_type for event_type, in conn.execute("SELECT type FROM events ORDER BY id")]
+        finally:
+            conn.close()
+
+    def compact(self, dry_run=False):
+        with contextlib.redirect_stdout(io.StringIO()) as report:
+            compact.compact(self.db_path, os.path.join(self.tmp.name, "archive.db"), dry_run, POLICY)
+        return report.getvalue()
+
+    def test_dry_run(self):
+        before = self.types()
+        self.assertIn("Music", self.compact(dry_run=True))
+        self.assertEqual(self.types(), before)
+
+    def test_compact(self):
+        self.compact()
+        # Each month keeps the first FuelScoop of each minute and the Scan, its ReceiveText are long past 30 days
+        self.assertEqual(self.types(), ["FuelScoop", "FuelScoop", "Scan"] * 2)
+        archive = connect(os.path.join(self.tmp.name, "archive.db"), readonly=True)
+        try:
+            self.assertEqual(archive.execute("SELECT COUNT(*) FROM events WHERE type = 'ReceiveText'").fetchone(), (4,))
+        finally:
+            archive.close()
+        conn = connect(self.db_path)
+        try:
+            self.assertEqual(load_retention(Writer(conn, False)), POLICY)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import import_journal
+from personaldb import connect
+from watch import PollWatcher
+
+JOURNAL = "Journal.2022-01-01T000000.01.log"
+
+
+def journal_line(body_name, second):
+    return json.dumps({
+        "timestamp": "2022-01-01T00:00:%02dZ" % second,
+        "event": "Scan",
+        "BodyName": body_name,
+    }) + "\n"
+
+
+class JournalTest(unittest.TestCase):
+    # A journal directory in a temp dir, written to as the game would
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.save_path = os.path.join(self.tmp.name, "journals")
+        os.mkdir(self.save_path)
+        self.db_path = os.path.join(self.tmp.name, "save.db")
+        self.journal = os.path.join(self.save_path, JOURNAL)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def append(self, *lines):
+        with open(self.journal, 'a') as file:
+            file.writelines(lines)
+
+    def bodies(self):
+        if not os.path.exists(self.db_path):
+            return []
+        conn = connect(self.db_path, readonly=True)
+        try:
+            return [name for name, in conn.execute("SELECT BodyName FROM Scan ORDER BY event_id")]
+        except sqlite3.OperationalError:
+            # Nothing imported yet
+            return []
+        finally:
+            conn.close()
+
+
+
+class CheckpointTest(JournalTest):
+    # Bulk imports resume each file from the size, mtime and offset recorded by the last one
+    def import_journal(self):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as stderr:
+            import_journal.import_save_to_db(self.save_path, self.db_path)
+        return stderr.getvalue()
+
+    def imports(self):
+        conn = connect(self.db_path, readonly=True)
+        try:
+            return conn.execute('SELECT key, count, size, mtime, "offset" FROM imports').fetchall()
+        finally:
+            conn.close()
+
+    def test_unchanged(self):
+        self.append(journal_line("A 1", 0), journal_line("A 2", 1))
+        self.import_journal()
+        imports = self.imports()
+        self.assertEqual([row[1:3] for row in imports], [(2, os.path.getsize(self.journal))])
+        # Not even read again
+        with mock.patch.object(import_journal, "load_file") as load_file:
+            self.import_journal()
+        load_file.assert_not_called()
+        self.assertEqual(self.bodies(), ["A 1", "A 2"])
+        self.assertEqual(self.imports(), imports)
+
+    def test_appended(self):
+        self.append(journal_line("A 1", 0))
+        self.import_journal()
+        # A line still being written is left for the next import
+        line = journal_line("A 3", 2)
+        self.append(journal_line("A 2", 1), line[:10])
+        self.import_journal()
+        self.assertEqual(self.bodies(), ["A 1", "A 2"])
+        self.append(line[10:])
+        self.import_journal()
+        self.assertEqual(self.bodies(), ["A 1", "A 2", "A 3"])
+
+    def test_truncated(self):
+        self.append(journal_line("A 1", 0), journal_line("A 2", 1))
+        self.import_journal()
+        # Replaced by a shorter file, the lines it holds can't be told apart from those already imported
+        os.remove(self.journal)
+        self.append(journal_line("B 1", 2))
+        self.assertIn("shrank below", self.import_journal())
+        self.assertEqual(self.bodies(), ["A 1", "A 2"])
+
+
+class FollowTest(JournalTest):
+    # follow() run on a thread against the journal directory
+    def wait_for(self, expected, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.bodies() == expected:
+                return
+            time.sleep(0.05)
+        self.assertEqual(self.bodies(), expected)
+
+    def start(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=import_journal.follow, args=(self.save_path, self.db_path),
+                                  kwargs={"stop": stop})
+        thread.start()
+        return stop, thread
+
+    def follow_appends(self):
+        self.append(journal_line("A 1", 0))
+        stop, thread = self.start()
+        try:
+            self.wait_for(["A 1"])
+            self.append(journal_line("A 2", 1), journal_line("A 3", 2))
+            self.wait_for(["A 1", "A 2", "A 3"])
+            # A line still being written is left until its newline arrives
+            with open(self.journal, 'a') as file:
+                line = journal_line("A 4", 3)
+                file.write(line[:10])
+                file.flush()
+                time.sleep(0.3)
+                self.assertEqual(self.bodies(), ["A 1", "A 2", "A 3"])
+                file.write(line[10:])
+            self.wait_for(["A 1", "A 2", "A 3", "A 4"])
+        finally:
+            stop.set()
+            thread.join()
+        # Restarted, it carries on from the checkpoint without reading anything twice
+        self.append(journal_line("A 5", 4))
+        stop, thread = self.start()
+        try:
+            self.wait_for(["A 1", "A 2", "A 3", "A 4", "A 5"])
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_follow(self):
+        self.follow_appends()
+
+    def test_follow_polling(self):
+        with mock.patch.object(import_journal, "watch", PollWatcher):
+            self.follow_appends()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,362 @@
+import copy
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from personaldb import (
+    BackgroundWriter, Retention, Writer, StructuredImport, apply_retention, connect, enable_shards, migrate_snapshots,
+    set_retention, shard_id_offset, shard_path, structured_import, upgrade
+)
+from personal_best import Reader
+from synthetic_journal import SyntheticJournal, TradeJournal
+from trade_data import trade_query
+
+
+def outfitting(second, items, market_id=1):
+    return {
+        "timestamp": "2022-01-01T00:00:%02dZ" % second,
+        "event": "Outfitting",
+        "MarketID": market_id,
+        "StationName": "Station %d" % market_id,
+        "Items": items,
+    }
+
+
+def modules(count, price=100):
+    return [{"id": 128049000 + i, "Name": "module_%d" % i, "BuyPrice": price + i} for i in range(count)]
+
+
+class DatabaseTest(unittest.TestCase):
+    # A database in a temp dir, written through a Writer the way import_journal writes it
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "save.db")
+        self.conn = connect(self.db_path)
+        self.writer = Writer(self.conn, False)
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def import_events(self, importer, *events):
+        with self.writer.transaction():
+            for event in events:
+                importer.event(dict(event))
+
+    def query(self, sql, *args):
+        return self.conn.execute(sql, args).fetchall()
+
+
+class SnapshotTest(DatabaseTest):
+    def items(self):
+        return [json.loads(items) for items, in self.query("SELECT Items FROM Outfitting ORDER BY event_id")]
+
+    def test_dedupes_by_content(self):
+        items = modules(3)
+        # The same list serialized with its keys in another order
+        reordered_keys = [dict(reversed(list(item.items()))) for item in items]
+        self.import_events(StructuredImport(self.writer), outfitting(0, items), outfitting(1, reordered_keys))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM snapshots"), [(1,)])
+        self.assertEqual(self.items(), [items, items])
+
+    def test_deltas_round_trip(self):
+        self.assertEqual(self.import_deltas(), self.items())
+
+    def test_compressed_deltas_round_trip(self):
+        self.writer.compress_threshold = 64
+        self.assertEqual(self.import_deltas(), self.items())
+        self.assertEqual(self.query("SELECT typeof(payload), base IS NULL FROM snapshots ORDER BY rowid"),
+                         [("blob", 1), ("blob", 0), ("blob", 0)])
+
+    def import_deltas(self):
+        base = modules(40)
+        changed = [dict(item) for item in base[1:]]
+        changed[5]["BuyPrice"] = 1
+        del changed[6]["BuyPrice"]
+        # Items moved around and one added, besides the ones changed and the one removed
+        changed[0], changed[10] = changed[10], changed[0]
+        changed.insert(3, {"id": 128049999, "Name": "module_new", "BuyPrice": 5})
+        lists = [base, changed, base[::-1]]
+        self.import_events(StructuredImport(self.writer, snapshot_deltas=True),
+                           *(outfitting(second, items) for second, items in enumerate(lists)))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM snapshots WHERE base IS NOT NULL"), [(2,)])
+        return lists
+
+    def test_migrated_snapshots_dedupe(self):
+        items = modules(3)
+        # An inline table from before snapshots, holding the list with its keys in another order
+        reordered_keys = [dict(reversed(list(item.items()))) for item in items]
+        with self.writer.transaction():
+            self.writer.set_schema("events", "id INTEGER PRIMARY KEY AUTOINCREMENT", "timestamp TIMESTAMP",
+                                   "type TEXT", "event JSON")
+            event_id = self.writer.insert("events", timestamp="2022-01-01T00:00:00Z", type="Outfitting",
+                                          event=json.dumps(outfitting(0, items))).lastrowid
+            self.writer.set_schema("Outfitting", "event_id INTEGER", "MarketID INTEGER", "Items JSON")
+            self.writer.insert("Outfitting", event_id=event_id, MarketID=1, Items=json.dumps(reordered_keys))
+            migrate_snapshots(self.writer)
+        self.import_events(StructuredImport(self.writer), outfitting(1, items))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM snapshots"), [(1,)])
+        self.assertEqual(self.items(), [items, items])
+
+
+class BackgroundWriterTest(DatabaseTest):
+    # A group failing part way is retried event by event with the importer as it was before the group
+    def write(self, *events):
+        failed = []
+        background = BackgroundWriter(self.db_path, max_delay=10, on_error=failed.append)
+        for event in events:
+            background.submit(event)
+        background.stop()
+        return failed
+
+    def stored(self, table):
+        conn = connect(self.db_path, readonly=True)
+        try:
+            return [timestamp for timestamp, in conn.execute("SELECT timestamp FROM events WHERE type = ? ORDER BY id",
+                                                             [table])]
+        finally:
+            conn.close()
+
+    def test_retry_after_failure(self):
+        with self.writer.transaction():
+            StructuredImport(self.writer)
+            set_retention(self.writer, {"FuelScoop": Retention("sample", interval=60)})
+        # Not JSON serializable, so the event fails to be written
+        bad = {"timestamp": "2022-01-01T00:00:10Z", "event": "Scan", "BodyName": object()}
+        scoop = {"timestamp": "2022-01-01T00:00:00Z", "event": "FuelScoop", "Scooped": 1.5}
+        self.assertEqual(self.write(scoop, bad), [bad])
+        self.assertEqual(self.stored("FuelScoop"), ["2022-01-01T00:00:00Z"])
+
+    def test_retry_in_new_shard(self):
+        with self.writer.transaction():
+            StructuredImport(self.writer)
+            enable_shards(self.writer)
+        bad = {"timestamp": "2022-01-01T00:00:10Z", "event": "Scan", "BodyName": object()}
+        scan = {"timestamp": "2022-01-01T00:00:00Z", "event": "Scan", "BodyName": "A 1"}
+        self.assertEqual(self.write(scan, bad), [bad])
+        self.assertEqual(self.stored("Scan"), ["2022-01-01T00:00:00Z"])
+
+
+class VirtualTest(DatabaseTest):
+    # Event types stored as views over events read back as they do from tables of their own
+    def test_views_match_tables(self):
+        events = list(SyntheticJournal(seed=2).events(3000)) + list(TradeJournal(seed=3, visit_every=10).events(600))
+        self.import_events(StructuredImport(self.writer), *copy.deepcopy(events))
+        virtual_path = os.path.join(self.tmp.name, "virtual.db")
+        virtual = connect(virtual_path)
+        try:
+            writer = Writer(virtual, False)
+            with writer.transaction():
+                importer = StructuredImport(writer, virtual=True)
+                for event in events:
+                    importer.event(dict(event))
+            views = sorted(writer.virtual_schema)
+            self.assertIn("MarketBuy", views)
+            for view in views:
+                columns = ",".join('"%s"' % row[1] for row in self.query("PRAGMA table_info(%s)" % view))
+                sql = "SELECT %s FROM %s ORDER BY event_id" % (columns, view)
+                rows = self.query(sql)
+                self.assertTrue(rows, view)
+                # Nested values come back minified from the views
+                self.assertEqual([self.normalized(row) for row in virtual.execute(sql)],
+                                 [self.normalized(row) for row in rows], view)
+            for sql in (trade_query(), Reader.MATERIAL_QUERY):
+                rows = self.query(sql)
+                self.assertTrue(rows)
+                self.assertEqual([self.normalized(row) for row in virtual.execute(sql)],
+                                 [self.normalized(row) for row in rows])
+        finally:
+            virtual.close()
+
+    @staticmethod
+    def normalized(row):
+        return tuple(json.loads(v) if isinstance(v, str) and v[:1] in ('[', '{') else v for v in row)
+
+
+POLICY = {
+    "Music": Retention("drop"),
+    "FuelScoop": Retention("sample", interval=60),
+    "ReceiveText": Retention("archive", days=30),
+}
+
+
+def noise(timestamp, event_type):
+    return {"timestamp": timestamp, "event": event_type}
+
+
+# Events of each type POLICY has a rule for, and one it leaves alone
+NOISE = [
+    noise("2022-01-01T00:00:00Z", "Music"),
+    noise("2022-01-01T00:00:10Z", "FuelScoop"),
+    noise("2022-01-01T00:00:50Z", "FuelScoop"),
+    noise("2022-01-01T00:01:05Z", "FuelScoop"),
+    noise("2022-01-01T00:01:30Z", "Music"),
+    noise("2022-01-01T00:02:00Z", "ReceiveText"),
+    noise("2022-02-20T00:00:00Z", "ReceiveText"),
+    noise("2022-02-20T00:00:10Z", "Scan"),
+]
+# The timestamps of those importing with POLICY keeps
+KEPT = ["2022-01-01T00:00:10Z", "2022-01-01T00:01:05Z", "2022-01-01T00:02:00Z", "2022-02-20T00:00:00Z",
+        "2022-02-20T00:00:10Z"]
+# ReceiveText over 30 days old by then
+NOW = StructuredImport.epoch("2022-03-01T00:00:00Z")
+
+
+class RetentionTest(DatabaseTest):
+    def timestamps(self, conn=None):
+        return [timestamp for timestamp, in (conn or self.conn).execute("SELECT timestamp FROM events ORDER BY id")]
+
+    def test_import(self):
+        importer = StructuredImport(self.writer, retention=POLICY)
+        # Checking an event changes nothing, only importing it does
+        for _ in range(2):
+            self.assertTrue(importer.retains("FuelScoop", noise("2022-01-01T00:00:10Z", "FuelScoop")))
+            self.assertFalse(importer.retains("Music", noise("2022-01-01T00:00:00Z", "Music")))
+        self.assertEqual(importer.sample_intervals, {})
+        self.import_events(importer, *NOISE)
+        self.assertEqual(self.timestamps(), KEPT)
+
+    def test_compaction(self):
+        self.import_events(StructuredImport(self.writer, retention={}), *NOISE)
+        archive_path = os.path.join(self.tmp.name, "archive.db")
+        self.assertEqual(apply_retention(self.writer, archive_path, POLICY, now=NOW, dry_run=True),
+                         {"Music": (2, 0), "FuelScoop": (1, 0), "ReceiveText": (1, 1)})
+        self.assertEqual(len(self.timestamps()), len(NOISE))
+        apply_retention(self.writer, archive_path, POLICY, now=NOW)
+        # What sampling at import would have kept, less the archived ReceiveText
+        self.assertEqual(self.timestamps(), [timestamp for timestamp in KEPT if timestamp != "2022-01-01T00:02:00Z"])
+        archive = connect(archive_path, readonly=True)
+        try:
+            self.assertEqual(self.timestamps(archive), ["2022-01-01T00:02:00Z"])
+            self.assertEqual(archive.execute("SELECT COUNT(*) FROM ReceiveText").fetchone(), (1,))
+        finally:
+            archive.close()
+        self.assertEqual(self.query("SELECT COUNT(*) FROM ReceiveText"), [(1,)])
+        # Nothing left for another run to remove
+        self.assertEqual(apply_retention(self.writer, archive_path, POLICY, now=NOW), {})
+
+
+def scan(timestamp, body_name, **fields):
+    return {"timestamp": timestamp, "event": "Scan", "BodyName": body_name, **fields}
+
+
+class ShardTest(DatabaseTest):
+    # Events of each month imported into a shard of their own and read back through the union views
+    def read(self, sql, since=None, until=None):
+        conn = connect(self.db_path, readonly=True, since=since, until=until)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_months(self):
+        # Imported before sharding, stays in the main database
+        self.import_events(StructuredImport(self.writer), scan("2021-12-31T23:00:00Z", "A 0"))
+        with self.writer.transaction():
+            enable_shards(self.writer)
+        self.import_events(
+            structured_import(self.writer),
+            scan("2022-01-15T00:00:00Z", "A 1"),
+            scan("2022-02-15T00:00:00Z", "A 2"),
+            # A key the earlier months' tables don't have
+            scan("2022-03-15T00:00:00Z", "A 3", Landable=True),
+        )
+        self.assertEqual(self.query("SELECT name FROM shards ORDER BY name"),
+                         [("2022-01",), ("2022-02",), ("2022-03",)])
+        with sqlite3.connect(shard_path(self.db_path, "2022-02")) as conn:
+            self.assertEqual(conn.execute("SELECT id FROM events").fetchall(), [(shard_id_offset("2022-02") + 1,)])
+        conn.close()
+        self.assertEqual(self.read("SELECT BodyName, Landable FROM Scan ORDER BY event_id"),
+                         [("A 0", None), ("A 1", None), ("A 2", None), ("A 3", 1)])
+        self.assertEqual(self.read("SELECT BodyName FROM Scan ORDER BY event_id", since="2022-02", until="2022-02"),
+                         [("A 2",)])
+        self.assertEqual(self.read("SELECT BodyName FROM Scan ORDER BY event_id", since="2021-12-31"),
+                         [("A 0",), ("A 1",), ("A 2",), ("A 3",)])
+        self.assertEqual(self.read("SELECT type FROM events ORDER BY id", until="2022-01"), [("Scan",), ("Scan",)])
+
+    def test_trades(self):
+        # TradeJournal's events spread over three months, each month's in a shard of its own
+        events = list(TradeJournal(seed=4, visit_every=10).events(900))
+        for i, event in enumerate(events):
+            event["timestamp"] = "2022-%02d" % (i // 300 + 1) + event["timestamp"][7:]
+        unsharded_path = os.path.join(self.tmp.name, "unsharded.db")
+        unsharded = connect(unsharded_path)
+        try:
+            writer = Writer(unsharded, False)
+            with writer.transaction():
+                importer = StructuredImport(writer)
+                for event in copy.deepcopy(events):
+                    importer.event(event)
+            trades = sorted(unsharded.execute(trade_query()).fetchall(), key=repr)
+        finally:
+            unsharded.close()
+        with self.writer.transaction():
+            StructuredImport(self.writer)
+            enable_shards(self.writer)
+        self.import_events(structured_import(self.writer), *events)
+        self.assertEqual(len(self.query("SELECT name FROM shards")), 3)
+        self.assertTrue(trades)
+        self.assertEqual(sorted(self.read(trade_query()), key=repr), trades)
+
+
+def legacy_import(conn, events):
+    # Events stored as StructuredImport stored them before epochs, MarketItem and snapshots: the line without its
+    # "event" key in events, and a table per type with a column per key, Market.Items included
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TIMESTAMP, key TEXT, "
+                 "index_in_path INTEGER, type TEXT, event JSON)")
+    columns = {}
+    for event in events:
+        event = dict(event)
+        event_type = event.pop('event')
+        event_id = conn.execute("INSERT INTO events (timestamp, type, event) VALUES (?, ?, ?)",
+                                [event['timestamp'], event_type, json.dumps(event)]).lastrowid
+        del event['timestamp']
+        row = {'event_id': event_id, **{
+            k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in event.items()
+        }}
+        if event_type not in columns:
+            columns[event_type] = set()
+            conn.execute('CREATE TABLE %s ("event_id" INTEGER)' % event_type)
+        for k in row:
+            if k not in columns[event_type]:
+                if k != 'event_id':
+                    conn.execute('ALTER TABLE %s ADD COLUMN "%s"' % (event_type, k))
+                columns[event_type].add(k)
+        conn.execute("INSERT INTO %s (%s) VALUES (%s)" % (
+            event_type, ",".join('"%s"' % k for k in row), ",".join("?" for _ in row)
+        ), list(row.values()))
+    conn.commit()
+
+
+class UpgradeTest(DatabaseTest):
+    # A database from before epochs, upgraded, answers the trade query as one imported from scratch does
+    def test_upgrade_pre_epoch(self):
+        events = list(TradeJournal(seed=1, visit_every=10).events(600))
+        legacy_path = os.path.join(self.tmp.name, "legacy.db")
+        with sqlite3.connect(legacy_path) as conn:
+            legacy_import(conn, events)
+        conn.close()
+        legacy = connect(legacy_path)
+        try:
+            writer = Writer(legacy, False)
+            with writer.transaction():
+                upgrade(writer)
+            self.import_events(StructuredImport(self.writer), *copy.deepcopy(events))
+            for table in ("events", "Docked", "FSDJump", "MarketBuy", "MarketSell", "MarketItem"):
+                id_column = "id" if table == "events" else "event_id"
+                sql = "SELECT %s, epoch FROM %s ORDER BY %s, rowid" % (id_column, table, id_column)
+                upgraded = legacy.execute(sql).fetchall()
+                self.assertTrue(upgraded, table)
+                self.assertNotIn(None, [epoch for _, epoch in upgraded], table)
+                self.assertEqual(upgraded, self.query(sql), table)
+            trades = sorted(self.query(trade_query()), key=repr)
+            self.assertTrue(trades)
+            self.assertEqual(sorted(legacy.execute(trade_query()).fetchall(), key=repr), trades)
+        finally:
+            legacy.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
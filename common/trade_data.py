@@ -1,7 +1,11 @@
-import sqlite3
+import argparse
 import csv
 import sys
 
+from personaldb import (DEFAULT_SHARDS, SCREENSHOT_FUDGE, TICK_CUTOFF, TICK_DURATION, TradeObservations, Writer,
+                        check_query_plan, connect, default_instrumentation, instrument)
+from query_cache import QueryCache, default_cache_path
+
 DB_PATH = "/home/greg/ed/save.db"
 
 
@@ -22,27 +26,75 @@ def dump_res(res):
 # Complete = None -> Show all transactions
 # Complete = True -> Show only successfully completed transactions
 # Complete = False -> Show only incomplete transactions that may be completed by manual action
-def get_trade_data(db_path, complete=None, transaction_type=None):
-    tick_cutoff = '+4 hours'
-    tick_duration = '28 hours'
-    # There's some sort of clock skew between the timestamp captured when taking screenshots, and timestamps from EDMC.
-    # Screenshots were recorded as taking place ~25s before the docking event
-    # Artificially add this skew back into the timestamp so that it lines up.
-    screenshot_fudge = '+1 minute'
+def trade_query(complete=None, transaction_type=None):
+    # All times are compared as the integer epoch columns written by StructuredImport, in seconds
+    tick_cutoff = TICK_CUTOFF
+    tick_duration = TICK_DURATION
+    screenshot_fudge = SCREENSHOT_FUDGE
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+    # Epoch of the most recent docking before a point in time.
+    # Walks the Docked epoch index backwards instead of comparing against every Docked row.
+    # Selecting the epoch it is ordered by, rather than the event_id, lets SQLite merge the per-shard indexes of a
+    # sharded database too.
+    def last_docked_before(time_expr):
+        return f"""(
+                SELECT LastDocked.epoch
+                FROM Docked LastDocked
+                WHERE LastDocked.epoch < {time_expr}
+                ORDER BY LastDocked.epoch DESC
+                LIMIT 1
+            )"""
+
+    # Epoch of the latest market snapshot or docking at a market before the transaction.
+    # Only those rows are joined, rather than every earlier one, using the (MarketID, ..., epoch) indexes.
+    # ORDER BY ... LIMIT 1 rather than MAX() so the lookup still uses them through the union views over a
+    # sharded database, which SQLite materializes whole for an aggregate.
+    def latest_before(table, market_expr, commodity_expr=None):
+        commodity_criteria = f"AND Latest.Commodity = {commodity_expr}" if commodity_expr else ""
+        return f"""(
+                        SELECT Latest.epoch
+                        FROM {table} Latest
+                        WHERE Latest.MarketID = {market_expr}
+                        {commodity_criteria}
+                        AND Latest.epoch < TransactEpoch
+                        ORDER BY Latest.epoch DESC
+                        LIMIT 1
+                    )"""
+
+    # Screenshots of a table with the system of the most recent docking before them, read once for all transactions
+    def located(table, columns, group_by):
+        return f"""(
+                    SELECT
+                        {columns},
+                        StarSystem,
+                        {table}.epoch + {screenshot_fudge} ScreenshotEpoch,
+                        replace(text, '\n', '\\n') text
+                    FROM {table}
+                    JOIN (
+                        SELECT
+                            StarSystem,
+                            epoch DockedEpoch
+                        FROM Docked
+                    ) Docked
+                    ON DockedEpoch = {last_docked_before(f"{table}.epoch + {screenshot_fudge}")}
+                    GROUP BY {group_by}
+                    HAVING MAX(DockedEpoch)
+                )"""
 
     if complete is True:
         complete_criteria = """
-            StatusBefore.Influence IS NOT NULL
-            AND StatusAfter.Influence IS NOT NULL
+            Trades.InfluenceBefore IS NOT NULL
+            AND Trades.InfluenceAfter IS NOT NULL
         """
     elif complete is False:
-        complete_criteria = """
+        complete_criteria = f"""
             (
-                (StatusBefore.Influence IS NULL AND datetime() < Trades.TickCutoff)
+                (Trades.InfluenceBefore IS NULL AND {now} < Trades.TickCutoff)
                 OR (
-                    StatusBefore.Influence IS NOT NULL
-                    AND (StatusAfter.Influence IS NULL)
-                    AND (datetime() < Trades.TickWindow)
+                    Trades.InfluenceBefore IS NOT NULL
+                    AND (Trades.InfluenceAfter IS NULL)
+                    AND ({now} < Trades.TickWindow)
                 )
             )
         """
@@ -56,30 +108,7 @@ def get_trade_data(db_path, complete=None, transaction_type=None):
     else:
         transaction_criteria = '1=1'
 
-    writer = csv.writer(sys.stdout, delimiter='\t')
-    with sqlite3.connect(db_path) as conn:
-        res = conn.execute(f"""
-        SELECT
-            date(TransactTime) Date,
-            Trades.StarSystem,
-            Population,
-            Trades.Faction,
-            StatusBefore.Influence,
-            Trades.Type Type,
-            Commodity_Localised Commodity,
-            Count,
-            Inventory,
-            Inventory-Count,
-            Bracket,
-            Price,
-            Count*Price Total,
-            Traffic.TotalTraffic,
-            StatusAfter.Influence,
-            Traffic.Ships,
-            Traffic.text RawTraffic,
-            StatusBefore.text RawStatusBefore,
-            StatusAfter.text RawStatusAfter
-        FROM (
+    trades = f"""
             -- Get all of the non-OCR details of the transaction, should always exist from EDMC.
             SELECT
                 *
@@ -93,34 +122,33 @@ def get_trade_data(db_path, complete=None, transaction_type=None):
                     FROM (
                         -- Details of the transaction itself
                         SELECT
+                            event_id TradeId,
                             MarketId,
                             "Buy" Type,
                             MarketBuy.Type Commodity,
                             Count,
-                            datetime(timestamp) TransactTime,
-                            datetime(timestamp, '{tick_cutoff}') TickCutoff,
-                            datetime(timestamp, '+{tick_duration}') TickWindow,
-                            datetime(timestamp, '-{tick_duration}') PreviousTickWindow
+                            epoch TransactEpoch,
+                            epoch + {tick_cutoff} TickCutoff,
+                            epoch + {tick_duration} TickWindow,
+                            epoch - {tick_duration} PreviousTickWindow
                         FROM MarketBuy
-                        JOIN events ON event_id = events.id
                     ) Transact
                     JOIN (
                         -- Details of the market performing the transaction, such as demand come from the market event
                         SELECT
-                            MarketId,
-                            StarSystem,
-                            json_extract(item.value, '$.Name_Localised') Commodity_Localised,
-                            replace(lower(json_extract(item.value, '$.Name_Localised')), ' ', '') Commodity,
-                            json_extract(item.value,'$.BuyPrice') Price,
-                            json_extract(item.value,'$.Stock') Inventory,
-                            json_extract(item.value,'$.StockBracket') Bracket,
-                            datetime(timestamp) MarketTime
-                        FROM Market, json_each(Market.Items) item
-                        JOIN events ON event_id = events.id
+                            MarketItem.MarketId,
+                            (SELECT StarSystem FROM Market WHERE Market.event_id = MarketItem.event_id) StarSystem,
+                            Name_Localised Commodity_Localised,
+                            Commodity,
+                            BuyPrice Price,
+                            Stock Inventory,
+                            StockBracket Bracket,
+                            MarketItem.epoch MarketEpoch
+                        FROM MarketItem
                     ) Market
                     ON Market.MarketId = Transact.MarketID
                     AND Market.Commodity = Transact.Commodity
-                    AND MarketTime < TransactTime
+                    AND MarketEpoch = {latest_before("MarketItem", "Transact.MarketID", "Transact.Commodity")}
                 )
                 UNION ALL
                 SELECT
@@ -132,150 +160,257 @@ def get_trade_data(db_path, complete=None, transaction_type=None):
                     FROM (
                         -- Details of the transaction itself
                         SELECT
+                            event_id TradeId,
                             MarketId,
                             "Sell" Type,
                             MarketSell.Type Commodity,
                             Count,
-                            datetime(timestamp) TransactTime,
-                            datetime(timestamp, '{tick_cutoff}') TickCutoff,
-                            datetime(timestamp, '+{tick_duration}') TickWindow,
-                            datetime(timestamp, '-{tick_duration}') PreviousTickWindow
+                            epoch TransactEpoch,
+                            epoch + {tick_cutoff} TickCutoff,
+                            epoch + {tick_duration} TickWindow,
+                            epoch - {tick_duration} PreviousTickWindow
                         FROM MarketSell
-                        JOIN events ON event_id = events.id
                     ) Transact
                     JOIN (
                         -- Details of the market performing the transaction, such as demand come from the market event
                         SELECT
-                            MarketId,
-                            StarSystem,
-                            json_extract(item.value, '$.Name_Localised') Commodity_Localised,
-                            replace(lower(json_extract(item.value, '$.Name_Localised')), ' ', '') Commodity,
-                            json_extract(item.value,'$.SellPrice') Price,
-                            json_extract(item.value,'$.Demand') Inventory,
-                            json_extract(item.value,'$.DemandBracket') Bracket,
-                            datetime(timestamp) MarketTime
-                        FROM Market, json_each(Market.Items) item
-                        JOIN events ON event_id = events.id
+                            MarketItem.MarketId,
+                            (SELECT StarSystem FROM Market WHERE Market.event_id = MarketItem.event_id) StarSystem,
+                            Name_Localised Commodity_Localised,
+                            Commodity,
+                            SellPrice Price,
+                            Demand Inventory,
+                            DemandBracket Bracket,
+                            MarketItem.epoch MarketEpoch
+                        FROM MarketItem
                     ) Market
                     ON Market.MarketId = Transact.MarketID
                     AND Market.Commodity = Transact.Commodity
-                    AND MarketTime < TransactTime
+                    AND MarketEpoch = {latest_before("MarketItem", "Transact.MarketID", "Transact.Commodity")}
                 )
             ) Transact
-            JOIN (
-                -- Details about the system population come from an arbitrary jump into the system
+            -- CROSS JOIN keeps the transactions as the outer loop, so the lookups below run once per transaction
+            -- rather than once per jump or docking when the tables are views over shards
+            CROSS JOIN (
+                -- Details about the system population come from the latest jump into the system
                 SELECT
+                    event_id JumpId,
                     Population,
                     StarSystem
                 FROM FSDJump
             ) FSDJump
-            ON FSDJump.StarSystem = Transact.StarSystem
-            JOIN (
+            ON JumpId = (
+                SELECT LastJump.event_id
+                FROM FSDJump LastJump
+                WHERE LastJump.StarSystem = Transact.StarSystem
+                ORDER BY LastJump.event_id DESC
+                LIMIT 1
+            )
+            CROSS JOIN (
                 -- Details about the faction come from the most recent docking event
                 SELECT
                     StationName,
                     StarSystem,
-                    json_extract(StationFaction, '$.Name') Faction,
+                    json_extract(inflate(StationFaction), '$.Name') Faction,
                     MarketId,
-                    datetime(timestamp) DockedTime
+                    epoch DockedEpoch
                 FROM Docked
-                JOIN events ON event_id = events.id
             ) Docked
             ON Docked.MarketId = Transact.MarketId
-            AND DockedTime < TransactTime
-            GROUP BY TransactTime
-            HAVING MAX(MarketTime) AND MAX(DockedTime)
-        ) Trades
-        -- Left join all of the OCR details in case they are missing, show incomplete tests.
-        LEFT JOIN (
+            AND DockedEpoch = {latest_before("Docked", "Transact.MarketID")}
+            -- Only repeats of the same market snapshot or docking at one epoch, if any, are left to group
+            GROUP BY TradeId
+    """
+
+    traffic = located("DetailedTrafficReport", "total TotalTraffic, ships Ships", "ScreenshotEpoch")
+    statuses = located("LocalFactionStatusSummary", "faction StatusFaction, influence Influence",
+                       "StatusFaction, ScreenshotEpoch")
+
+    # The OCR details are left joined one table at a time in case they are missing, to show incomplete tests.
+    # Each level has a single MIN() or MAX(), so SQLite takes the other columns of the screenshot from the row it
+    # picks where there are several in the window: the earliest traffic report in the measured tick, and the latest
+    # status in the tick before the transaction and earliest in the tick after.
+    return f"""
+        SELECT
+            date(TransactEpoch, 'unixepoch') Date,
+            StarSystem,
+            Population,
+            Faction,
+            InfluenceBefore Influence,
+            Type,
+            Commodity_Localised Commodity,
+            Count,
+            Inventory,
+            Inventory-Count,
+            Bracket,
+            Price,
+            Count*Price Total,
+            TotalTraffic,
+            InfluenceAfter Influence,
+            Ships,
+            RawTraffic,
+            RawStatusBefore,
+            RawStatusAfter
+        FROM (
             SELECT
-                *
+                Trades.*,
+                StatusAfter.Influence InfluenceAfter,
+                StatusAfter.text RawStatusAfter,
+                MIN(StatusAfter.ScreenshotEpoch) StatusAfterEpoch
             FROM (
-                -- Details about the traffic in the system during the measured tick
-                SELECT
-                    total TotalTraffic,
-                    ships Ships,
-                    datetime(timestamp, '{screenshot_fudge}') TrafficTime,
-                    replace(text, '\n', '\\n') text
-                FROM DetailedTrafficReport
-                JOIN events ON event_id = events.id
-            ) Traffic
-            JOIN (
                 SELECT
-                    StarSystem,
-                    datetime(timestamp) DockedTime
-                FROM Docked
-                JOIN events ON event_id = events.id
-            ) Docked
-            ON DockedTime < TrafficTime
-            GROUP BY TrafficTime
-            HAVING MAX(DockedTime)
-        ) Traffic
-        ON Traffic.StarSystem = Trades.StarSystem
-        AND Trades.TickCutoff < TrafficTime
-        AND TrafficTime < Trades.TickWindow
-        JOIN (
-            SELECT
-                StarSystem,
-                faction StatusFaction,
-                influence Influence,
-                DockedTime,
-                datetime(timestamp, '{screenshot_fudge}') StatusBeforeTime,
-                replace(text, '\n', '\\n') text
-            FROM LocalFactionStatusSummary
-            JOIN events ON event_id = events.id
-            JOIN (
-                SELECT
-                    StarSystem,
-                    datetime(timestamp) DockedTime
-                FROM Docked
-                JOIN events ON event_id = events.id
-            ) Docked
-            ON DockedTime < StatusBeforeTime
-            GROUP BY StatusFaction, StatusBeforeTime
-            HAVING MAX(DockedTime)
-        ) StatusBefore
-        ON StatusBeforeTime < Trades.TickCutoff
-        AND Trades.PreviousTickWindow < StatusBeforeTime
-        AND StatusBefore.StarSystem = Trades.StarSystem
-        AND StatusBefore.StatusFaction = upper(Trades.Faction)
-        LEFT JOIN (
-            SELECT
-                StarSystem,
-                faction StatusFaction,
-                influence Influence,
-                datetime(timestamp, '{screenshot_fudge}') StatusAfterTime,
-                replace(text, '\n', '\\n') text
-            FROM LocalFactionStatusSummary
-            JOIN events ON event_id = events.id
-            JOIN (
-                SELECT
-                    StarSystem,
-                    datetime(timestamp) DockedTime
-                FROM Docked
-                JOIN events ON event_id = events.id
-            ) Docked
-            ON DockedTime < StatusAfterTime
-            GROUP BY StatusFaction, StatusAfterTime
-            HAVING MAX(DockedTime)
-        ) StatusAfter
-        ON Trades.TickCutoff < StatusAfterTime
-        AND StatusAfterTime < Trades.TickWindow
-        AND StatusAfter.StarSystem = Trades.StarSystem
-        AND StatusAfter.StatusFaction = upper(Trades.Faction)
+                    Trades.*,
+                    StatusBefore.Influence InfluenceBefore,
+                    StatusBefore.text RawStatusBefore,
+                    MAX(StatusBefore.ScreenshotEpoch) StatusBeforeEpoch
+                FROM (
+                    SELECT
+                        Trades.*,
+                        Traffic.TotalTraffic,
+                        Traffic.Ships,
+                        Traffic.text RawTraffic,
+                        MIN(Traffic.ScreenshotEpoch) TrafficEpoch
+                    FROM ({trades}) Trades
+                    -- Details about the traffic in the system during the measured tick
+                    LEFT JOIN {traffic} Traffic
+                    ON Traffic.StarSystem = Trades.StarSystem
+                    AND Trades.TickCutoff < Traffic.ScreenshotEpoch
+                    AND Traffic.ScreenshotEpoch < Trades.TickWindow
+                    GROUP BY Trades.TradeId
+                ) Trades
+                JOIN {statuses} StatusBefore
+                ON StatusBefore.ScreenshotEpoch < Trades.TickCutoff
+                AND Trades.PreviousTickWindow < StatusBefore.ScreenshotEpoch
+                AND StatusBefore.StarSystem = Trades.StarSystem
+                AND StatusBefore.StatusFaction = upper(Trades.Faction)
+                GROUP BY Trades.TradeId
+            ) Trades
+            LEFT JOIN {statuses} StatusAfter
+            ON Trades.TickCutoff < StatusAfter.ScreenshotEpoch
+            AND StatusAfter.ScreenshotEpoch < Trades.TickWindow
+            AND StatusAfter.StarSystem = Trades.StarSystem
+            AND StatusAfter.StatusFaction = upper(Trades.Faction)
+            GROUP BY Trades.TradeId
+        ) Trades
         WHERE {complete_criteria} AND {transaction_criteria}
-        GROUP BY Trades.TransactTime
-        HAVING
-            (MIN(TrafficTime) OR TrafficTime IS NULL)
-            AND
-            (MAX(StatusBeforeTime) OR StatusBeforeTime IS NULL)
-            AND
-            (MIN(StatusAfterTime) OR StatusAfterTime IS NULL)
-        ORDER BY Trades.TransactTime
-        """)
+        ORDER BY Trades.TransactEpoch, Trades.TradeId
+        """
+
+
+# The same report read from TradeObservation, kept up to date on import once rebuild_trade_observations() created it.
+# A row per transaction, with the same screenshots as trade_query(): the earliest traffic report, and the latest status
+# before and earliest after the tick.
+def observation_query(complete=None, transaction_type=None):
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    criteria = [
+        # Transactions trade_query() drops: no jump into the system, or no influence measured before
+        "JumpId IS NOT NULL",
+        "StatusBeforeEpoch IS NOT NULL",
+    ]
+    if complete is True:
+        criteria.append("InfluenceBefore IS NOT NULL AND InfluenceAfter IS NOT NULL")
+    elif complete is False:
+        criteria.append(f"""(
+            (InfluenceBefore IS NULL AND {now} < TickCutoff)
+            OR (InfluenceBefore IS NOT NULL AND InfluenceAfter IS NULL AND {now} < TickWindow)
+        )""")
+    if transaction_type is not None:
+        criteria.append(f"Type = '{transaction_type}'")
+    return f"""
+        SELECT
+            date(TransactEpoch, 'unixepoch') Date,
+            StarSystem,
+            Population,
+            Faction,
+            InfluenceBefore,
+            Type,
+            Commodity_Localised Commodity,
+            Count,
+            Inventory,
+            Inventory-Count,
+            Bracket,
+            Price,
+            Count*Price Total,
+            TotalTraffic,
+            InfluenceAfter,
+            Ships,
+            RawTraffic,
+            RawStatusBefore,
+            RawStatusAfter
+        FROM TradeObservation
+        WHERE {" AND ".join(criteria)}
+        ORDER BY TransactEpoch, event_id
+        """
+
+
+def has_observations(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'TradeObservation'").fetchone() is not None
+
+
+def get_trade_data(db_path, complete=None, transaction_type=None, instrumentation=None, since=None, until=None,
+                   cache=None):
+    writer = csv.writer(sys.stdout, delimiter='\t')
+    instrumentation = instrumentation or default_instrumentation()
+    with connect(db_path, readonly=True, since=since, until=until) as conn:
+        if has_observations(conn):
+            sql = observation_query(complete, transaction_type)
+        else:
+            sql = trade_query(complete, transaction_type)
+
+        def compute():
+            return instrumentation.query(conn, sql) if instrumentation else conn.execute(sql)
+        # Which trades are incomplete depends on the time of the query as well as on the database
+        res = cache.rows(conn, [sql], compute) if cache and complete is not False else compute()
         for r in res:
             writer.writerow(r)
 
 
+def check_trade_plans(db_path, since=None, until=None):
+    with connect(db_path, readonly=True, since=since, until=until) as conn:
+        for complete in (None, True, False):
+            for transaction_type in (None, 'Buy', 'Sell'):
+                check_query_plan(conn, trade_query(complete, transaction_type))
+                if has_observations(conn):
+                    check_query_plan(conn, observation_query(complete, transaction_type))
+
+
+def rebuild_trade_observations(db_path):
+    with connect(db_path) as conn:
+        writer = Writer(conn, False)
+        if "shards" in writer.schema_cache:
+            raise Exception("TradeObservation is not supported on a sharded database, query it with trade_query()")
+        with writer.transaction():
+            TradeObservations(writer).rebuild()
+
+
 if __name__ == "__main__":
-    get_trade_data(DB_PATH)
+    parser = argparse.ArgumentParser(description="Dump trade transactions with their market and influence data")
+    parser.add_argument("--check-plan",
+                        help="Fail if any variant of the trade query falls back to a full table scan",
+                        action="store_true")
+    parser.add_argument("--rebuild",
+                        help="Recompute the TradeObservation table from the imported events, creating it if needed. "
+                             "Imports started from then on keep it up to date.",
+                        action="store_true")
+    parser.add_argument("--no-cache",
+                        help="Run the query even if the database is unchanged since its result was cached",
+                        action="store_true")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write query timings to PATH on exit, as JSON if it ends in .json, '-' for stderr")
+    parser.add_argument("--since", metavar="DATE",
+                        help="On a sharded database, only read the months from DATE (YYYY-MM or an ISO timestamp). "
+                             f"Without --since or --until the newest {DEFAULT_SHARDS} months are read")
+    parser.add_argument("--until", metavar="DATE",
+                        help="On a sharded database, only read the months up to DATE (YYYY-MM or an ISO timestamp)")
+    args = parser.parse_args()
+    if args.profile:
+        instrument(args.profile)
+    if args.rebuild:
+        rebuild_trade_observations(DB_PATH)
+    elif args.check_plan:
+        check_trade_plans(DB_PATH, args.since, args.until)
+    else:
+        cache = None
+        if not args.no_cache:
+            cache = QueryCache(default_cache_path(DB_PATH), instrumentation=default_instrumentation())
+        get_trade_data(DB_PATH, since=args.since, until=args.until, cache=cache)
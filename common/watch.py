@@ -0,0 +1,98 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    # Names of files in one directory that were written, created or moved in, straight from the kernel
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for %s" % path)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        names = set()
+        while readable:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name:
+                    names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher:
+    # Stat-based stand-in for inotify. Polls quickly after a change and backs off while the directory is quiet,
+    # to at most MAX_INTERVAL between scans however long the caller waits.
+    MIN_INTERVAL = 0.05
+    MAX_INTERVAL = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.interval = self.MIN_INTERVAL
+        self.seen = self._scan()
+
+    def _scan(self):
+        seen = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                seen[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return seen
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            time.sleep(max(min(self.interval, deadline - time.monotonic()), 0))
+            seen = self._scan()
+            names = {name for name, state in seen.items() if self.seen.get(name) != state}
+            self.seen = seen
+            if names:
+                self.interval = self.MIN_INTERVAL
+                return names
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+            if time.monotonic() >= deadline:
+                return names
+
+    def close(self):
+        pass
+
+
+def watch(path):
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError, TypeError) as e:
+        print("inotify unavailable (%s), polling %s instead" % (e, path), file=sys.stderr)
+        return PollWatcher(path)
@@ -1,8 +1,6 @@
-import sqlite3
 import sys
 import tkinter as tk
 import pathlib
-import json
 import myNotebook as nb
 from config import config
 import logging
@@ -10,7 +8,7 @@ import os
 
 from config import appname
 
-from common.personaldb import Writer, StructuredImport
+from common.personaldb import BackgroundWriter, decode_event
 
 DB_PATH = "/home/greg/ed/save.db"
 
@@ -45,9 +43,19 @@ def plugin_start3(plugin_dir):
 
 def plugin_start():
     this.marketId = None
+    this.writer = BackgroundWriter(DB_PATH, on_error=write_failed)
     return 'TradeResearch'
 
 
+def plugin_stop():
+    this.writer.stop()
+
+
+def write_failed(entry):
+    # Runs on the writer thread, the status label picks the error up on the next journal entry
+    logger.exception(f"Failed to write {entry.get('event')}")
+
+
 def plugin_app(parent):
     label = tk.Label(parent, text="Trade Research:")
     this.status = tk.Label(parent, text="Ready", anchor=tk.W)
@@ -67,7 +75,6 @@ def prefs_changed(cmdr, is_beta):
 
 def journal_entry(cmdr, is_beta, system, station, entry, state):
     event = entry['event'] if 'event' in entry else None
-    this.status['text'] = f"Writing {event}"
     try:
         if not state['Captain'] and entry['event'] in ('Market', 'Outfitting', 'Shipyard'):
             if this.marketId != entry['MarketID']:
@@ -81,14 +88,13 @@ def journal_entry(cmdr, is_beta, system, station, entry, state):
             path = pathlib.Path(journaldir) / f'{entry["event"]}.json'
 
             with path.open('rb') as f:
-                entry = json.load(f)
-
-        with sqlite3.connect(DB_PATH) as conn:
-            writer = Writer(conn, False)
-            importer = StructuredImport(writer)
-            importer.event(entry)
-            writer.commit()
-        this.status['text'] = f"Wrote {event}"
+                entry = decode_event(f.read())
+
+        this.writer.submit(entry)
+        if this.writer.last_error is not None:
+            this.status['text'] = f"Error: {this.writer.last_error}"
+        else:
+            this.status['text'] = f"Queued {event}"
     except Exception as e:
         this.status['text'] = 'Error'
         raise e